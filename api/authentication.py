@@ -0,0 +1,105 @@
+"""
+knox token authentication with a cache in front of the token table. a validated token is cached under its digest
+together with its user, the profile and priority of the user and its permissions, so permission classes, serializers
+and views of a request never load them again, and following requests do not even query the token.
+entries are dropped when the token is deleted (logout) and skipped once the version of the user is increased,
+see api.signals
+"""
+import binascii
+from hmac import compare_digest
+
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from knox.auth import TokenAuthentication
+from knox.crypto import hash_token
+from knox.models import AuthToken
+from knox.settings import CONSTANTS, knox_settings
+from rest_framework import exceptions
+
+from base import cache as cache_versions
+
+
+def token_cache_key(digest: str) -> str:
+    return f"authtoken:{digest}"
+
+
+def user_version_name(pk: int) -> str:
+    return f"user:{pk}"
+
+
+def invalidate_token(digest: str):
+    cache.delete(token_cache_key(digest))
+
+
+def invalidate_users(pks):
+    """
+    drops the cached tokens of the users, e.g. after their permissions changed
+    """
+    cache_versions.bump_version(*[user_version_name(pk) for pk in pks])
+
+
+def preload_permissions(user):
+    """
+    fills the permission cache of ModelBackend with one query instead of one for the user and one for the groups
+    """
+    if not user.is_active:
+        return
+    if user.is_superuser:
+        permissions = Permission.objects.all()
+    else:
+        permissions = Permission.objects.filter(models.Q(user=user) | models.Q(group__user=user))
+    user._perm_cache = {f"{app_label}.{codename}" for app_label, codename in permissions.values_list('content_type__app_label', 'codename')}
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, token):
+        try:
+            digest = hash_token(token.decode("utf-8"))
+        except (TypeError, binascii.Error, UnicodeDecodeError):
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        key = token_cache_key(digest)
+        cached = cache.get(key)
+        if cached is not None:
+            auth_token, version = cached
+            if (auth_token.expiry is None or auth_token.expiry > timezone.now()) and \
+                    version == cache_versions.get_version(user_version_name(auth_token.user_id)):
+                if knox_settings.AUTO_REFRESH and auth_token.expiry and self.renew_token(auth_token):
+                    cache.set(key, (auth_token, version), settings.AUTH_TOKEN_CACHE_TIMEOUT)
+                return self.validate_user(auth_token)
+        user, auth_token = self.lookup(token.decode("utf-8"), digest)
+        version = cache_versions.get_version(user_version_name(user.pk))
+        # loaded after reading the version, so a permission change in between makes the entry outdated at once,
+        # other races are bounded by the timeout
+        preload_permissions(user)
+        if settings.AUTH_TOKEN_CACHE_TIMEOUT > 0:
+            cache.set(key, (auth_token, version), settings.AUTH_TOKEN_CACHE_TIMEOUT)
+        return user, auth_token
+
+    def lookup(self, token: str, digest: str):
+        """
+        TokenAuthentication.authenticate_credentials, fetching the user with profile and priority in the same query
+        """
+        for auth_token in AuthToken.objects.select_related('user__profile__prio').filter(token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH]):
+            if self._cleanup_token(auth_token):
+                continue
+            if compare_digest(digest, auth_token.digest):
+                if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                    self.renew_token(auth_token)
+                return self.validate_user(auth_token)
+        raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+    def renew_token(self, auth_token) -> bool:
+        """
+        moves the expiry at most every MIN_REFRESH_INTERVAL seconds, returns whether it was written
+        """
+        new_expiry = timezone.now() + knox_settings.TOKEN_TTL
+        if (new_expiry - auth_token.expiry).total_seconds() <= knox_settings.MIN_REFRESH_INTERVAL:
+            return False
+        # update instead of save, a token deleted meanwhile stays deleted
+        AuthToken.objects.filter(digest=auth_token.digest).update(expiry=new_expiry)
+        auth_token.expiry = new_expiry
+        return True
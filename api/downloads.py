@@ -0,0 +1,142 @@
+"""
+file downloads that do not load the file into the worker. the bytes are streamed by FileResponse or, with
+FILE_DOWNLOAD_MODE 'x-accel-redirect' or 'x-sendfile', sent by the web server in front of django.
+every response carries ETag and Last-Modified, so clients revalidate instead of downloading again, and single
+byte ranges are answered with 206 so interrupted downloads can be resumed
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from typing import Optional
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpRequest, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# rental form exports were stored in MEDIA_ROOT before they moved to PRIVATE_MEDIA_ROOT, see base.storage
+PRIVATE_PREFIXES = ('rental_form_exports/',)
+
+
+def parse_range(header: str, size: int):
+    """
+    (start, end) of the first byte and the last byte of a single range, None if the header is not usable
+    and the whole file has to be sent. raises ValueError if the range lies behind the end of the file
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # multiple ranges are rare enough to answer them with the whole file
+        return None
+    start, end = match.groups()
+    if start == '':
+        if end == '':
+            return None
+        # the last n bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class RangeFile:
+    """
+    file like object that ends after length bytes, FileResponse streams it in chunks
+    """
+
+    def __init__(self, file, start: int, length: int):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def file_response(request: HttpRequest, path: str, name: str, content_type: Optional[str] = None,
+                  as_attachment: bool = False, filename: Optional[str] = None, accel_prefix: Optional[str] = None) -> HttpResponse:
+    """
+    response for the file at path. name is the path relative to the root of its storage, the web server finds the
+    file by it below accel_prefix (FILE_DOWNLOAD_ACCEL_PREFIX by default) in the x-accel-redirect mode
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404(f"{name} does not exist")
+    etag = quote_etag(f"{int(stat.st_mtime * 1000):x}-{stat.st_size:x}")
+    last_modified = http_date(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if settings.FILE_DOWNLOAD_MODE == 'x-accel-redirect':
+            # nginx answers conditional and range requests of the internal location itself
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = quote(posixpath.join(accel_prefix or settings.FILE_DOWNLOAD_ACCEL_PREFIX, name.replace(os.sep, '/')))
+        elif settings.FILE_DOWNLOAD_MODE == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = ranged_file_response(request, path, stat.st_size, content_type, (etag, last_modified))
+        if as_attachment or filename:
+            disposition = 'attachment' if as_attachment else 'inline'
+            response['Content-Disposition'] = f"{disposition}; filename*=utf-8''{quote(filename or os.path.basename(path))}"
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def ranged_file_response(request: HttpRequest, path: str, size: int, content_type: str, validators) -> HttpResponse:
+    """
+    validators are the etag and the last modification date of the file
+    """
+    byte_range = None
+    header = request.headers.get('Range')
+    # If-Range names the version the client has a part of, for other versions the whole file is sent
+    if header and request.headers.get('If-Range', validators[0]) in validators:
+        try:
+            byte_range = parse_range(header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{size}"
+            return response
+    if byte_range is None:
+        return FileResponse(open(path, 'rb'), content_type=content_type)
+    start, end = byte_range
+    response = FileResponse(RangeFile(open(path, 'rb'), start, end - start + 1), status=206, content_type=content_type)
+    response['Content-Length'] = str(end - start + 1)
+    response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def media(request: HttpRequest, path: str) -> HttpResponse:
+    """
+    replaces django.views.static.serve for MEDIA_URL
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith(PRIVATE_PREFIXES):
+        raise Http404(f"{path} does not exist")
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404(f"{path} does not exist")
+    if os.path.isdir(full_path):
+        raise Http404(f"{path} does not exist")
+    return file_response(request, full_path, path)
@@ -0,0 +1,142 @@
+"""
+per request performance numbers: wall time, time spent in the database, number of queries, queries that were sent
+more than once with the same parameters and cache hits. they are sent to the client as Server-Timing header, so they
+show up in the network tab of the browser, logged as one json line to the 'performance' logger and counted in the
+prometheus metrics of base.metrics.
+requests slower than SLOW_REQUEST_THRESHOLD seconds are logged as warning together with their sql statements
+"""
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from base import metrics
+
+logger = logging.getLogger("performance")
+
+_missing = object()
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = []
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        execute_wrapper of the database connection
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.db_time += duration
+            self.queries.append((sql, params, duration))
+
+    def duplicate_queries(self) -> int:
+        counts = Counter((sql, repr(params)) for sql, params, _ in self.queries)
+        return sum(count - 1 for count in counts.values())
+
+    @contextmanager
+    def count_cache(self, alias='default'):
+        """
+        counts the hits of get and get_many of the cache of this thread
+        """
+        backend = caches[alias]
+        get, get_many = backend.get, backend.get_many
+
+        def counting_get(key, default=None, version=None):
+            value = get(key, _missing, version=version)
+            if value is _missing:
+                self.cache_misses += 1
+                return default
+            self.cache_hits += 1
+            return value
+
+        def counting_get_many(keys, version=None):
+            keys = list(keys)
+            values = get_many(keys, version=version)
+            self.cache_hits += len(values)
+            self.cache_misses += len(keys) - len(values)
+            return values
+
+        backend.get, backend.get_many = counting_get, counting_get_many
+        try:
+            yield
+        finally:
+            del backend.get, backend.get_many
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        started = time.perf_counter()
+        with connection.execute_wrapper(stats), stats.count_cache():
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+        duplicates = stats.duplicate_queries()
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = ', '.join([
+                f'total;dur={duration * 1000:.1f}',
+                f'db;dur={stats.db_time * 1000:.1f};desc="{len(stats.queries)} queries, {duplicates} duplicates"',
+                f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+            ])
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'view': getattr(request, 'performance_view', None),
+            'action': getattr(request, 'performance_action', None),
+            'duration_ms': round(duration * 1000, 1),
+            'db_ms': round(stats.db_time * 1000, 1),
+            'queries': len(stats.queries),
+            'duplicate_queries': duplicates,
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+        }
+        metrics.observe_request(getattr(request, 'metrics_action', 'unresolved'), request.method, response.status_code, duration, len(stats.queries))
+        if duration >= settings.SLOW_REQUEST_THRESHOLD:
+            # slowest statements first
+            record['sql'] = [{'sql': sql, 'ms': round(query_duration * 1000, 2)}
+                             for sql, _, query_duration in sorted(stats.queries, key=lambda query: -query[2])[:settings.SLOW_REQUEST_MAX_QUERIES]]
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        remembers the drf view and action, e.g. ReservationViewSet and bulk_create
+        """
+        view_class = getattr(view_func, 'cls', None)
+        request.performance_view = view_class.__name__ if view_class is not None else view_func.__name__
+        actions = getattr(view_func, 'actions', None)
+        request.performance_action = actions.get(request.method.lower()) if actions else None
+        # url prefix of the viewset, e.g. reservations.bulk_create, the url name for everything else
+        prefix = viewset_prefixes().get(view_class)
+        if prefix is not None:
+            request.metrics_action = f"{prefix}.{request.performance_action}"
+        else:
+            request.metrics_action = request.resolver_match.view_name if request.resolver_match else request.performance_view
+
+
+_viewset_prefixes = None
+
+
+def viewset_prefixes() -> dict:
+    global _viewset_prefixes
+    if _viewset_prefixes is None:
+        from api.urls import router
+        _viewset_prefixes = {viewset: prefix for prefix, viewset, _ in router.registry}
+    return _viewset_prefixes
@@ -0,0 +1,118 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    cursor pagination over the ordering in cursor_ordering of the view, e.g. ('reserved_from', 'id').
+    the cursor contains the values of all ordering fields of the last row, so every page is a index range scan
+    no matter how deep into the history it is.
+    only used if the request contains the cursor or page_size param, otherwise the whole list is returned as before
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = [(field.lstrip('-'), field.startswith('-')) for field in view.cursor_ordering]
+        self.page_size = self.get_page_size(request)
+        position, self.reverse = self.decode_cursor(request, queryset.model)
+
+        if position is not None:
+            queryset = queryset.filter(self.after(position, self.reverse))
+        queryset = queryset.order_by(*[('-' if descending != self.reverse else '') + field for field, descending in self.ordering])
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def after(self, position, reverse):
+        """
+        rows behind position in the ordering, or in front of it if reverse is set.
+        (a, b) > (x, y) is written as a > x OR (a = x AND b > y) because the fields can have different directions
+        """
+        condition = Q()
+        for i, (field, descending) in enumerate(self.ordering):
+            lookup = 'lt' if descending != reverse else 'gt'
+            equal = {name: value for (name, _), value in zip(self.ordering[:i], position)}
+            condition |= Q(**equal, **{f'{field}__{lookup}': position[i]})
+        return condition
+
+    def decode_cursor(self, request, model):
+        """
+        the position is converted by the fields of the ordering, a forged or stale cursor must not reach the filter
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            position, reverse = cursor['p'], bool(cursor['r'])
+            if not isinstance(position, list) or len(position) != len(self.ordering) or None in position:
+                raise NotFound(self.invalid_cursor_message)
+            position = [model._meta.get_field(field).to_python(value) for (field, _), value in zip(self.ordering, position)]
+        except (TypeError, ValueError, KeyError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, row, reverse):
+        position = [getattr(row, field) for field, _ in self.ordering]
+        # str keeps the microseconds of datetimes which the json encoder of django would cut off
+        cursor = json.dumps({'p': position, 'r': reverse}, default=str)
+        return replace_query_param(self.base_url, self.cursor_query_param, base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii'))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # a previous link that pointed in front of the first row, the next page is the first one
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
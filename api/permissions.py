@@ -11,10 +11,7 @@ logger = logging.getLogger('django')
 
 class UserPermission(permissions.BasePermission):
     def has_permission(self, request:Request, view):
-        logger.info('lol1')
-        logger.info(request.user.is_authenticated)
-        logger.info(request.user.is_superuser)
-        logger.info(view.action)
+        logger.debug(f"UserPermission.has_permission: action={view.action} authenticated={request.user.is_authenticated} superuser={request.user.is_superuser}")
         if view.action in ['list', 'toggle_permission']:
             return request.user.is_authenticated and request.user.is_superuser
         elif view.action == 'create':
@@ -26,10 +23,9 @@ class UserPermission(permissions.BasePermission):
 
     def has_object_permission(self, request:HttpRequest, view, obj):
         # Deny actions on objects if the user is not authenticated
-        logger.info('lol2')
         if not request.user.is_authenticated:
             return False
-        logger.info(request.user.is_superuser)
+        logger.debug(f"UserPermission.has_object_permission: action={view.action} superuser={request.user.is_superuser}")
         if view.action == 'retrieve':
             return obj == request.user or request.user.is_superuser
         elif view.action in ['destroy', 'update', 'partial_update', 'list']:
@@ -118,7 +114,6 @@ class ReservationPermission(permissions.BasePermission):
         """
         if not request.user.is_authenticated:
             return False
-        print(view.action)
         if view.action in ['retrieve', 'bulk_create', 'cancel_reservation', 'list']:
             return True
         elif view.action in ['list', 'create', 'download_form', 'currently_selected_objects']:
@@ -156,6 +151,18 @@ class RentalPermission(permissions.BasePermission):
 
         return True
 
+class RentalFormExportPermission(permissions.BasePermission):
+    def has_permission(self, request:Request, view):
+        """
+        only lenders print rental forms
+        """
+        if not request.user.is_authenticated:
+            return False
+        if view.action in ['create', 'retrieve', 'list', 'download']:
+            return request.user.has_perm('base.lending_access')
+        return False
+
+
 class TextPermission(permissions.BasePermission):
     def has_permission(self, request:Request, view):
         """
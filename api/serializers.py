@@ -2,22 +2,51 @@ from django.contrib.auth.models import User, Group, Permission
 from rest_framework import serializers
 from rest_framework.exceptions import ParseError
 from rest_framework.request import Request
+from rest_framework.reverse import reverse
 from rest_framework import validators
 from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
-from django.db.models import Q
+from django.core.files.storage import default_storage
+from django.db import models as django_models
+from django.db.models import Count, Max, Q
 from django.forms import model_to_dict
 import logging
 import re
 from base.models import Category, RentalObject, RentalObjectType, Reservation, Rental, Tag, Text, Profile
 from base import models
+from base import availability
+from base import dynamic_settings
 from datetime import timedelta, datetime
 
 logger = logging.getLogger(name="django")
 
 
+class ImageVariantsField(serializers.Field):
+    """
+    urls of the image variants of base.images in the same form as ImageField, absolute if there is a request
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        request = self.context.get('request', None)
+        urls = {}
+        for variant, formats in value.items():
+            if variant == 'source':
+                continue
+            urls[variant] = {}
+            for extension, name in formats.items():
+                url = default_storage.url(name)
+                urls[variant][extension] = request.build_absolute_uri(url) if request is not None else url
+        return urls
+
+
 class RentalObjectTypeSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = RentalObjectType
         fields = '__all__'
@@ -79,8 +108,7 @@ class UserCreationSerializer(serializers.HyperlinkedModelSerializer):
         """
         overwrite the email validation to prevent multiuse of emails. Validate Email corresponding to a specific regex
         """
-        regex = re.compile(models.Settings.objects.get(
-            type='email_validation_regex').value)
+        regex = re.compile(dynamic_settings.get('email_validation_regex'))
         result = regex.fullmatch(email)
         if not (result and result.group(0) == email):
             raise serializers.ValidationError("Email ist im falsche Format")
@@ -190,6 +218,9 @@ class RentalObjectSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def get_currently_in_house(self, obj: models.RentalObject) -> bool:
+        if hasattr(obj, 'in_house'):
+            # annotated by RentalObject.objects.with_in_house()
+            return obj.in_house
         return obj.rental_set.filter(Q(Q(handed_out_at__lte=timezone.now()) & Q(Q(received_back_at__gte=timezone.now()) | Q(received_back_at__isnull=True)))).count() == 0
 
     def get_merged_identifier(self, obj: models.RentalObject) -> str:
@@ -220,10 +251,10 @@ class BulkReservationSerializer(serializers.ModelSerializer):
         if type(objectType) is not dict and model_to_dict(objectType)['duration'] + timedelta(days=7) < data['reserved_until']-data['reserved_from']:
             raise serializers.ValidationError(
                 detail="the rent duration exceeds max_rent_duration.")
-        if data['reserved_from'].isoweekday() != int(models.Settings.objects.get(type='lenting_day').value):
+        if data['reserved_from'].isoweekday() != dynamic_settings.get_int('lenting_day'):
             raise serializers.ValidationError(
                 detail="this day is not a lenting day therefore a reservation can not start here")
-        if data['reserved_until'].isoweekday() != int(models.Settings.objects.get(type='returning_day').value):
+        if data['reserved_until'].isoweekday() != dynamic_settings.get_int('returning_day'):
             raise serializers.ValidationError(
                 detail="this day is not a returning day therefore a reservation can not end here")
         if data['reserved_from'] >= data['reserved_until']:
@@ -254,6 +285,9 @@ class ReservationSerializer(serializers.ModelSerializer):
         exclude = ['reserver', 'notified']
 
     def get_fullfilled(self, obj):
+        if hasattr(obj, 'has_handed_out_rental'):
+            # annotated by Reservation.objects.with_fullfilled()
+            return obj.has_handed_out_rental
         return obj.rental_set.filter(handed_out_at__isnull=False).count() > 0
 
 
@@ -268,9 +302,41 @@ class ReservationAdminSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def get_fullfilled(self, obj):
+        if hasattr(obj, 'has_rental'):
+            return obj.has_rental
         return obj.rental_set.all().count() > 0
 
 
+class RentalListSerializer(serializers.ListSerializer):
+    """
+    fills extended_until, extended_count and extendable of all rentals at once. extended_until and extended_count are
+    read from the annotations of Rental.objects.with_extended_until() and with_extension_count(), or fetched with one
+    query for the rentals without them. the availability of all extension windows is calculated with one call of the
+    configured backend instead of once per rental
+    """
+
+    def to_representation(self, data):
+        rentals = list(data.all() if isinstance(data, django_models.manager.BaseManager) else data)
+        shared = {rental.pk: {'extended_until': rental.extended_until_date, 'extended_count': rental.extension_count}
+                  for rental in rentals if 'extended_until_date' in rental.__dict__ and 'extension_count' in rental.__dict__}
+        not_annotated = [rental for rental in rentals if rental.pk not in shared]
+        if not_annotated:
+            extensions = {rental_id: (count, latest) for rental_id, count, latest in models.Extension.objects.filter(
+                extended_rental__in=not_annotated).values('extended_rental').annotate(count=Count('id'), latest=Max('extended_until')).values_list(
+                'extended_rental', 'count', 'latest')}
+            for rental in not_annotated:
+                count, latest = extensions.get(rental.pk, (0, None))
+                shared[rental.pk] = {'extended_until': latest if latest is not None else rental.reservation.reserved_until,
+                                     'extended_count': count}
+        windows = {rental.pk: (rental.rented_object.type_id, *self.child.extension_window(shared[rental.pk]['extended_until']))
+                   for rental in rentals}
+        available = availability.available_ranges(windows.values())
+        for rental in rentals:
+            shared[rental.pk]['extendable'] = available[windows[rental.pk]]['available'] >= 1
+        self.child.shared = shared
+        return super().to_representation(rentals)
+
+
 class RentalSerializer(serializers.ModelSerializer):
     rented_object = RentalObjectSerializer(required=False, read_only=True)
     reservation = ReservationAdminSerializer(required=False, read_only=True)
@@ -284,6 +350,7 @@ class RentalSerializer(serializers.ModelSerializer):
     class Meta:
         model = Rental
         fields = '__all__'
+        list_serializer_class = RentalListSerializer
 
     def validate_reserved_until(self, reserved_until):
         """
@@ -294,24 +361,45 @@ class RentalSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 "reserved until overlaps with a reservation or rental")
         return reserved_until
-    
+
+    def get_shared(self, obj: Rental, field: str):
+        """
+        returns the value RentalListSerializer calculated for this rental or None if it is serialized on its own
+        """
+        return getattr(self, 'shared', {}).get(obj.pk, {}).get(field)
+
     def get_extended_until(self, obj:Rental) -> datetime:
         """
         add a field to check until when an item is rented
         """
-        return obj.extended_until()
+        extended_until = self.get_shared(obj, 'extended_until')
+        return extended_until if extended_until is not None else obj.extended_until()
     
     def get_extended_count(self, obj:Rental) -> int:
-        return obj.extension_set.count()
+        extended_count = self.get_shared(obj, 'extended_count')
+        if extended_count is not None:
+            return extended_count
+        # annotated by Rental.objects.with_extension_count()
+        return obj.extension_count if 'extension_count' in obj.__dict__ else obj.extension_set.count()
+
+    def extension_window(self, extended_until):
+        """
+        the range which has to be available to extend a rental by one week.
+        reserved_from + offset should result in the reseved + offset + offset for reparations
+        """
+        return (availability.normalize_date(extended_until + settings.DEFAULT_OFFSET_BETWEEN_RENTALS),
+                availability.normalize_date(extended_until + timedelta(weeks=1)))
 
     # default extension time = 1 week
     def get_extendable(self, obj) -> bool:
         """
         checking if the object is extendable by 1 week returns true if it is
         """
-        # reserved_from + offset should result in the reseved + offset + offset for reparations
-        available = models.RentalObjectType.available(pk=obj.rented_object.type.pk, from_date=self.get_extended_until(obj) +
-                                                      settings.DEFAULT_OFFSET_BETWEEN_RENTALS, until_date=self.get_extended_until(obj)+timedelta(weeks=1))
+        extendable = self.get_shared(obj, 'extendable')
+        if extendable is not None:
+            return extendable
+        from_date, until_date = self.extension_window(self.get_extended_until(obj))
+        available = models.RentalObjectType.available(pk=obj.rented_object.type.pk, from_date=from_date, until_date=until_date)
         return available["available"] >= 1
 
 
@@ -345,6 +433,30 @@ class FilesSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class RentalFormExportSerializer(serializers.ModelSerializer):
+    download = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.RentalFormExport
+        fields = ['id', 'lending_date', 'operation_numbers', 'status', 'total', 'rendered', 'error', 'created_at', 'finished_at', 'download']
+        read_only_fields = ['status', 'total', 'rendered', 'error', 'created_at', 'finished_at']
+
+    def validate_operation_numbers(self, value):
+        if not isinstance(value, list) or not all(isinstance(number, int) for number in value):
+            raise serializers.ValidationError("expected a list of operation numbers")
+        return value
+
+    def validate(self, data):
+        if (data.get('lending_date') is None) == (not data.get('operation_numbers')):
+            raise serializers.ValidationError("either lending_date or operation_numbers is required")
+        return data
+
+    def get_download(self, obj: models.RentalFormExport):
+        if obj.status != models.RentalFormExport.DONE:
+            return None
+        return reverse('rentalformexport-download', args=[obj.pk], request=self.context.get('request'))
+
+
 class SuggestionSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Suggestion
@@ -369,6 +481,7 @@ class OnPremiseWorkplaceStatusSerializer(serializers.ModelSerializer):
 class OnPremiseWorkplaceSerializer(serializers.ModelSerializer):
     status = OnPremiseWorkplaceStatusSerializer(many=True)
     image = serializers.ImageField(required=False)
+    image_variants = ImageVariantsField()
     class Meta:
         model = models.OnPremiseWorkplace
         fields = '__all__'
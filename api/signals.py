@@ -0,0 +1,66 @@
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from knox.models import AuthToken
+
+from api import authentication
+from base import models
+
+
+def token_deleted(sender, instance, **kwargs):
+    authentication.invalidate_token(instance.digest)
+
+
+def user_changed(sender, instance, **kwargs):
+    authentication.invalidate_users([instance.pk])
+
+
+def profile_changed(sender, instance, **kwargs):
+    authentication.invalidate_users([instance.user_id])
+
+
+def priority_changed(sender, instance, **kwargs):
+    authentication.invalidate_users(list(models.Profile.objects.filter(prio=instance).values_list('user_id', flat=True)))
+
+
+def user_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    groups or permissions of users were added or removed, from the side of the user or of the group/permission
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        pks = [instance.pk]
+    elif pk_set is not None:
+        pks = pk_set
+    else:
+        pks = list(instance.user_set.values_list('pk', flat=True))
+    authentication.invalidate_users(pks)
+
+
+def group_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        groups = [instance.pk]
+    elif pk_set is not None:
+        groups = pk_set
+    else:
+        groups = list(instance.group_set.values_list('pk', flat=True))
+    authentication.invalidate_users(User.objects.filter(groups__in=groups).values_list('pk', flat=True).distinct())
+
+
+def group_deleted(sender, instance, **kwargs):
+    authentication.invalidate_users(list(instance.user_set.values_list('pk', flat=True)))
+
+
+post_delete.connect(token_deleted, sender=AuthToken)
+post_save.connect(user_changed, sender=User)
+post_delete.connect(user_changed, sender=User)
+post_save.connect(profile_changed, sender=models.Profile)
+post_delete.connect(profile_changed, sender=models.Profile)
+post_save.connect(priority_changed, sender=models.Priority)
+pre_delete.connect(priority_changed, sender=models.Priority)
+m2m_changed.connect(user_relations_changed, sender=User.groups.through)
+m2m_changed.connect(user_relations_changed, sender=User.user_permissions.through)
+m2m_changed.connect(group_permissions_changed, sender=Group.permissions.through)
+pre_delete.connect(group_deleted, sender=Group)
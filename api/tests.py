@@ -1,3 +1,588 @@
 from django.test import TestCase
 
 # Create your tests here.
+import base64
+import io
+import os
+import json
+import shutil
+import threading
+import tempfile
+import zipfile
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from knox.models import AuthToken
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient, APIRequestFactory
+
+from api import serializers
+from api.authentication import CachedTokenAuthentication
+from base import availability
+from base import dynamic_settings
+from base import models
+from base import oauth
+from base import rental_form
+from base import tasks
+from base.tests import AvailabilityFixture
+
+
+class RentalSerializerTestCase(AvailabilityFixture, TestCase):
+    def test_list_equals_single_serialization(self):
+        for i, until_date in enumerate([date(2023, 1, 5), date(2023, 1, 12), date(2023, 1, 19)]):
+            reservation = self.reserve(date(2022, 12, 22), until_date, 1)
+            rental = models.Rental.objects.create(rented_object=self.objects[i], rental_number=i, reservation=reservation,
+                                                  handed_out_at=datetime(2022, 12, 22, 12, tzinfo=timezone.get_current_timezone()))
+            if i == 2:
+                models.Extension.objects.create(extended_from=until_date, extended_until=date(2023, 1, 26),
+                                                extended_by=self.profile.user, extended_rental=rental)
+        # blocks all but one object the week after the first rental
+        self.reserve(date(2023, 1, 6), date(2023, 1, 12), 2)
+        rentals = models.Rental.objects.all().order_by('pk')
+        context = {'request': APIRequestFactory().get('/api/rentals/')}
+        expected = [serializers.RentalSerializer(rental, context=context).data for rental in rentals]
+        data = serializers.RentalSerializer(rentals, many=True, context=context).data
+        self.assertEqual([{key: rental[key] for key in ['extended_until', 'extended_count', 'extendable']} for rental in data],
+                         [{key: rental[key] for key in ['extended_until', 'extended_count', 'extendable']} for rental in expected])
+        self.assertEqual([rental['extended_count'] for rental in data], [0, 0, 1])
+
+    @override_settings(AVAILABILITY_BACKEND='calendar')
+    def test_list_uses_the_configured_backend(self):
+        start = timezone.localdate() + timedelta(days=7)
+        reservation = self.reserve(start - timedelta(days=7), start, 1)
+        rental = models.Rental.objects.create(rented_object=self.objects[0], rental_number=1, reservation=reservation,
+                                              handed_out_at=timezone.now())
+        self.reserve(start, start + timedelta(days=1), 4)
+        availability.refresh_calendar([self.object_type.pk], start, start + timedelta(days=7))
+        context = {'request': APIRequestFactory().get('/api/rentals/')}
+        rentals = models.Rental.objects.with_extended_until().with_extension_count().filter(pk=rental.pk)
+        with CaptureQueriesContext(connection) as queries:
+            data = serializers.RentalSerializer(rentals, many=True, context=context).data
+        # extended_until and extended_count are read from the annotations, the availability from the calendar
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('SELECT "base_extension"')])
+        self.assertTrue([query for query in queries.captured_queries if 'FROM "base_availabilitycalendar"' in query['sql']])
+        self.assertEqual(data[0]['extendable'], serializers.RentalSerializer(rental, context=context).data['extendable'])
+        self.assertTrue(data[0]['extendable'])
+        self.assertEqual((data[0]['extended_until'], data[0]['extended_count']), (start, 0))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BulkHandoutTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        dynamic_settings.invalidate()
+        models.Settings.objects.create(type='returning_start_hour', value='8', public=True)
+        models.Settings.objects.create(type='returning_end_hour', value='12', public=True)
+
+    def test_handout_updates_availability_and_reminders(self):
+        start = timezone.localdate() + timedelta(days=7)
+        reservation = self.reserve(start, start + timedelta(days=7), 2)
+        rentals = [models.Rental.objects.create(rented_object=rented_object, rental_number=1, reservation=reservation)
+                   for rented_object in self.objects[:2]]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="lender", is_staff=True))
+        with mock.patch('base.signals.availability.invalidate_cache') as invalidate_cache:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/rentals/bulkhandout/', {'reservations': [reservation.pk]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(models.Rental.objects.filter(pk__in=[rental.pk for rental in rentals]).values_list('handed_out_at', flat=True)))
+        invalidate_cache.assert_called_with({self.object_type.pk})
+        self.assertEqual(set(models.ScheduledReminder.objects.values_list('rental_id', flat=True)), {rental.pk for rental in rentals})
+
+
+class AvailableObjectsTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.object_type.visible = True
+        self.object_type.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.profile.user)
+
+    def test_types_filter(self):
+        response = self.client.get('/api/rentalobjecttypes/available/', {'from_date': '2023-01-05', 'until_date': '2023-01-12', 'types': f'{self.object_type.pk},'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data), [self.object_type.pk])
+        response = self.client.get('/api/rentalobjecttypes/available/', {'from_date': '2023-01-05', 'until_date': '2023-01-12', 'types': 'K,1'})
+        self.assertEqual(response.status_code, 400)
+
+
+class QueryBudgetTestCase(AvailabilityFixture, TestCase):
+    """
+    listing rows must take the same number of queries no matter how many rows there are
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="lender", is_staff=True))
+        self.object_type.tags.create(name="Foto")
+        self.profile.user.groups.add(Group.objects.create(name="Studierende"))
+        self.rentals = 0
+
+    def rent(self):
+        # every rental ends on another day, so each has its own extension window
+        reservation = self.reserve(date(2023, 1, 5), date(2023, 1, 12) + timedelta(days=self.rentals), 1)
+        self.rentals += 1
+        models.Rental.objects.create(rented_object=self.objects[self.rentals], rental_number=self.rentals, reservation=reservation,
+                                     handed_out_at=datetime(2023, 1, 5, 12, tzinfo=timezone.get_current_timezone()))
+
+    def count_queries(self, url, rows):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), rows)
+        return len(queries)
+
+    def test_lists_have_a_fixed_query_budget(self):
+        self.rent()
+        one_row = {url: self.count_queries(url, 1) for url in ['/api/reservations/', '/api/rentals/']}
+        rentals_one_row = {}
+        for backend in ['postgres', 'calendar']:
+            with override_settings(AVAILABILITY_BACKEND=backend):
+                rentals_one_row[backend] = self.count_queries('/api/rentals/', 1)
+        one_row['/api/rentalobjects/?type=' + str(self.object_type.pk)] = self.count_queries('/api/rentalobjects/?type=' + str(self.object_type.pk), 7)
+        for _ in range(3):
+            self.rent()
+        self.assertEqual(self.count_queries('/api/reservations/', 4), one_row['/api/reservations/'])
+        self.assertEqual(self.count_queries('/api/rentals/', 4), one_row['/api/rentals/'])
+        for backend, queries in rentals_one_row.items():
+            with override_settings(AVAILABILITY_BACKEND=backend):
+                self.assertEqual(self.count_queries('/api/rentals/', 4), queries, backend)
+        models.RentalObject.objects.create(type=self.object_type, internal_identifier=7)
+        self.assertEqual(self.count_queries('/api/rentalobjects/?type=' + str(self.object_type.pk), 8),
+                         one_row['/api/rentalobjects/?type=' + str(self.object_type.pk)])
+
+
+class KeysetPaginationTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="lender", is_staff=True))
+        # many reservations share a date since all start on the lenting day
+        self.reservations = [self.reserve(date(2023, 1, 5 + 7 * (i % 2)), date(2023, 1, 19), 1) for i in range(5)]
+
+    def test_unpaginated_without_param(self):
+        response = self.client.get('/api/reservations/')
+        self.assertEqual(len(response.data), 5)
+
+    def test_walk_forward_and_back(self):
+        expected = [r.pk for r in sorted(self.reservations, key=lambda r: (r.reserved_from, r.pk))]
+        response = self.client.get('/api/reservations/?page_size=2')
+        pages = [[r['id'] for r in response.data['results']]]
+        self.assertIsNone(response.data['previous'])
+        while response.data['next'] is not None:
+            response = self.client.get(response.data['next'])
+            pages.append([r['id'] for r in response.data['results']])
+        self.assertEqual(pages, [expected[0:2], expected[2:4], expected[4:]])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([r['id'] for r in response.data['results']], expected[2:4])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([r['id'] for r in response.data['results']], expected[0:2])
+        self.assertIsNone(response.data['previous'])
+
+    def test_unique_and_invalid_cursor(self):
+        response = self.client.get('/api/reservations/?unique=true&page_size=10')
+        self.assertEqual([r['id'] for r in response.data['results']], [self.reservations[0].pk])
+        self.assertEqual(self.client.get('/api/reservations/?cursor=abc').status_code, 404)
+        for position in [["x", self.reservations[0].pk], ["2023-01-05", "x"], [None, 1], [{}, 1]]:
+            cursor = base64.urlsafe_b64encode(json.dumps({'p': position, 'r': False}).encode()).decode()
+            self.assertEqual(self.client.get(f'/api/reservations/?cursor={cursor}').status_code, 404, position)
+
+    def test_descending_datetime_ordering(self):
+        self.client.force_authenticate(User.objects.create_superuser(username="admin"))
+        response = self.client.get('/api/users/?page_size=1')
+        users = [r['id'] for r in response.data['results']]
+        while response.data['next'] is not None:
+            response = self.client.get(response.data['next'])
+            users += [r['id'] for r in response.data['results']]
+        self.assertEqual(users, list(User.objects.order_by('-date_joined', '-id').values_list('id', flat=True)))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RentalFormExportTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        shutil.copy(f"{settings.MEDIA_ROOT}/docxtemplate.docx", media_root)
+        private_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, private_root)
+        media = override_settings(MEDIA_ROOT=media_root, PRIVATE_MEDIA_ROOT=private_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        models.Files.objects.create(name='rental_form')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username="lender"))
+
+    def test_export_of_a_lending_day(self):
+        first = self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        models.Rental.objects.create(rented_object=self.objects[3], rental_number=1, reservation=first)
+        second = self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1)
+        second.operation_number = 2
+        second.save()
+        self.reserve(date(2023, 1, 12), date(2023, 1, 19), 1)
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1, canceled=timezone.now())
+        with mock.patch('api.views.tasks.export_rental_forms.delay', side_effect=rental_form.export) as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/rentalformexports/', {'lending_date': '2023-01-05'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        delay.assert_called_once_with(response.data['id'])
+        export = self.client.get(f"/api/rentalformexports/{response.data['id']}/").data
+        self.assertEqual((export['status'], export['total'], export['rendered']), ('done', 2, 2))
+        download = self.client.get(export['download'])
+        self.assertEqual(download.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(b''.join(download.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['1__.docx', '2__.docx'])
+        context = rental_form.reservation_context([rental_form.export_reservations(models.RentalFormExport(operation_numbers=[1])).get(pk=first.pk)])
+        self.assertEqual(context['rented_items'][0]['identifier'], 'K3')
+
+    def test_not_served_as_media(self):
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1)
+        with mock.patch('api.views.tasks.export_rental_forms.delay', side_effect=rental_form.export):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/rentalformexports/', {'lending_date': '2023-01-05'}, format='json')
+        export = models.RentalFormExport.objects.get(pk=response.data['id'])
+        self.assertTrue(export.file.path.startswith(settings.PRIVATE_MEDIA_ROOT))
+        self.assertEqual(self.client.get(f"/media/{export.file.name}").status_code, 404)
+        # exports stored in MEDIA_ROOT before the private storage are not served either
+        os.makedirs(f"{settings.MEDIA_ROOT}/rental_form_exports")
+        shutil.copy(export.file.path, f"{settings.MEDIA_ROOT}/{export.file.name}")
+        self.assertEqual(self.client.get(f"/media/{export.file.name}").status_code, 404)
+        self.assertEqual(self.client.get(f"/media/./rental_form_exports/../{export.file.name}").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/rentalformexports/{export.pk}/download/").status_code, 200)
+
+    def test_unreachable_broker(self):
+        with mock.patch('api.views.tasks.export_rental_forms.delay', side_effect=OSError("connection refused")):
+            with self.assertLogs('django', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/rentalformexports/', {'lending_date': '2023-01-05'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(models.RentalFormExport.objects.get(pk=response.data['id']).status, models.RentalFormExport.FAILED)
+
+    def test_requires_a_selection(self):
+        self.assertEqual(self.client.post('/api/rentalformexports/', {}, format='json').status_code, 400)
+        export = models.RentalFormExport.objects.create(created_by=User.objects.get(username="lender"), operation_numbers=[1])
+        self.assertEqual(self.client.get(f"/api/rentalformexports/{export.pk}/download/").status_code, 409)
+
+
+class DownloadTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with open(f"{media_root}/form.docx", 'wb') as file:
+            file.write(b'0123456789')
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def get(self, **headers):
+        response = self.client.get('/media/form.docx', headers=headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_conditional_and_range_requests(self):
+        response, content = self.get()
+        self.assertEqual((response.status_code, content, response['Content-Length']), (200, b'0123456789', '10'))
+        self.assertEqual(self.get(If_None_Match=response['ETag'])[0].status_code, 304)
+        self.assertEqual(self.get(If_Modified_Since=response['Last-Modified'])[0].status_code, 304)
+        response, content = self.get(Range='bytes=2-4')
+        self.assertEqual((response.status_code, content, response['Content-Range']), (206, b'234', 'bytes 2-4/10'))
+        self.assertEqual(self.get(Range='bytes=-3')[1], b'789')
+        self.assertEqual(self.get(Range='bytes=8-')[1], b'89')
+        self.assertEqual(self.get(Range='bytes=10-')[0].status_code, 416)
+        # the client has a part of another version
+        self.assertEqual(self.get(Range='bytes=2-4', If_Range='"0-0"')[1], b'0123456789')
+
+    def test_web_server_modes(self):
+        with override_settings(FILE_DOWNLOAD_MODE='x-accel-redirect'):
+            response, content = self.get()
+            self.assertEqual((response['X-Accel-Redirect'], content), ('/protected-media/form.docx', b''))
+        with override_settings(FILE_DOWNLOAD_MODE='x-sendfile'):
+            self.assertEqual(self.get()[0]['X-Sendfile'], f"{settings.MEDIA_ROOT}/form.docx")
+        self.assertEqual(self.client.get('/media/../requirements.txt').status_code, 404)
+
+
+class EmailValidationTestCase(TestCase):
+    def setUp(self):
+        dynamic_settings.invalidate()
+        # the default of Profile.prio is the pk the priority had when the models were loaded
+        models.Priority.objects.create(pk=models.Profile._meta.get_field('prio').default, prio=99, name="unverified")
+        models.Settings.objects.create(type='email_validation_regex', value=settings.EMAIL_VALIDATION_REGEX, public=True)
+        models.Text.objects.create(name='signup_mail', content='{{validation_link}}')
+
+    def tearDown(self):
+        dynamic_settings.invalidate()
+
+    def test_signup_link_activates_the_account_once(self):
+        client = APIClient()
+        with self.captureOnCommitCallbacks():
+            response = client.post('/api/users/', {'username': 'renter', 'password': 'Geheim123!', 'email': 'renter@rwth-aachen.de',
+                                                   'first_name': 'R', 'last_name': 'S', 'profile': {}}, format='json')
+        self.assertEqual(response.status_code, 201)
+        user = User.objects.get(username='renter')
+        self.assertFalse(user.is_active)
+        token = models.OutgoingMail.objects.get().message.rsplit('/', 1)[1]
+        self.assertEqual(user.email_validation_token.token_hash, models.EmailValidationToken.hash_token(token))
+        self.assertEqual(client.post('/api/users/email_validation/', {'hash': 'wrong'}).status_code, 400)
+        with self.assertNumQueries(3):
+            self.assertEqual(client.post('/api/users/email_validation/', {'hash': token}).status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.is_active)
+        self.assertEqual(client.post('/api/users/email_validation/', {'hash': token}).status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedTokenAuthenticationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="lender")
+        models.Profile.objects.create(user=self.user, prio=models.Priority.objects.create(prio=99, name="unverified"))
+        self.auth_token, token = AuthToken.objects.create(self.user)
+        self.token = token.encode()
+        self.authentication = CachedTokenAuthentication()
+
+    def authenticate(self, queries):
+        with self.assertNumQueries(queries):
+            user, _ = self.authentication.authenticate_credentials(self.token)
+        return user
+
+    def test_cached_until_the_user_changes(self):
+        self.assertEqual(self.authenticate(3), self.user)
+        user = self.authenticate(0)
+        with self.assertNumQueries(0):
+            self.assertFalse(user.has_perm('base.lending_access'))
+        self.user.user_permissions.add(Permission.objects.get(codename='lending_access'))
+        self.authenticate(3)
+        user = self.authenticate(0)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('base.lending_access'))
+        with self.assertNumQueries(0):
+            self.assertEqual(user.profile.prio.prio, 99)
+        group = Group.objects.create(name="Ausleihe")
+        group.permissions.add(Permission.objects.get(codename='inventory_editing'))
+        self.user.groups.add(group)
+        self.assertTrue(self.authenticate(3).has_perm('base.inventory_editing'))
+        models.Priority.objects.filter(prio=99).update(name="unverifiziert")
+        models.Priority.objects.get(prio=99).save()
+        self.assertEqual(self.authenticate(3).profile.prio.name, "unverifiziert")
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(3)
+
+    def test_logout_and_coalesced_refresh(self):
+        # created less than MIN_REFRESH_INTERVAL ago, nothing is written
+        self.authenticate(3)
+        AuthToken.objects.filter(pk=self.auth_token.pk).update(expiry=timezone.now() + timezone.timedelta(hours=1))
+        cache.clear()
+        self.authenticate(4)
+        expiry = AuthToken.objects.get(pk=self.auth_token.pk).expiry
+        self.assertGreater(expiry, timezone.now() + settings.REST_KNOX['TOKEN_TTL'] - settings.REST_KNOX['MIN_REFRESH_INTERVAL'] * timezone.timedelta(seconds=1))
+        self.authenticate(0)
+        self.auth_token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(1)
+
+
+class StubOAuthProvider(BaseHTTPRequestHandler):
+    """
+    the endpoints of the oauth provider base.oauth talks to. the user finishes the process after server.pending polls
+    """
+
+    def answer(self, data):
+        self.server.calls.append(self.path)
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/code':
+            self.answer({'device_code': 'device', 'user_code': 'ABCD', 'interval': 5, 'expires_in': 600})
+        elif self.server.pending > 0:
+            self.server.pending -= 1
+            self.answer({'error': 'authorization_pending', 'access_token': None})
+        else:
+            self.answer({'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 3600})
+
+    def do_GET(self):
+        if self.server.data_errors > 0:
+            self.server.data_errors -= 1
+            self.answer({'IsError': True})
+        else:
+            self.answer({'IsError': False, 'Data': {'faculty': '6'}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OAuthVerificationTestCase(TestCase):
+    def setUp(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubOAuthProvider)
+        server.calls, server.pending, server.data_errors = [], 1, 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        url = f"http://127.0.0.1:{server.server_port}"
+        provider = override_settings(OAUTH_CLIENTS={'oauth': {
+            'client_id': 'rent', 'scope': 'user', 'OAUTH_AUTHORIZATION_CODE_URL': url + '/code', 'OAUTH_ACCESS_TOKEN_URL': url + '/token',
+            'OAUTH_VERIFICATION_URL': 'https://verify/?code=', 'OAUTH_VERIFICATIONDATA_ENDPOINT': url + '/data/',
+            'OAUTH_DATA_KEY': 'faculty', 'OAUTH_DATA_VALUE': '6'}})
+        provider.enable()
+        self.addCleanup(provider.disable)
+        models.Priority.objects.create(prio=50, name="automatically verified")
+        self.user = User.objects.create_user(username="renter")
+        models.Profile.objects.create(user=self.user, prio=models.Priority.objects.create(prio=99, name="unverified"))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def state(self):
+        calls = len(self.server.calls)
+        response = self.client.post('/api/users/oauth/token/')
+        # the endpoint never calls the provider itself
+        self.assertEqual(len(self.server.calls), calls)
+        return response.data
+
+    def test_polling_in_the_background(self):
+        with mock.patch('base.tasks.poll_oauth_verification.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/users/oauth/verify/')
+            self.assertEqual(response.data, {'url': 'https://verify/?code=ABCD', 'max_refresh_interval': 5})
+            process = models.OauthVerificationProcess.objects.get(user=self.user)
+            apply_async.assert_called_once_with((process.pk,), countdown=5)
+            self.assertEqual(self.state(), {'verified': False})
+            tasks.poll_oauth_verification(process.pk)
+            self.assertEqual(apply_async.call_count, 2)
+            self.assertEqual(self.state(), {'verified': False})
+            tasks.poll_oauth_verification(process.pk)
+            self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(self.server.calls, ['/code', '/token', '/token', '/data/access'])
+        self.assertEqual(self.state(), {'verified': True})
+        self.assertEqual(models.Profile.objects.get(user=self.user).prio.prio, 50)
+
+    def test_provider_is_called_outside_of_transactions(self):
+        depth = len(connection.atomic_blocks)
+        post = oauth.session().post
+
+        def checked_post(*args, **kwargs):
+            self.assertEqual(len(connection.atomic_blocks), depth)
+            return post(*args, **kwargs)
+        with mock.patch.object(oauth.session(), 'post', side_effect=checked_post) as patched, \
+                mock.patch('base.tasks.poll_oauth_verification.apply_async'):
+            self.assertEqual(self.client.post('/api/users/oauth/verify/').status_code, 200)
+        patched.assert_called_once()
+
+    def test_stalled_polling_is_resumed_once(self):
+        with mock.patch('base.tasks.poll_oauth_verification.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/users/oauth/verify/')
+            process = models.OauthVerificationProcess.objects.get(user=self.user)
+            # the lease of the scheduled poll is live
+            self.assertFalse(oauth.polling_stalled(process))
+            process.polling_until = timezone.now() - timedelta(seconds=1)
+            process.save(update_fields=['polling_until'])
+            with self.captureOnCommitCallbacks(execute=True):
+                self.state()
+                self.state()
+            self.assertEqual(apply_async.call_args_list, [mock.call((process.pk,), countdown=5), mock.call((process.pk,), countdown=0)])
+        self.assertGreater(models.OauthVerificationProcess.objects.get(pk=process.pk).polling_until, timezone.now())
+
+    def test_error_of_the_provider_is_retried(self):
+        self.server.pending, self.server.data_errors = 0, 1
+        with mock.patch('base.tasks.poll_oauth_verification.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/users/oauth/verify/')
+            process = models.OauthVerificationProcess.objects.get(user=self.user)
+            tasks.poll_oauth_verification(process.pk)
+            self.assertEqual(apply_async.call_count, 2)
+            self.assertIn("error", self.state())
+            tasks.poll_oauth_verification(process.pk)
+            self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(self.server.calls, ['/code', '/token', '/data/access', '/data/access'])
+        self.assertEqual(self.state(), {'verified': True})
+
+    def test_unreachable_provider(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.client.post('/api/users/oauth/verify/').status_code, 503)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PerformanceMiddlewareTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="lender", is_staff=True))
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1)
+
+    @override_settings(SERVER_TIMING_HEADER=True)
+    def test_timings_and_log_line(self):
+        cache.set('warm', 1)
+        with self.assertLogs('performance', 'INFO') as logs, CaptureQueriesContext(connection) as queries:
+            with mock.patch('api.views.ReservationViewSet.get_queryset', side_effect=lambda: cache.get('warm') and cache.get('cold') or models.Reservation.objects.all()):
+                response = self.client.get('/api/reservations/')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual((record['view'], record['action'], record['status']), ('ReservationViewSet', 'list', 200))
+        self.assertEqual(record['queries'], len(queries))
+        self.assertEqual((record['cache_hits'], record['cache_misses']), (1, 1))
+        self.assertIn(f'desc="{len(queries)} queries, {record["duplicate_queries"]} duplicates"', response['Server-Timing'])
+        self.assertNotIn('sql', record)
+
+    def test_slow_request_with_sql(self):
+        with override_settings(SLOW_REQUEST_THRESHOLD=0, SERVER_TIMING_HEADER=False):
+            with self.assertLogs('performance', 'WARNING') as logs:
+                response = self.client.get('/api/reservations/')
+        self.assertFalse(response.has_header('Server-Timing'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(len(record['sql']), record['queries'])
+        self.assertTrue(any('base_reservation' in query['sql'] for query in record['sql']))
+
+
+class MetricsTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="lender", is_staff=True))
+
+    def sample(self, name, **labels):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_api_actions_and_tasks(self):
+        from celery import signals as celery_signals
+        requests_before = self.sample('api_requests_total', action='reservations.list', method='GET', status='2xx')
+        queries_before = self.sample('api_request_queries_count', action='reservations.list', method='GET')
+        tasks_before = self.sample('celery_tasks_total', task='base.tasks.cleanup_accounts', outcome='success')
+        self.assertEqual(self.client.get('/api/reservations/').status_code, 200)
+        celery_signals.task_prerun.send(sender=tasks.cleanup_accounts, task_id='1', task=tasks.cleanup_accounts)
+        celery_signals.task_postrun.send(sender=tasks.cleanup_accounts, task_id='1', task=tasks.cleanup_accounts, state='SUCCESS')
+        self.assertEqual(self.sample('api_requests_total', action='reservations.list', method='GET', status='2xx'), requests_before + 1)
+        self.assertEqual(self.sample('api_request_queries_count', action='reservations.list', method='GET'), queries_before + 1)
+        self.assertEqual(self.sample('celery_tasks_total', task='base.tasks.cleanup_accounts', outcome='success'), tasks_before + 1)
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertIn(b'api_request_duration_seconds_bucket{action="reservations.list"', response.content)
+        self.assertIn(b'celery_task_duration_seconds_count{task="base.tasks.cleanup_accounts"}', response.content)
+
+    def test_token(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secrets').status_code, 403)
+        # without a token the metrics are only public while debugging
+        with override_settings(METRICS_TOKEN='', DEBUG=False):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN='', DEBUG=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
@@ -15,6 +15,7 @@ router.register(r'tags', views.TagViewSet)
 router.register(r'texts', views.TextViewSet)
 router.register(r'settings', views.SettingsViewSet)
 router.register(r'rentals', views.RentalViewSet)
+router.register(r'rentalformexports', views.RentalFormExportViewSet)
 router.register(r'duration', views.MaxRentDurationViewSet)
 router.register(r'priority', views.PriorityViewSet)
 router.register(r'files', views.FilesViewSet)
@@ -1,25 +1,25 @@
 import hashlib
+import hmac
 from django.utils.crypto import get_random_string
 from datetime import datetime, timedelta
 from django.contrib.auth import login
 from django.contrib.auth.models import User, Group, Permission
 from django.conf import settings
-from django.core.mail import send_mail
-from django.template import Context, Template
+from django.template import Context
 from django.template.loader import render_to_string
 from django.forms.models import model_to_dict
 from django.core.exceptions import FieldError
-from django.db.models import Max, Q, F
+from django.db.models import Max, Q, F, Prefetch
 from django.db import transaction
 from django.utils import timezone
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.db import IntegrityError
 import os
 
 from rest_framework import status
 from rest_framework.request import Request
-from rest_framework import viewsets, renderers
+from rest_framework import viewsets, renderers, mixins
 from rest_framework import permissions
 from rest_framework.authtoken.serializers import AuthTokenSerializer
 from rest_framework.response import Response
@@ -29,18 +29,27 @@ from rest_framework.views import exception_handler
 
 
 from knox.views import LoginView as KnoxLoginView
-from knox.auth import TokenAuthentication
 
 from .serializers import CategorySerializer, UserSerializer, RentalObjectSerializer, UserCreationSerializer, GroupSerializer, KnowLoginUserSerializer, RentalObjectTypeSerializer, ReservationSerializer, RentalSerializer, TagSerializer, TextSerializer
 from .permissions import UserPermission, GroupPermission
 from api import permissions as customPermissions
 from api import serializers
+from api import downloads
+from api.authentication import CachedTokenAuthentication
+from api.pagination import KeysetPagination
 
 from base.models import RentalObject, RentalObjectType, Category, Reservation, Rental, Profile, Tag, Text
 from base import models
+from base import availability
+from base import dynamic_settings
+from base import mail
+from base import mail_templates
+from base import metrics
+from base import oauth
+from base import rental_form
+from base import signals as base_signals
+from base import tasks
 
-from docxtpl import DocxTemplate
-import io
 
 import requests
 
@@ -51,6 +60,25 @@ import re
 
 logger = logging.getLogger(name="django")
 
+
+def serialized_reservations(queryset=None):
+    """
+    reservations with everything ReservationSerializer and ReservationAdminSerializer touch fetched upfront,
+    so listing them takes the same number of queries for any number of rows
+    """
+    queryset = models.Reservation.objects.all() if queryset is None else queryset
+    return queryset.with_fullfilled().select_related('objecttype', 'reserver__user', 'reserver__prio').prefetch_related(
+        'objecttype__tags', 'reserver__user__groups')
+
+
+def serialized_rental_objects(queryset=None):
+    """
+    rental objects with everything RentalObjectSerializer touches fetched upfront
+    """
+    queryset = models.RentalObject.objects.all() if queryset is None else queryset
+    return queryset.with_in_house().select_related('type')
+
+
 def integrity_error_exception_handler(exc, context):
     """
     custom errorhandler. Translates e.g. internal model errors to correct statuscodes and errormessages.
@@ -86,8 +114,22 @@ class LoginView(KnoxLoginView):
         return KnowLoginUserSerializer
 
 
+def metrics_view(request):
+    """
+    prometheus metrics of all processes, see base.metrics. only for scrapers sending METRICS_TOKEN, without a token
+    they are only public with DEBUG
+    """
+    if settings.METRICS_TOKEN:
+        allowed = hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {settings.METRICS_TOKEN}".encode())
+    else:
+        allowed = settings.DEBUG
+    if not allowed:
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([permissions.IsAuthenticated])
 def checkCredentials(request: Request):
     """
@@ -104,8 +146,12 @@ class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all().order_by('-date_joined')
     serializer_class = UserSerializer
     permission_classes = [UserPermission]
+    pagination_class = KeysetPagination
+    # user_cursor index of base migration 0094
+    cursor_ordering = ('-date_joined', '-id')
 
     @action(detail=False, methods=['post'], permission_classes=[permissions.AllowAny])
+    @transaction.atomic
     def passwordreset(self, request:Request):
         if 'username' in request.data and 'email' in request.data:
             usermodel = models.User.objects.filter(username=request.data['username'], email=request.data['email'])
@@ -117,8 +163,8 @@ class UserViewSet(viewsets.ModelViewSet):
                 models.PasswordReset.objects.create(user=usermodel, hash=hash)
                 link=settings.FRONTEND_HOST + 'account/passwordreset?hash='+ hash
                 email_text = render_to_string('passwordreset.html',{'link':link})
-                send_mail(subject="Passwordreset", message=email_text, html_message=email_text,
-                        from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[request.data['email']])
+                mail.queue_mail(subject="Passwordreset", message=email_text, html_message=email_text,
+                                from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[request.data['email']])
             else:
                 logger.info(f"Es wurden {usermodel.count()} Accounts zu den Daten Email: {request.data['username']} und Nutzername: {request.data['email']} gefunden. Daher kann kein Reset Link gesendet werden")
         return Response(data={'abs':'abs'})
@@ -165,96 +211,52 @@ class UserViewSet(viewsets.ModelViewSet):
     def verify_with_oauth(self, request: Request):
         """
         if no verification process has been startet yet, fetch user and device code from the endpoint and return the verification url for the user.
-        please call /api/users/oauth/token to check if the user already finished the process
+        a celery task asks the endpoint if the user finished the process, please call /api/users/oauth/token to check the state
         """
         process = models.OauthVerificationProcess.objects.filter(
-            user=request.user)
-        if len(process) > 0:
-            if process.first().access_token == None:
-                return Response({"url": settings.OAUTH_CLIENTS['oauth']['OAUTH_VERIFICATION_URL'] + process.first().user_code, "max_refresh_interval": process.first().ping_interval.seconds})
+            user=request.user).first()
+        if process is not None:
+            if process.access_token == None:
+                return Response({"url": settings.OAUTH_CLIENTS['oauth']['OAUTH_VERIFICATION_URL'] + process.user_code, "max_refresh_interval": process.ping_interval.seconds})
             else:
                 # delete process expired restart process by deleting it
-                if process.first().access_token != None and process.first().verification_process_expires < timezone.now():
-                    process.first().delete()
+                if process.verification_process_expires < timezone.now():
+                    process.delete()
                 else:
                     return Response({"url": "", "max_refresh_interval": 0})
-        rsp = requests.post(settings.OAUTH_CLIENTS['oauth']['OAUTH_AUTHORIZATION_CODE_URL'], data={
-                            "client_id": settings.OAUTH_CLIENTS['oauth']['client_id'], 'scope': settings.OAUTH_CLIENTS['oauth']['scope']})
-
-        rsp = rsp.json()
-        device_code = rsp['device_code']
-        user_code = rsp['user_code']
-        url = settings.OAUTH_CLIENTS['oauth']['OAUTH_VERIFICATION_URL'] + user_code
-        verifaction_process = models.OauthVerificationProcess.objects.create(
-            device_code=device_code,
-            user_code=user_code,
-            ping_interval=timedelta(seconds=rsp['interval']),
-            verification_process_expires=timezone.now(
-            ) + timedelta(seconds=rsp['expires_in']),
-            user=request.user)
-        verifaction_process.save()
-
-        # logger.info(state)
-        return Response({"url": url, "max_refresh_interval": rsp['interval']})
+        try:
+            process = oauth.start(request.user)
+        except (requests.RequestException, ValueError, KeyError):
+            logger.exception("requesting a device code failed")
+            return Response("the verification service is not reachable, please try again later", status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        url = settings.OAUTH_CLIENTS['oauth']['OAUTH_VERIFICATION_URL'] + process.user_code
+        return Response({"url": url, "max_refresh_interval": process.ping_interval.seconds})
 
     @action(detail=False, methods=['post'], url_path="oauth/token", permission_classes=[permissions.IsAuthenticated])
     def get_access_token(self, request: Request):
         """
-        this function calls the OAUTH-Endpoint and fetches the accesstoken if none is already present, if one is present the api is called and the status is verfied and written  to the profile and the priority is set to a verified state
+        the state of the verification process. the access token is fetched and the profile verified by the celery task base.tasks.poll_oauth_verification,
+        this only reads the result from the database
         """
         # first we check if there is a process for this account
         process = models.OauthVerificationProcess.objects.filter(
-            user=request.user)
-        if len(process) == 0:
+            user=request.user).first()
+        if process is None:
             return Response("Expired. Please start the verification process by calling /oauth/verify", status=status.HTTP_400_BAD_REQUEST)
-        process = process.first()
         if process.access_token == None and process.verification_process_expires < timezone.now():
             # check if the verification process is expired and delete it if it is
             process.delete()
             return Response("verificationsprocess expired, please restart the process", status=status.HTTP_400_BAD_REQUEST)
-
-        if (process.last_ping != None and process.last_ping+process.ping_interval > timezone.now()):
-            # we prevent the external API from being called to often, therefore we limit it ourselves
-            return Response({'status': "error", "description": "Please slow down, we are not allowed to ping the auth server that often"}, status=status.HTTP_400_BAD_REQUEST)
-        data = {"verified": False}
-        if process.access_token == None:
-            # if the current process contains a access_token the verification process is done if not we have to call the api and ask if the user endet his/her verification
-            process.last_ping = timezone.now()
-            process.save()
-            accesstokenrsp = requests.post(settings.OAUTH_CLIENTS['oauth']['OAUTH_ACCESS_TOKEN_URL'], data={
-                "client_id": settings.OAUTH_CLIENTS['oauth']['client_id'], "code": process.device_code, "grant_type": "device"})
-            data = accesstokenrsp.json()
-            if data['access_token'] != None:
-                process.access_token = data['access_token']
-                process.refresh_token = data['refresh_token']
-                process.access_token_exipiry = timezone.now(
-                ) + timedelta(seconds=data['expires_in'])
-                process.save()
-            process.refresh_from_db()
-        if process.access_token != None and not request.user.profile.verified:
-            # important part get data from api and update user profile and priorities accordingly.
-            userdata = requests.get(
-                settings.OAUTH_CLIENTS['oauth']['OAUTH_VERIFICATIONDATA_ENDPOINT']+process.access_token).json()
-            if userdata["IsError"]:
-                return Response("there was an error while calling the api. please write an message to us")
-            # TODO TESTING REPLACE with correct api endpoint and faculty
-            data_field = settings.OAUTH_CLIENTS['oauth']['OAUTH_DATA_KEY']
-            if "Data" in userdata and data_field in userdata["Data"] and userdata["Data"][data_field] == settings.OAUTH_CLIENTS['oauth']['OAUTH_DATA_VALUE']:
-                logger.debug("user: " + str(request.user.pk) +
-                             " has been automatically verified")
-                request.user.profile.verified = True
-                request.user.profile.prio = models.Priority.objects.get(
-                    prio=50, name__contains="automatically")
-                request.user.profile.save()
-            else:
-                request.user.profile.automatically_verifiable = False
-                request.user.profile.save()
-                data = {"automatically_verifiable": False}
-                logger.debug("user: " + str(request.user.pk) +
-                             " couldn't be automatically verified. \n" + str(userdata))
-        if request.user.profile.verified:
-            data = {"verified": True}
-        return Response(data)
+        if oauth.polling_stalled(process):
+            oauth.resume_polling(process)
+        profile = models.Profile.objects.get(user=request.user)
+        if profile.verified:
+            return Response({"verified": True})
+        if process.error:
+            return Response(process.error)
+        if process.access_token != None and not profile.automatically_verifiable:
+            return Response({"automatically_verifiable": False})
+        return Response({"verified": False})
 
     @action(detail=False, methods=['post'], permission_classes=[permissions.AllowAny])
     def email_validation(self, request: Request):
@@ -263,14 +265,13 @@ class UserViewSet(viewsets.ModelViewSet):
         """
         hash = request.POST['hash']
         # to be able to deactivate accounts last login is checked
-        for model in User.objects.all().filter(is_active=False, last_login__isnull=True):
-            model_hash = hashlib.sha256(
-                (str(model.date_joined) + model.username + settings.EMAIL_VALIDATION_HASH_SALT).encode("utf-8")).hexdigest()
-            if model_hash == hash:
-                model.is_active = True
-                model.save()
-                # User.objects.get(pk=model.id).update(is_active=True)
-                return Response(data={'success': True, 'detail': "Die Email wurde erfolgreich validiert und man kann sich mit dem verbundenen Account einloggen."})
+        token = models.EmailValidationToken.objects.select_related('user').filter(
+            token_hash=models.EmailValidationToken.hash_token(hash), user__is_active=False, user__last_login__isnull=True).first()
+        if token is not None:
+            token.user.is_active = True
+            token.user.save()
+            token.delete()
+            return Response(data={'success': True, 'detail': "Die Email wurde erfolgreich validiert und man kann sich mit dem verbundenen Account einloggen."})
         return Response(status=status.HTTP_400_BAD_REQUEST, data={'success': False, 'detail': "Der Link wurde entweder schon benutzt oder der Link ist falsch, bitte stelle sicher dass der Link richtig eingegeben wurde"})
         # {key:value for key, value in }
 
@@ -286,6 +287,7 @@ class UserViewSet(viewsets.ModelViewSet):
                 return serializers.AdminUserSerializer
             return UserSerializer
 
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
         """
         use default implementation, but remove password from returned data and send email to user.
@@ -303,15 +305,15 @@ class UserViewSet(viewsets.ModelViewSet):
             templateData = user
         templateData['frontend_host'] = settings.FRONTEND_HOST
         templateData['hash'] = hashlib.sha256(
-            (str(templateData["date_joined"]) + templateData["username"] + settings.EMAIL_VALIDATION_HASH_SALT).encode("utf-8")).hexdigest()
+            (str(timezone.now()) + get_random_string(length=256)).encode("utf-8")).hexdigest()
+        models.EmailValidationToken.objects.create(user=user, token_hash=models.EmailValidationToken.hash_token(templateData['hash']))
         templateData['validation_link'] = f"{templateData['frontend_host']}validate/{templateData['hash']}"
-        template = Template(models.Text.objects.filter(
-            name='signup_mail').first().content.replace(r"%}}</p>", r"%}}").replace(r"<p>{{%", r"{{%"))
+        template = mail_templates.get_template('signup_mail', unwrap_tags=True)
         message = template.render(Context(templateData))
 
         # TODO validate if mail has been send
-        send_mail(subject="Registrierung", message=message, html_message=message,
-                  from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[templateData['email']])
+        mail.queue_mail(subject="Registrierung", message=message, html_message=message,
+                        from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[templateData['email']])
         return Response(data, status=status.HTTP_201_CREATED, headers=headers)
 
 
@@ -328,7 +330,7 @@ class RentalobjectViewSet(viewsets.ModelViewSet):
     permission_classes = [customPermissions.RentalObjectPermission]
 
     def get_queryset(self):
-        queryset = RentalObject.objects.all()
+        queryset = serialized_rental_objects()
         getdict = self.request.GET
         if 'type' in getdict:
             queryset = queryset.filter(type=getdict['type'])
@@ -400,13 +402,10 @@ class RentalobjectTypeViewSet(viewsets.ModelViewSet):
                 result.append(data)
         return Response(result)
 
-    @action(detail=True, url_path="available", methods=['GET'], permission_classes=[permissions.IsAuthenticated])
-    def available_object(self, request: Request, pk=None):
+    def get_date_range(self, request: Request):
         """
-        takes two arguments a start date and an end date end calculates if that object is available around that time
+        parses the from_date and until_date query params of the availability endpoints
         """
-        if not models.RentalObjectType.objects.all().filter(id=pk).exists():
-            raise models.RentalObjectType.DoesNotExist
         if not 'from_date' in request.query_params:
             raise FieldError("from_date query param is missing")
         if not 'until_date' in request.query_params:
@@ -416,6 +415,16 @@ class RentalobjectTypeViewSet(viewsets.ModelViewSet):
             request.query_params['from_date'], "%Y-%m-%d").replace(tzinfo=timezone.get_current_timezone())
         until_date = datetime.strptime(
             request.query_params['until_date'], "%Y-%m-%d").replace(tzinfo=timezone.get_current_timezone())
+        return from_date, until_date
+
+    @action(detail=True, url_path="available", methods=['GET'], permission_classes=[permissions.IsAuthenticated])
+    def available_object(self, request: Request, pk=None):
+        """
+        takes two arguments a start date and an end date end calculates if that object is available around that time
+        """
+        if not models.RentalObjectType.objects.all().filter(id=pk).exists():
+            raise models.RentalObjectType.DoesNotExist
+        from_date, until_date = self.get_date_range(request)
         ret = models.RentalObjectType.available(
             pk=pk, until_date=until_date, from_date=from_date)
         return Response(data=ret)
@@ -423,16 +432,20 @@ class RentalobjectTypeViewSet(viewsets.ModelViewSet):
     @action(detail=False, url_path="available", methods=['GET'], permission_classes=[permissions.IsAuthenticated])
     def available_objects(self, request: Request):
         """
-        this function does the same as available_object only for querysets returns all objects available around that time
+        this function does the same as available_object only for querysets returns all objects available around that time.
+        the optional types query param limits the result to a comma separated list of type ids
         """
-        # TODO allow the supply of a specific set of types
+        from_date, until_date = self.get_date_range(request)
         queryset = self.get_queryset().filter(visible=True)
-        data = {}
-        for object_type in queryset:
-            data[object_type.id] = self.available_object(
-                request=request, pk=object_type.id).data
+        if 'types' in request.query_params:
+            types = [pk for pk in request.query_params['types'].split(',') if pk]
+            if not all(pk.isdigit() for pk in types):
+                return Response({'detail': "types has to be a comma separated list of type ids"}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(pk__in=types)
+        pks = list(queryset.values_list('id', flat=True))
+        data = availability.available_many(pks, from_date, until_date)
 
-        return Response(data)
+        return Response({pk: data[pk] for pk in pks})
 
     def get_queryset(self):
         queryset = RentalObjectType.objects.all().order_by('category', 'name')
@@ -458,12 +471,14 @@ class ReservationViewSet(viewsets.ModelViewSet):
     serializer_class = ReservationSerializer
     # TODO assign rights
     permission_classes = [customPermissions.ReservationPermission]
+    pagination_class = KeysetPagination
+    cursor_ordering = ('reserved_from', 'id')
 
     def get_serializer_class(self):
         return serializers.ReservationAdminSerializer if self.request.user.is_staff else serializers.ReservationSerializer
 
     def get_queryset(self):
-        queryset = Reservation.objects.all()
+        queryset = serialized_reservations()
         getdict = self.request.GET
         if 'reserved_from' in getdict:
             # we fetch all starting after that
@@ -476,9 +491,6 @@ class ReservationViewSet(viewsets.ModelViewSet):
             if getdict['open'] in ['true', 'True']:
                 # remove all reservations that already got a corresponding rental
                 queryset = queryset.exclude(rental__handed_out_at__isnull=False)
-        if 'unique' in getdict:
-            if getdict['unique'] in ['true', 'True']:
-                queryset = queryset.distinct('operation_number')
         if 'operation_number' in getdict:
             queryset = queryset.filter(
                 operation_number=getdict['operation_number'])
@@ -488,6 +500,10 @@ class ReservationViewSet(viewsets.ModelViewSet):
         if 'canceled' in getdict:
             if getdict['canceled'] in ['false', 'False']:
                 queryset = queryset.filter(canceled__isnull=True)
+        if 'unique' in getdict:
+            if getdict['unique'] in ['true', 'True']:
+                # one reservation per operation number. done in a subquery so the result can still be ordered freely
+                queryset = queryset.filter(pk__in=queryset.order_by('operation_number', 'pk').distinct('operation_number').values('pk'))
         return queryset
     
     @action(detail=True, url_path="selectedobjects", methods=['GET'])
@@ -500,6 +516,7 @@ class ReservationViewSet(viewsets.ModelViewSet):
         return Response(result)
 
     @action(detail=True, methods=['POST'], url_path="cancel", permission_classes=[permissions.IsAuthenticated])
+    @transaction.atomic
     def cancel_reservation(self, request: Request, pk=None):
         reservation = Reservation.objects.get(pk=pk)
         if request.user != reservation.reserver.user and not request.user.is_staff:
@@ -511,15 +528,15 @@ class ReservationViewSet(viewsets.ModelViewSet):
         reservation.rental_set.all().delete()
         serializer = ReservationSerializer(reservation)
         template_data = serializer.data
-        template = Template(models.Text.objects.filter(
-            name='reservation_cancel_mail').first().content)
+        template = mail_templates.get_template('reservation_cancel_mail')
         message = template.render(Context(template_data))
-        send_mail(subject="Stornierung deiner Reservierung", message=message, html_message=message,
-                  from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[reservation.reserver.user.email])
+        mail.queue_mail(subject="Stornierung deiner Reservierung", message=message, html_message=message,
+                        from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[reservation.reserver.user.email])
 
         return Response(serializer.data)
 
     @action(detail=False, methods=['POST'], url_path="bulk", permission_classes=[permissions.IsAuthenticated])
+    @transaction.atomic
     def bulk_create(self, request: Request):
         """
         create reservations from a list of reservation candidates
@@ -561,16 +578,15 @@ class ReservationViewSet(viewsets.ModelViewSet):
 
             response_data.append(serializer.data)
         template_data = {**template_data,
-                         "lenting_start_hour": models.Settings.objects.get(type="lenting_start_hour").value,
-                         "lenting_end_hour": models.Settings.objects.get(type="lenting_end_hour").value,
-                         "returning_start_hour": models.Settings.objects.get(type="returning_start_hour").value,
-                         "returning_end_hour": models.Settings.objects.get(type="returning_end_hour").value, }
-        template = Template(models.Text.objects.filter(
-            name='reservation_confirmation_mail').first().content.replace(r"%}}</p>", r"%}}").replace(r"<p>{{%", r"{{%"))
+                         "lenting_start_hour": dynamic_settings.get("lenting_start_hour"),
+                         "lenting_end_hour": dynamic_settings.get("lenting_end_hour"),
+                         "returning_start_hour": dynamic_settings.get("returning_start_hour"),
+                         "returning_end_hour": dynamic_settings.get("returning_end_hour"), }
+        template = mail_templates.get_template('reservation_confirmation_mail', unwrap_tags=True)
         message = template.render(Context(template_data))
         if len(template_data['reservations']) > 0:
-            send_mail(subject="Deine Reservierung", message=message, html_message=message,
-                      from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[template_data['reservations'][0]["reserver"].user.email])
+            mail.queue_mail(subject="Deine Reservierung", message=message, html_message=message,
+                            from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[template_data['reservations'][0]["reserver"].user.email])
         return Response(data={'data': response_data})
 
     @ action(detail=False, methods=['POST'], url_path="download_form", permission_classes=[permissions.IsAuthenticated])
@@ -580,28 +596,62 @@ class ReservationViewSet(viewsets.ModelViewSet):
         """
         logger.info(f"Downloading rental form for reservations: {list(map(lambda x:x['id'], request.data))}")
         context = {'rented_items': [], 'reserver': {}}
+        rental_objects = models.RentalObject.objects.in_bulk([int(pk) for reservation in request.data for pk in reservation['selectedObjects']])
         for reservation in request.data:
             context['reserver']['last_name'] = reservation['reserver']['user']['last_name']
             context['reserver']['first_name'] = reservation['reserver']['user']['first_name']
             context['reserver']['email'] = reservation['reserver']['user']['email']
             context['rented_items'].append({'operation_number':reservation['operation_number'],'reserved_from': reservation['reserved_from'], 'reserved_until': reservation['reserved_until'], 'count': reservation['count'], 'name': reservation['objecttype']['name'], 'identifier': ",".join(
-                [reservation['objecttype']['prefix_identifier'] + str(models.RentalObject.objects.get(pk=thing).internal_identifier) for thing in reservation['selectedObjects']])})
-        filepath = models.Files.objects.get(name='rental_form').file.path
-        doc = DocxTemplate(filepath)
-        doc.render(context=context)
-        file = io.BytesIO()
-        doc.save(file)
+                [reservation['objecttype']['prefix_identifier'] + str(rental_objects[int(thing)].internal_identifier) for thing in reservation['selectedObjects']])})
         # we have to use djangos Response class here because the DRF's class does weird stuff
-        return HttpResponse(file.getvalue(), content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+        return HttpResponse(rental_form.render(context), content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+
+
+class RentalFormExportViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+    """
+    zip with the rental forms of all reservations of a lending day or of a list of operation numbers.
+    a created export is rendered by a celery task, poll it for the progress and get the zip from download once it is done
+    """
+    queryset = models.RentalFormExport.objects.all()
+    serializer_class = serializers.RentalFormExportSerializer
+    permission_classes = [customPermissions.RentalFormExportPermission]
+
+    def get_queryset(self):
+        return super().get_queryset().filter(created_by=self.request.user).order_by('-created_at')
+
+    @transaction.atomic
+    def perform_create(self, serializer):
+        export = serializer.save(created_by=self.request.user)
+
+        def schedule():
+            try:
+                tasks.export_rental_forms.delay(export.pk)
+            except Exception as e:
+                # the frontend polls pending exports, a failed one can be requested again
+                logger.exception(f"could not schedule {export}")
+                models.RentalFormExport.objects.filter(pk=export.pk).update(
+                    status=models.RentalFormExport.FAILED, error=repr(e), finished_at=timezone.now())
+        transaction.on_commit(schedule)
+
+    @ action(detail=True, methods=['GET'], url_path="download")
+    def download(self, request: Request, pk=None):
+        export = self.get_object()
+        if export.status != models.RentalFormExport.DONE:
+            return HttpResponse(f"export is {export.status}", status=status.HTTP_409_CONFLICT)
+        return downloads.file_response(request, export.file.path, export.file.name, content_type='application/zip', as_attachment=True,
+                                       filename=f"rental_forms_{export.lending_date or export.pk}.zip", accel_prefix=settings.FILE_DOWNLOAD_PRIVATE_ACCEL_PREFIX)
 
 
 class RentalViewSet(viewsets.ModelViewSet):
     queryset = Rental.objects.all()
     serializer_class = RentalSerializer
     permission_classes = [customPermissions.RentalPermission]
+    pagination_class = KeysetPagination
+    cursor_ordering = ('rental_number', 'id')
 
     def get_queryset(self):
-        queryset = models.Rental.objects.all()
+        queryset = models.Rental.objects.with_extended_until().with_extension_count().prefetch_related(
+            Prefetch('rented_object', queryset=serialized_rental_objects()), Prefetch('reservation', queryset=serialized_reservations()))
         if self.request.user.is_staff:
             queryset = queryset
         else:
@@ -623,7 +673,7 @@ class RentalViewSet(viewsets.ModelViewSet):
         """
         extends the rental by one week
         """
-        rental = models.Rental.objects.get(pk=pk)
+        rental = models.Rental.objects.with_extended_until().get(pk=pk)
         serializer = serializers.RentalSerializer(
             rental, context={'request': request})
         if serializer.data['extendable']:
@@ -636,6 +686,8 @@ class RentalViewSet(viewsets.ModelViewSet):
                 models.Extension.objects.create(extended_by=request.user, extended_from=rental.extended_until(), extended_until=serializer.data['extended_until']+timedelta(weeks=1), extended_rental=rental)
                 rental.notified = None
                 rental.save()
+                # fetch the rental again to annotate the new end of the rental
+                rental = models.Rental.objects.with_extended_until().get(pk=pk)
                 serializer = serializers.RentalSerializer(
                     rental, context={'request': request})
                 return Response(serializer.data)
@@ -643,6 +695,7 @@ class RentalViewSet(viewsets.ModelViewSet):
             return APIException("nicht verlängerbar", code=status.HTTP_400_BAD_REQUEST)
 
     @ action(detail=False, methods=['POST'], url_path="bulk", permission_classes=[permissions.IsAuthenticated])
+    @transaction.atomic
     def bulk_rental_creation(self, request: Request):
         """
         Takes a list of reservations with a list of slectedObjects each to create collected rentals to be handed out
@@ -653,7 +706,7 @@ class RentalViewSet(viewsets.ModelViewSet):
         else:
             rental_number = 1
         for reservation in request.data:
-            logger.info(reservation)
+            logger.debug(reservation)
             reservation_model = models.Reservation.objects.get(pk=reservation['id'])
             # remove all Rentals that are on this rental 
             reservation_model.rental_set.exclude(rented_object__in=reservation['selectedObjects']).delete()
@@ -682,11 +735,10 @@ class RentalViewSet(viewsets.ModelViewSet):
                 template_data.append(serializer.validated_data)
                 serializer.save()
                 ret_data.append(serializer.data)
-        template = Template(models.Text.objects.filter(
-            name='rental_confirmation_mail').first().content.replace(r"%}}</p>", r"%}}").replace(r"<p>{{%", r"{{%"))
+        template = mail_templates.get_template('rental_confirmation_mail', unwrap_tags=True)
         message = template.render(Context({'rentals': template_data}))
-        send_mail(subject="Dein Ausleihvorgang", message=message, html_message=message,
-                  from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[template_data[0]['reservation'].reserver.user.email])
+        mail.queue_mail(subject="Dein Ausleihvorgang", message=message, html_message=message,
+                        from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[template_data[0]['reservation'].reserver.user.email])
         return Response(ret_data)
     @ action(detail=False, methods=['POST'], url_path="bulkhandout", permission_classes=[permissions.IsAuthenticated])
     def bulk_rental_handout(self, request: Request):
@@ -699,6 +751,10 @@ class RentalViewSet(viewsets.ModelViewSet):
                 if rental_set.all().count() != reservation.count:
                     raise ValueError("The number of rented objects is unequal to the number of reserved objects")
                 rental_set.all().update(handed_out_at= timezone.now())
+                # update() does not send signals, but the availability and the reminders depend on handed_out_at
+                for rental in rental_set.all():
+                    base_signals.update_availability_on_save(models.Rental, rental)
+                    base_signals.update_reminders_on_save(models.Rental, rental)
                 #TODO send email on handout
         return Response()
 
@@ -713,6 +769,8 @@ class RentalViewSet(viewsets.ModelViewSet):
         if len(queryset) != len(request.data):
             return Response("couldn't find some of those rentals", status=status.HTTP_400_BAD_REQUEST)
         updated = queryset.update(received_back_at=timezone.now())
+        # returned rentals do not need reminders anymore
+        models.ScheduledReminder.objects.filter(rental__in=request.data, sent_at__isnull=True).delete()
         return Response(updated)
 
 
@@ -792,8 +850,9 @@ class FilesViewSet(viewsets.ModelViewSet):
         if ('name' not in request.GET):
             return HttpResponse("missing 'name' query param", status.HTTP_400_BAD_REQUEST)
         instance = self.queryset.filter(name=request.GET['name']).first()
-        file = instance.file.open()
-        return HttpResponse(file, content_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+        if instance is None:
+            return HttpResponse(f"no file named {request.GET['name']}", status.HTTP_404_NOT_FOUND)
+        return downloads.file_response(request, instance.file.path, instance.file.name, content_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
 
 
 class ProfileViewSet(viewsets.ModelViewSet):
@@ -808,7 +867,7 @@ class OnPremiseWorkplaceViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        logger.info(self.request.GET)
+        logger.debug(self.request.GET)
         if 'displayed' in self.request.GET:
             if self.request.GET['displayed'] in ['True', 'true']:
                 queryset = queryset.filter(displayed=True)
@@ -820,22 +879,12 @@ class OnPremiseWorkplaceViewSet(viewsets.ModelViewSet):
         """
         return all Timeslots which are bookable [{start: time, end:time, weekday: int, date:date ,disabled: bool}]
         """
-        weekdays = models.Settings.objects.get(
-            type='onpremise_weekdays').value.replace(' ', '').split(',')
-        temp = models.Settings.objects.get(
-            type='onpremise_starttime').value.replace(' ', '').split(':')
-        onpremise_start_hour = int(temp[0])
-        onpremise_start_min = int(temp[1] if len(temp) > 1 else 0)
-        temp = models.Settings.objects.get(
-            type='onpremise_endtime').value.replace(' ', '').split(':')
-        onpremise_end_hour = int(temp[0])
-        onpremise_end_min = int(temp[1] if len(temp) > 1 else 0)
-        onpremise_break = timedelta(minutes=int(models.Settings.objects.get(
-            type='onpremise_breakinbetween_in_min').value.replace(' ', '')))
-        onpremise_date_range = int(models.Settings.objects.get(
-            type='onpremise_date_range_in_days').value.replace(' ', ''))
-        duration = timedelta(minutes=int(models.Settings.objects.get(
-            type='onepremise_slotduration').value.replace(' ', '')))
+        weekdays = dynamic_settings.get_list('onpremise_weekdays')
+        onpremise_start_hour, onpremise_start_min = dynamic_settings.get_time('onpremise_starttime')
+        onpremise_end_hour, onpremise_end_min = dynamic_settings.get_time('onpremise_endtime')
+        onpremise_break = timedelta(minutes=dynamic_settings.get_int('onpremise_breakinbetween_in_min'))
+        onpremise_date_range = dynamic_settings.get_int('onpremise_date_range_in_days')
+        duration = timedelta(minutes=dynamic_settings.get_int('onepremise_slotduration'))
         ret = []
         excluded_workplaces = models.OnPremiseWorkplace.objects.get(
             pk=pk).exclusions.all()
@@ -875,6 +924,8 @@ class OnPremiseBookingViewSet(viewsets.ModelViewSet):
     queryset = models.OnPremiseBooking.objects.all()
     serializer_class = serializers.OnPremiseBookingSerializer
     permission_classes = [customPermissions.OnPremiseBookingPermission]
+    pagination_class = KeysetPagination
+    cursor_ordering = ('slot_start', 'id')
 
     @action(detail=True, url_path="cancel", methods=['POST'], permission_classes=[permissions.IsAuthenticated])
     def cancel_onpremise_booking(self, request: Request, pk=None):
@@ -44,7 +44,22 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
+    'loggers': {
+        # one json line per request from api.middleware.PerformanceMiddleware, WARNING only logs slow requests
+        'performance': {
+            'level': os.environ.get('PERFORMANCE_LOG_LEVEL', 'INFO'),
+        },
+    },
 }
+# requests taking longer than this many seconds are logged as warning together with their sql statements
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1))
+SLOW_REQUEST_MAX_QUERIES = int(os.environ.get('SLOW_REQUEST_MAX_QUERIES', 50))
+# adds the timings of api.middleware.PerformanceMiddleware to every response as Server-Timing header. off unless DEBUG,
+# the query counts and durations would tell every client about the internals of the api
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', str(DEBUG)) in ['true', 'True', '1']
+# /metrics only answers requests with "Authorization: Bearer <METRICS_TOKEN>", without a token only with DEBUG.
+# see base.metrics for multiprocess mode
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Application definition
 
@@ -67,6 +82,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,7 +95,7 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'knox.auth.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'EXCEPTION_HANDLER': 'api.views.integrity_error_exception_handler'
 
@@ -92,7 +108,11 @@ REST_KNOX = {
     'USER_SERIALIZER': 'knox.serializers.UserSerializer',
     'TOKEN_LIMIT_PER_USER': None,
     'AUTO_REFRESH': True,
+    # seconds, the expiry of a token is written at most this often
+    'MIN_REFRESH_INTERVAL': 5 * 60,
 }
+# seconds a validated token is cached with its user and permissions, see api.authentication
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.environ.get('AUTH_TOKEN_CACHE_TIMEOUT', 60))
 
 ROOT_URLCONF = 'backend.urls'
 TEMPLATES = [
@@ -124,6 +144,10 @@ OAUTH_CLIENTS = {
     }
 }
 
+# seconds to connect to and to wait for an answer of the oauth provider, see base.oauth
+OAUTH_TIMEOUT = (float(os.environ.get('OAUTH_CONNECT_TIMEOUT', 3.05)), float(os.environ.get('OAUTH_READ_TIMEOUT', 10)))
+OAUTH_POOL_SIZE = int(os.environ.get('OAUTH_POOL_SIZE', 10))
+
 WSGI_APPLICATION = 'backend.wsgi.application'
 
 
@@ -142,6 +166,16 @@ DATABASES = {
     }
 }
 
+# Cache, shares the redis instance with celery
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('CACHE_URL', 'redis://redis:6379/1'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -181,6 +215,18 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# files that are only sent by views checking the permissions, never under MEDIA_URL, see base.storage
+PRIVATE_MEDIA_ROOT = os.environ.get('PRIVATE_MEDIA_ROOT', os.path.join(BASE_DIR, 'private_media'))
+# 'django' streams downloads from the worker, 'x-accel-redirect' (nginx) and 'x-sendfile' (apache, lighttpd) only
+# send a header and let the web server send the file
+FILE_DOWNLOAD_MODE = os.environ.get('FILE_DOWNLOAD_MODE', 'django')
+# internal nginx location that maps to MEDIA_ROOT, used by 'x-accel-redirect'
+FILE_DOWNLOAD_ACCEL_PREFIX = os.environ.get('FILE_DOWNLOAD_ACCEL_PREFIX', '/protected-media/')
+# internal nginx location that maps to PRIVATE_MEDIA_ROOT
+FILE_DOWNLOAD_PRIVATE_ACCEL_PREFIX = os.environ.get('FILE_DOWNLOAD_PRIVATE_ACCEL_PREFIX', '/protected-private-media/')
+# longest side in pixels of the variants base.images creates of uploaded images
+IMAGE_VARIANT_SIZES = {'thumbnail': 320, 'medium': 960}
+IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY', 80))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -211,6 +257,16 @@ EMAIL_USE_TLS = str(os.environ.get('EMAIL_USE_TLS')).lower() == "true"
 EMAIL_USE_SSL = str(os.environ.get('EMAIL_USE_SSL')).lower() == "true"
 DEFAULT_FROM_EMAIL = str(os.environ.get('DEFAULT_FROM_EMAIL'))
 DEFAULT_NOTIFICATION_EMAIL = str(os.environ.get('DEFAULT_NOTIFICATION_EMAIL'))
+# mails are queued in base.OutgoingMail and sent in batches by a celery task over one smtp connection
+MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+# most mails sent within one minute, the rest waits for the next run
+MAIL_RATE_LIMIT_PER_MINUTE = int(os.environ.get('MAIL_RATE_LIMIT_PER_MINUTE', 120))
+# attempts until a mail is marked as failed and not sent anymore
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 8))
+# seconds a run of send_queued_mails has to send the mails it claimed, afterwards another run may send them
+MAIL_CLAIM_TIMEOUT = int(os.environ.get('MAIL_CLAIM_TIMEOUT', 300))
+# seconds until the first retry of a failed mail, doubled with every further attempt
+MAIL_RETRY_BACKOFF = int(os.environ.get('MAIL_RETRY_BACKOFF', 60))
 
 
 # Settings for appointments
@@ -226,9 +282,32 @@ DEFAULT_RETURNING_END_HOUR = 12
 diff_in_days = 0
 DEFAULT_OFFSET_BETWEEN_RENTALS = timedelta(days=diff_in_days)
 
+# 'python' calculates the availability of types in the worker, 'postgres' lets the database count the blocked objects per day
+# and 'calendar' reads the precalculated base.AvailabilityCalendar (run manage.py rebuild_availability_calendar before switching)
+# all of them answer the same, the calendar calculates ranges with partly defect objects or an offset between rentals directly
+AVAILABILITY_BACKEND = os.environ.get('AVAILABILITY_BACKEND', 'python')
+# seconds a calculated availability is cached, changes of a type invalidate its entries earlier
+AVAILABILITY_CACHE_TIMEOUT = int(os.environ.get('AVAILABILITY_CACHE_TIMEOUT', 60 * 60))
+# number of days starting today which are kept in the availability calendar
+AVAILABILITY_CALENDAR_DAYS = int(os.environ.get('AVAILABILITY_CALENDAR_DAYS', 365))
+# seconds a process uses its copy of the base.Settings table before checking the version in the cache again
+SETTINGS_CACHE_CHECK_INTERVAL = float(os.environ.get('SETTINGS_CACHE_CHECK_INTERVAL', 1))
+# zips of base.RentalFormExport are deleted after this time
+RENTAL_FORM_EXPORT_MAX_AGE = timedelta(hours=int(os.environ.get('RENTAL_FORM_EXPORT_MAX_AGE_HOURS', 24)))
+
 EMAIL_VALIDATION_REGEX = '\\S+@([a-zA-Z0-9]+\\.)?rwth-aachen\\.de'
 
 # celery broker and result
 CELERY_BROKER_URL = os.environ.get("BROKER_URL", "redis://redis:6379/0")
 CELERY_RESULT_BACKEND = os.environ.get(
     "RESULT_BACKEND", "redis://redis:6379/0")
+# tasks are published on commit inside requests, an unreachable broker must fail fast instead of blocking the request
+# with the default retries. every caller catches the error and has a fallback, e.g. a periodic task
+CELERY_BROKER_CONNECTION_TIMEOUT = float(os.environ.get('CELERY_BROKER_CONNECTION_TIMEOUT', 2))
+CELERY_BROKER_TRANSPORT_OPTIONS = {'socket_connect_timeout': CELERY_BROKER_CONNECTION_TIMEOUT}
+CELERY_TASK_PUBLISH_RETRY_POLICY = {
+    'max_retries': int(os.environ.get('CELERY_PUBLISH_MAX_RETRIES', 1)),
+    'interval_start': 0,
+    'interval_step': 0.2,
+    'interval_max': 0.5,
+}
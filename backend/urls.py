@@ -17,10 +17,12 @@ from django.contrib import admin
 from django.urls import include,path, re_path
 from django.conf.urls.static import static 
 from django.conf import settings
-from django.views.static import serve
+from api import downloads
+from api import views as api_views
 
 urlpatterns = [
     path('api/', include('api.urls')),
     path('django-admin/', admin.site.urls),
-    re_path(r'^media/(?P<path>.*)$', serve, kwargs={'document_root': settings.MEDIA_ROOT})
+    path('metrics', api_views.metrics_view),
+    re_path(r'^media/(?P<path>.*)$', downloads.media)
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
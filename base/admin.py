@@ -26,4 +26,8 @@ admin.site.register(models.OnPremiseBooking)
 admin.site.register(models.OnPremiseWorkplace)
 admin.site.register(models.OnPremiseWorkplaceStatus)
 admin.site.register(models.PasswordReset)
-admin.site.register(models.Extension)
\ No newline at end of file
+admin.site.register(models.Extension)
+admin.site.register(models.OutgoingMail)
+admin.site.register(models.ScheduledReminder)
+admin.site.register(models.EmailValidationToken)
+admin.site.register(models.RentalFormExport)
@@ -109,9 +109,24 @@ class BaseConfig(AppConfig):
             models.Text.objects.create(
                 name='signup_mail', content=r"Hallo {{first_name}}, bitte aktiviere dein Konto unter {{validation_link}}")
     
-        if not PeriodicTask.objects.filter(task="base.tasks.notify_about_rentals_and_reservations").exists():
-            logger.info(f"creating lenting_day with {settings.DEFAULT_LENTING_DAY_OF_WEEK} in db")
-            PeriodicTask.objects.create(name="Send Notifications about rentals and reservations", task="base.tasks.notify_about_rentals_and_reservations", args=[], kwargs={}, enabled=True, interval_id=IntervalSchedule.objects.get_or_create(every=30, period="minutes")[0].pk)
+        # replaced by send_due_reminders
+        PeriodicTask.objects.filter(task="base.tasks.notify_about_rentals_and_reservations").delete()
+
+        if not PeriodicTask.objects.filter(task="base.tasks.send_due_reminders").exists():
+            logger.info(f"creating periodic task send_due_reminders in db")
+            PeriodicTask.objects.create(name="Send Notifications about rentals and reservations when they are due", task="base.tasks.send_due_reminders", args=[], kwargs={}, enabled=True, interval_id=IntervalSchedule.objects.get_or_create(every=1, period="minutes")[0].pk)
+
+        if not PeriodicTask.objects.filter(task="base.tasks.send_queued_mails").exists():
+            logger.info(f"creating periodic task send_queued_mails in db")
+            PeriodicTask.objects.create(name="Send queued mails, including retries of failed ones", task="base.tasks.send_queued_mails", args=[], kwargs={}, enabled=True, interval_id=IntervalSchedule.objects.get_or_create(every=1, period="minutes")[0].pk)
+
+        if not PeriodicTask.objects.filter(task="base.tasks.roll_availability_calendar").exists():
+            logger.info(f"creating periodic task roll_availability_calendar in db")
+            PeriodicTask.objects.create(name="Move the availability calendar to the current day", task="base.tasks.roll_availability_calendar", args=[], kwargs={}, enabled=True, interval_id=IntervalSchedule.objects.get_or_create(every=1, period="days")[0].pk)
+
+        if not PeriodicTask.objects.filter(task="base.tasks.cleanup_rental_form_exports").exists():
+            logger.info(f"creating periodic task cleanup_rental_form_exports in db")
+            PeriodicTask.objects.create(name="Delete old zips of rental forms", task="base.tasks.cleanup_rental_form_exports", args=[], kwargs={}, enabled=True, interval_id=IntervalSchedule.objects.get_or_create(every=1, period="hours")[0].pk)
 
         if not PeriodicTask.objects.filter(task="base.tasks.cleanup_accounts").exists():
             logger.info(f"creating lenting_day with {settings.DEFAULT_LENTING_DAY_OF_WEEK} in db")
@@ -0,0 +1,424 @@
+"""
+calculation of the available objects of a RentalObjectType for a range of days.
+every rental, reservation and defect status is turned into a weighted interval of blocked days. the occupancy of every
+day is then calculated in one pass over a difference array instead of checking every interval for every day.
+"""
+from datetime import date, datetime, timedelta
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from base import cache as cache_versions
+from base import models
+
+
+class BlockedInterval(NamedTuple):
+    """
+    a timerange in which `weight` objects of a type are occupied. from_date is inclusive, until_date is exclusive
+    """
+    from_date: date
+    until_date: date
+    weight: int = 1
+
+
+# a type and the first and last day of a range, the days are normalized by normalize_date
+Range = Tuple[int, datetime, datetime]
+
+
+def normalize_date(value: date) -> datetime:
+    """
+    dates and datetimes are both accepted by the api, internally we always calculate with the start of the day
+    """
+    return datetime.combine(value, datetime.min.time(), tzinfo=timezone.get_current_timezone())
+
+
+def to_date(value: date) -> date:
+    """
+    the day of a date or datetime. fields with a datetime default like RentalObjectStatus.from_date keep the datetime
+    on the instance until it is loaded again
+    """
+    if isinstance(value, datetime):
+        return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    return value
+
+
+def occupancy_per_day(intervals: Iterable[BlockedInterval], from_date: date, until_date: date) -> List[int]:
+    """
+    returns the number of occupied objects for every day between from_date and until_date (both inclusive).
+    each interval adds its weight on its first day and removes it on its end day, the prefix sum is the occupancy.
+    """
+    days = (until_date - from_date).days + 1
+    if days <= 0:
+        return []
+    diff = [0] * (days + 1)
+    for interval in intervals:
+        start = max((interval.from_date - from_date).days, 0)
+        end = min((interval.until_date - from_date).days, days)
+        if start >= end:
+            continue
+        diff[start] += interval.weight
+        diff[end] -= interval.weight
+    occupancy = []
+    current = 0
+    for day_diff in range(days):
+        current += diff[day_diff]
+        occupancy.append(current)
+    return occupancy
+
+
+def free_per_day(count: int, intervals: Iterable[BlockedInterval], from_date: date, until_date: date) -> dict:
+    """
+    builds the response of RentalObjectType.available: the free objects for each day as '%Y-%m-%d' key and the
+    minimum over the whole range as 'available'
+    """
+    ret = {}
+    max_value = 0
+    for day_diff, occupied in enumerate(occupancy_per_day(intervals, from_date, until_date)):
+        ret[str(from_date + timedelta(days=day_diff))] = count - occupied
+        max_value = occupied if occupied > max_value else max_value
+    ret['available'] = count - max_value
+    return ret
+
+
+class AvailabilitySnapshot:
+    """
+    everything that can block objects of a set of types between from_date and until_date, fetched with a fixed number
+    of queries. afterwards the availability of every range inside can be calculated without touching the database again
+    """
+
+    def __init__(self, pks: Iterable[int], from_date: datetime, until_date: datetime):
+        pks = list(pks)
+        self.objects = defaultdict(list)
+        self.status = defaultdict(list)
+        self.reservations = defaultdict(list)
+        self.rentals = defaultdict(list)
+        for object_id, type_id in models.RentalObject.objects.filter(type__in=pks, rentable=True).values_list('id', 'type_id'):
+            self.objects[type_id].append(object_id)
+        # all "defect" status of those types
+        for type_id, object_id, status_from, status_until in models.RentalObjectStatus.objects.filter(
+                rental_object__type__in=pks, rentable=False, from_date__lte=until_date, until_date__gte=from_date).values_list(
+                'rental_object__type_id', 'rental_object_id', 'from_date', 'until_date'):
+            self.status[type_id].append((object_id, status_from, status_until))
+        # reservations that are already related to a rental or are canceled do not block anything
+        reservations = models.Reservation.objects.filter(
+            objecttype_id__in=pks, reserved_from__lte=until_date.date(), reserved_until__gte=from_date.date(), canceled__isnull=True).exclude(
+            Exists(models.Rental.objects.filter(reservation=OuterRef('pk'), rented_object__type=OuterRef('objecttype'))))
+        for type_id, reserved_from, reserved_until, count in reservations.values_list('objecttype_id', 'reserved_from', 'reserved_until', 'count'):
+            self.reservations[type_id].append((reserved_from, reserved_until, count))
+        rentals = models.Rental.objects.with_extended_until().filter(
+            rented_object__type__in=pks, rented_object__rentable=True, handed_out_at__lte=until_date, extended_until_date__lte=until_date.date())
+        for type_id, object_id, handed_out_at, extended_until in rentals.values_list('rented_object__type_id', 'rented_object_id', 'handed_out_at', 'extended_until_date'):
+            self.rentals[type_id].append((object_id, handed_out_at, extended_until))
+
+    def blocked_intervals(self, pk: int, from_date: datetime, until_date: datetime) -> Tuple[int, List[BlockedInterval]]:
+        """
+        the number of rentable objects of a type and all rentals and reservations blocking them in the given range
+        """
+        offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+        # remove all objects with an status from objects
+        defect = {object_id for object_id, status_from, status_until in self.status[pk]
+                  if status_from <= until_date.date() and status_until >= from_date.date()}
+        objects = {object_id for object_id in self.objects[pk] if object_id not in defect}
+        intervals = []
+        for object_id, handed_out_at, extended_until in self.rentals[pk]:
+            if object_id in objects and handed_out_at <= until_date and extended_until <= from_date.date():
+                intervals.append(BlockedInterval(
+                    handed_out_at.date(), extended_until + offset))
+        for reserved_from, reserved_until, count in self.reservations[pk]:
+            if reserved_from <= until_date.date() and reserved_until >= from_date.date():
+                intervals.append(BlockedInterval(
+                    reserved_from, reserved_until + offset, count))
+        return len(objects), intervals
+
+    def available(self, pk: int, from_date: datetime, until_date: datetime) -> dict:
+        count, intervals = self.blocked_intervals(pk, from_date, until_date)
+        return free_per_day(count, intervals, from_date.date(), until_date.date())
+
+
+def available_snapshot(ranges: List[Range]) -> Dict[Range, dict]:
+    """
+    python implementation of available_ranges, one snapshot covers all ranges
+    """
+    if not ranges:
+        return {}
+    snapshot = AvailabilitySnapshot({pk for pk, _, _ in ranges}, min(from_date for _, from_date, _ in ranges),
+                                    max(until_date for _, _, until_date in ranges))
+    return {key: snapshot.available(*key) for key in ranges}
+
+
+# the same selection as AvailabilitySnapshot for every range, but the counting for every type and day is done by postgres
+AVAILABILITY_SQL = """
+WITH ranges AS (
+    SELECT * FROM unnest(%(pks)s::bigint[], %(from_dates)s::date[], %(until_dates)s::date[], %(until_datetimes)s::timestamptz[])
+        AS g(type_id, from_date, until_date, until_datetime)
+), objects AS (
+    SELECT g.type_id, g.from_date, g.until_date, g.until_datetime, o.id FROM ranges g
+    JOIN base_rentalobject o ON o.type_id = g.type_id
+    WHERE o.rentable AND NOT EXISTS (
+        SELECT 1 FROM base_rentalobjectstatus s
+        WHERE s.rental_object_id = o.id AND NOT s.rentable AND s.from_date <= g.until_date AND s.until_date >= g.from_date)
+), blocked AS (
+    SELECT g.type_id, g.from_date, g.until_date, r.reserved_from AS blocked_from, r.reserved_until + %(offset)s AS blocked_until, r.count AS weight
+    FROM ranges g
+    JOIN base_reservation r ON r.objecttype_id = g.type_id
+    WHERE r.canceled IS NULL AND r.reserved_from <= g.until_date AND r.reserved_until >= g.from_date
+        AND NOT EXISTS (
+            SELECT 1 FROM base_rental rl JOIN base_rentalobject ro ON ro.id = rl.rented_object_id
+            WHERE rl.reservation_id = r.id AND ro.type_id = r.objecttype_id)
+    UNION ALL
+    SELECT o.type_id, o.from_date, o.until_date, (rl.handed_out_at AT TIME ZONE 'UTC')::date, e.extended_until + %(offset)s, 1
+    FROM base_rental rl
+    JOIN objects o ON o.id = rl.rented_object_id
+    JOIN base_reservation r ON r.id = rl.reservation_id
+    CROSS JOIN LATERAL (
+        SELECT COALESCE(MAX(x.extended_until), r.reserved_until) AS extended_until
+        FROM base_extension x WHERE x.extended_rental_id = rl.id) e
+    WHERE rl.handed_out_at <= o.until_datetime AND e.extended_until <= o.from_date
+)
+SELECT g.type_id, g.from_date, g.until_date, days.day::date, COALESCE(object_count.value, 0), COALESCE(SUM(b.weight), 0)
+FROM ranges g
+LEFT JOIN (SELECT type_id, from_date, until_date, COUNT(*) AS value FROM objects GROUP BY type_id, from_date, until_date) object_count
+    ON object_count.type_id = g.type_id AND object_count.from_date = g.from_date AND object_count.until_date = g.until_date
+LEFT JOIN LATERAL generate_series(g.from_date, g.until_date, interval '1 day') AS days(day) ON true
+LEFT JOIN blocked b ON b.type_id = g.type_id AND b.from_date = g.from_date AND b.until_date = g.until_date
+    AND b.blocked_from <= days.day::date AND days.day::date < b.blocked_until
+GROUP BY g.type_id, g.from_date, g.until_date, object_count.value, days.day
+ORDER BY g.type_id, g.from_date, g.until_date, days.day
+"""
+
+
+def available_sql_ranges(ranges: List[Range]) -> Dict[Range, dict]:
+    """
+    postgres implementation of available_ranges, the free objects of every range and day are calculated with one statement
+    """
+    if not ranges:
+        return {}
+    by_dates = {(pk, from_date.date(), until_date.date()): (pk, from_date, until_date) for pk, from_date, until_date in ranges}
+    with connection.cursor() as cursor:
+        cursor.execute(AVAILABILITY_SQL, {'pks': [pk for pk, _, _ in by_dates], 'from_dates': [from_date for _, from_date, _ in by_dates],
+                                          'until_dates': [until_date for _, _, until_date in by_dates],
+                                          'until_datetimes': [until_date for _, _, until_date in by_dates.values()],
+                                          'offset': settings.DEFAULT_OFFSET_BETWEEN_RENTALS.days})
+        rows = cursor.fetchall()
+    ret = {}
+    max_values = {}
+    for type_id, from_date, until_date, day, count, occupied in rows:
+        key = by_dates[(type_id, from_date, until_date)]
+        if key not in ret:
+            ret[key] = {}
+            max_values[key] = 0
+        if day is not None:
+            ret[key][str(day)] = count - occupied
+            max_values[key] = occupied if occupied > max_values[key] else max_values[key]
+        ret[key]['available'] = count - max_values[key]
+    return ret
+
+
+def available_sql(pks: List[int], from_date: datetime, until_date: datetime) -> Dict[int, dict]:
+    """
+    postgres implementation of available_many
+    """
+    calculated = available_sql_ranges([(pk, from_date, until_date) for pk in pks])
+    return {pk: calculated[(pk, from_date, until_date)] for pk in pks}
+
+
+def calendar_range() -> Tuple[date, date]:
+    """
+    the days for which the availability calendar keeps rows, starting today
+    """
+    today = timezone.localdate()
+    return today, today + timedelta(days=settings.AVAILABILITY_CALENDAR_DAYS - 1)
+
+
+def calendar_days(snapshot: AvailabilitySnapshot, pk: int, from_date: date, until_date: date) -> List[Tuple[date, int, int]]:
+    """
+    calculates (day, rentable, occupied) for every day in the range. the values of each day equal available() for
+    that single day, see available_calendar for the ranges whose availability is the minimum of their days
+    """
+    offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+    days = (until_date - from_date).days + 1
+    if days <= 0:
+        return []
+    objects = set(snapshot.objects[pk])
+    # merge the status of each object to count every defect object only once per day
+    defect_ranges = defaultdict(list)
+    for object_id, status_from, status_until in sorted(snapshot.status[pk], key=lambda status: status[1]):
+        if object_id not in objects:
+            continue
+        start = max((status_from - from_date).days, 0)
+        end = min((status_until - from_date).days + 1, days)
+        if start >= end:
+            continue
+        ranges = defect_ranges[object_id]
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    defect = [0] * (days + 1)
+    for ranges in defect_ranges.values():
+        for start, end in ranges:
+            defect[start] += 1
+            defect[end] -= 1
+    # a reservation only blocks a single day if it overlaps it, so it ends at its last day even with an offset
+    occupied = occupancy_per_day([BlockedInterval(reserved_from, min(reserved_until + timedelta(days=1), reserved_until + offset), count)
+                                  for reserved_from, reserved_until, count in snapshot.reservations[pk]], from_date, until_date)
+    for object_id, handed_out_at, extended_until in snapshot.rentals[pk]:
+        if object_id not in objects:
+            continue
+        for day_diff in range(offset.days):
+            day = extended_until + timedelta(days=day_diff)
+            index = (day - from_date).days
+            if not 0 <= index < days or handed_out_at > normalize_date(day) or handed_out_at.date() > day:
+                continue
+            if any(start <= index < end for start, end in defect_ranges[object_id]):
+                continue
+            occupied[index] += 1
+    ret = []
+    current_defect = 0
+    for index in range(days):
+        current_defect += defect[index]
+        ret.append((from_date + timedelta(days=index), len(objects) - current_defect, occupied[index]))
+    return ret
+
+
+def calendar_rows(pks: Iterable[int], from_date: date, until_date: date) -> List[models.AvailabilityCalendar]:
+    """
+    recalculates the calendar rows of the given types for a range of days without saving them
+    """
+    pks = list(pks)
+    snapshot = AvailabilitySnapshot(pks, normalize_date(from_date), normalize_date(until_date))
+    return [models.AvailabilityCalendar(object_type_id=pk, day=day, rentable=rentable, occupied=occupied)
+            for pk in pks for day, rentable, occupied in calendar_days(snapshot, pk, from_date, until_date)]
+
+
+def refresh_calendar(pks: Iterable[int], from_date: date, until_date: date):
+    """
+    overwrites the calendar rows of the given types for the days between from_date and until_date inside calendar_range
+    """
+    first_day, last_day = calendar_range()
+    from_date = max(to_date(from_date), first_day)
+    until_date = min(to_date(until_date), last_day)
+    pks = list(models.RentalObjectType.objects.filter(pk__in=pks).values_list('pk', flat=True))
+    if from_date > until_date or not pks:
+        return
+    models.AvailabilityCalendar.objects.bulk_create(calendar_rows(pks, from_date, until_date), batch_size=1000, update_conflicts=True,
+                                                    unique_fields=['object_type', 'day'], update_fields=['rentable', 'occupied'])
+
+
+def available_calendar_ranges(ranges: List[Range]) -> Dict[Range, dict]:
+    """
+    reads the availability from the calendar. the rows hold the values of single days, their minimum is the
+    availability of the range unless
+    - an object is defect on some days of the range, it is missing on all days of the range then
+    - DEFAULT_OFFSET_BETWEEN_RENTALS is set, the days blocked after a rental or reservation depend on the start of the range
+    those ranges and ranges that are not completely covered by rows are calculated directly like the other engines do
+    """
+    exact = list(ranges) if settings.DEFAULT_OFFSET_BETWEEN_RENTALS else [key for key in ranges if key[2].date() < key[1].date()]
+    candidates = [key for key in ranges if key not in exact]
+    ret = {}
+    if candidates:
+        pks = {pk for pk, _, _ in candidates}
+        first_day = min(from_date for _, from_date, _ in candidates).date()
+        last_day = max(until_date for _, _, until_date in candidates).date()
+        rows = defaultdict(dict)
+        for type_id, day, rentable, occupied in models.AvailabilityCalendar.objects.filter(
+                object_type__in=pks, day__gte=first_day, day__lte=last_day).values_list('object_type_id', 'day', 'rentable', 'occupied'):
+            rows[type_id][day] = rentable - occupied
+        status = defaultdict(list)
+        for type_id, status_from, status_until in models.RentalObjectStatus.objects.filter(
+                rental_object__type__in=pks, rental_object__rentable=True, rentable=False, from_date__lte=last_day, until_date__gte=first_day).values_list(
+                'rental_object__type_id', 'from_date', 'until_date'):
+            status[type_id].append((status_from, status_until))
+        for key in candidates:
+            pk, from_date, until_date = key
+            days = [from_date.date() + timedelta(days=day_diff) for day_diff in range((until_date.date() - from_date.date()).days + 1)]
+            if any(day not in rows[pk] for day in days) or any(
+                    status_from <= until_date.date() and status_until >= from_date.date() for status_from, status_until in status[pk]):
+                exact.append(key)
+                continue
+            ret[key] = {str(day): rows[pk][day] for day in days}
+            ret[key]['available'] = min(rows[pk][day] for day in days)
+    ret.update(available_snapshot(exact))
+    return ret
+
+
+def available_calendar(pks: List[int], from_date: datetime, until_date: datetime) -> Dict[int, dict]:
+    """
+    calendar implementation of available_many
+    """
+    calculated = available_calendar_ranges([(pk, from_date, until_date) for pk in pks])
+    return {pk: calculated[(pk, from_date, until_date)] for pk in pks}
+
+
+def calculate_ranges(ranges: List[Range]) -> Dict[Range, dict]:
+    if settings.AVAILABILITY_BACKEND == 'postgres':
+        return available_sql_ranges(ranges)
+    if settings.AVAILABILITY_BACKEND == 'calendar':
+        return available_calendar_ranges(ranges)
+    return available_snapshot(ranges)
+
+
+def calculate_available(pks: List[int], from_date: datetime, until_date: datetime) -> Dict[int, dict]:
+    calculated = calculate_ranges([(pk, from_date, until_date) for pk in pks])
+    return {pk: calculated[(pk, from_date, until_date)] for pk in pks}
+
+
+def cache_version_name(pk: int) -> str:
+    return f"availability:{pk}"
+
+
+def invalidate_cache(pks: Iterable[int]):
+    """
+    has to be called after every change of something that blocks objects of those types
+    """
+    cache_versions.bump_version(*[cache_version_name(pk) for pk in pks])
+
+
+def available_ranges(ranges: Iterable[Tuple[int, date, date]]) -> Dict[Range, dict]:
+    """
+    calculates available for several types and ranges with one call of the configured engine, e.g. for a page of rentals
+    that end on different days. the keys are (pk, from_date, until_date) with both dates normalized by normalize_date.
+    results are cached per type and range until the type gets invalidated
+    """
+    # the serializers pass the type itself instead of its primary key
+    ranges = list(dict.fromkeys((getattr(pk, 'pk', pk), normalize_date(from_date), normalize_date(until_date))
+                                for pk, from_date, until_date in ranges))
+    if connection.in_atomic_block:
+        # uncommitted changes are only visible inside this transaction and must not end up in the cache
+        return calculate_ranges(ranges)
+    versions = cache_versions.get_versions({cache_version_name(pk) for pk, _, _ in ranges})
+    keys = {key: f"availability:{settings.AVAILABILITY_BACKEND}:{key[0]}:{versions[cache_version_name(key[0])]}:{key[1].date()}:{key[2].date()}"
+            for key in ranges}
+    cached = cache.get_many(keys.values())
+    ret = {key: cached[keys[key]] for key in ranges if keys[key] in cached}
+    missing = [key for key in ranges if keys[key] not in cached]
+    if missing:
+        calculated = calculate_ranges(missing)
+        cache.set_many({keys[key]: calculated[key] for key in missing},
+                       timeout=settings.AVAILABILITY_CACHE_TIMEOUT)
+        ret.update(calculated)
+    return ret
+
+
+def available_many(pks: Iterable[int], from_date: date, until_date: date) -> Dict[int, dict]:
+    """
+    calculates available for a list of types at once, the number of queries does not depend on the number of types
+    """
+    pks = [getattr(pk, 'pk', pk) for pk in pks]
+    from_date = normalize_date(from_date)
+    until_date = normalize_date(until_date)
+    calculated = available_ranges([(pk, from_date, until_date) for pk in pks])
+    return {pk: calculated[(pk, from_date, until_date)] for pk in pks}
+
+
+def available(pk: int, from_date: date, until_date: date) -> dict:
+    """
+    calculates the free objects of a type for each day in the range and the number of objects that are free on all days
+    """
+    pk = getattr(pk, 'pk', pk)
+    return available_many([pk], from_date, until_date)[pk]
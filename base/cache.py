@@ -0,0 +1,34 @@
+"""
+versioned cache entries. instead of searching and deleting every cached entry that depends on an object, the version of
+the object is increased. entries of older versions are not read anymore and expire on their own
+"""
+from typing import Dict, Iterable
+
+from django.core.cache import cache
+
+
+def version_key(name: str) -> str:
+    return f"version:{name}"
+
+
+def get_versions(names: Iterable[str]) -> Dict[str, int]:
+    """
+    fetches the current versions of a list of names with one cache request
+    """
+    names = list(names)
+    versions = cache.get_many([version_key(name) for name in names])
+    return {name: versions.get(version_key(name), 0) for name in names}
+
+
+def get_version(name: str) -> int:
+    return get_versions([name])[name]
+
+
+def bump_version(*names: str):
+    """
+    invalidates every entry cached for one of the names
+    """
+    for name in names:
+        # versions never expire, otherwise an old version could be reached again
+        cache.add(version_key(name), 0, timeout=None)
+        cache.incr(version_key(name))
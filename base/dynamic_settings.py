@@ -0,0 +1,82 @@
+"""
+process local copy of the base.Settings table. the whole table is loaded at once and kept until the version in the
+cache changes, which happens whenever a row is saved or deleted. the version is checked at most every
+SETTINGS_CACHE_CHECK_INTERVAL seconds, so other processes pick up a change after that time at the latest
+"""
+import time
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+
+from base import cache as cache_versions
+from base import models
+
+VERSION_NAME = 'settings'
+
+_values: Dict[str, str] = {}
+_version = None
+_checked_at = 0.0
+
+
+def _load(version: int):
+    global _values, _version
+    _values = dict(models.Settings.objects.values_list('type', 'value'))
+    _version = version
+
+
+def values() -> Dict[str, str]:
+    """
+    all settings as type: value
+    """
+    global _checked_at
+    now = time.monotonic()
+    if _version is None or now - _checked_at >= settings.SETTINGS_CACHE_CHECK_INTERVAL:
+        # read the version before the table, a change in between only causes another reload
+        version = cache_versions.get_version(VERSION_NAME)
+        _checked_at = now
+        if version != _version:
+            _load(version)
+    return _values
+
+
+def invalidate():
+    """
+    called after a setting changed. reloads the table in this process on the next access and in all others after their next version check
+    """
+    global _version
+    cache_versions.bump_version(VERSION_NAME)
+    _version = None
+
+
+def get(type: str) -> str:
+    """
+    the value of a setting, raises Settings.DoesNotExist like Settings.objects.get if there is none
+    """
+    try:
+        return values()[type]
+    except KeyError:
+        # the row might have been created since the table was loaded
+        _load(cache_versions.get_version(VERSION_NAME))
+    try:
+        return _values[type]
+    except KeyError:
+        raise models.Settings.DoesNotExist(f"Settings matching type={type} does not exist")
+
+
+def get_int(type: str) -> int:
+    return int(get(type).replace(' ', ''))
+
+
+def get_list(type: str) -> List[str]:
+    """
+    comma separated values like '1,2,3'
+    """
+    return get(type).replace(' ', '').split(',')
+
+
+def get_time(type: str) -> Tuple[int, int]:
+    """
+    hour and minute of values like '10:30' or '18'
+    """
+    parts = get(type).replace(' ', '').split(':')
+    return int(parts[0]), int(parts[1] if len(parts) > 1 else 0)
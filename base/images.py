@@ -0,0 +1,111 @@
+"""
+scaled down variants of uploaded images, so lists do not load every image in full resolution.
+base.signals schedules base.tasks.generate_image_variants after an image changed, the variants are stored in
+MEDIA_ROOT/variants and their names in the image_variants field of the model, e.g.
+{'source': 'camera.png', 'thumbnail': {'webp': 'variants/camera_1a2b3c4d_thumbnail_320_q80.webp', 'jpeg': ...}, 'medium': {...}}
+"""
+import hashlib
+import io
+import logging
+import os
+from typing import Dict, Type
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import models as django_models
+from PIL import Image, ImageOps
+
+logger = logging.getLogger("django")
+
+# models with an image and an image_variants field
+MODELS = ['base.RentalObjectType', 'base.OnPremiseWorkplace']
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def variants_outdated(instance) -> bool:
+    return bool(instance.image) and instance.image_variants.get('source') != instance.image.name
+
+
+def scaled(image: Image.Image, size: int, file_format: str) -> bytes:
+    variant = image.copy()
+    # never scales up
+    variant.thumbnail((size, size), Image.LANCZOS)
+    if file_format == 'JPEG' and variant.mode != 'RGB':
+        # jpeg has no transparency, transparent parts become white
+        background = Image.new('RGB', variant.size, (255, 255, 255))
+        variant = variant.convert('RGBA')
+        background.paste(variant, mask=variant.split()[-1])
+        variant = background
+    elif variant.mode not in ('RGB', 'RGBA'):
+        variant = variant.convert('RGBA')
+    output = io.BytesIO()
+    if file_format == 'JPEG':
+        variant.save(output, file_format, quality=settings.IMAGE_VARIANT_QUALITY, optimize=True, progressive=True)
+    else:
+        variant.save(output, file_format, quality=settings.IMAGE_VARIANT_QUALITY, method=4)
+    return output.getvalue()
+
+
+def generate_variants(name: str) -> Dict:
+    """
+    creates the variants of the image stored as name. the file names contain a hash of the image, so types sharing
+    an image, e.g. the default nopicture.png, share the variants as well. size and quality are part of the names too,
+    existing files are only reused while IMAGE_VARIANT_SIZES and IMAGE_VARIANT_QUALITY stay the same
+    """
+    with default_storage.open(name, 'rb') as file:
+        content = file.read()
+    stem = os.path.splitext(os.path.basename(name))[0]
+    digest = hashlib.sha1(content).hexdigest()[:8]
+    variants = {'source': name}
+    image = None
+    for variant, size in settings.IMAGE_VARIANT_SIZES.items():
+        variants[variant] = {}
+        for extension, file_format in FORMATS.items():
+            variant_name = f"variants/{stem}_{digest}_{variant}_{size}_q{settings.IMAGE_VARIANT_QUALITY}.{extension}"
+            if not default_storage.exists(variant_name):
+                if image is None:
+                    image = ImageOps.exif_transpose(Image.open(io.BytesIO(content)))
+                variant_name = default_storage.save(variant_name, ContentFile(scaled(image, size, file_format)))
+            variants[variant][extension] = variant_name
+    return variants
+
+
+def variant_names(variants: Dict) -> set:
+    return {name for key, formats in variants.items() if key != 'source' for name in formats.values()}
+
+
+def delete_unused(variants: Dict):
+    """
+    deletes the files of replaced variants that no row uses anymore, rows sharing the image may still use them
+    """
+    if not variants.get('source'):
+        return
+    used = set()
+    for model in MODELS:
+        for other_variants in apps.get_model(model).objects.filter(image_variants__source=variants['source']).values_list('image_variants', flat=True):
+            used |= variant_names(other_variants)
+    for name in variant_names(variants) - used:
+        default_storage.delete(name)
+
+
+def update_variants(model: str, pk: int, force: bool = False) -> bool:
+    """
+    brings the variants of the row up to date with its image, returns whether new variants were generated
+    """
+    model_class: Type[django_models.Model] = apps.get_model(model)
+    instance = model_class.objects.filter(pk=pk).first()
+    if instance is None or not (force or variants_outdated(instance)):
+        return False
+    old_variants = instance.image_variants
+    try:
+        variants = generate_variants(instance.image.name)
+    except (OSError, Image.DecompressionBombError):
+        logger.exception(f"could not generate the variants of {instance.image.name}")
+        return False
+    # update instead of save, so the signals do not schedule the task again
+    model_class.objects.filter(pk=pk, image=instance.image.name).update(image_variants=variants)
+    if variant_names(old_variants) - variant_names(variants):
+        delete_unused(old_variants)
+    return True
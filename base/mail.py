@@ -0,0 +1,135 @@
+"""
+mail outbox. queue_mail stores the mail in base.OutgoingMail inside the current transaction, so it is only sent if the
+change it is about got committed. base.tasks.send_queued_mails delivers the queue over one smtp connection.
+mails that still fail after MAIL_MAX_ATTEMPTS are marked with failed_at and not tried again
+"""
+import logging
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from base import models
+
+logger = logging.getLogger("django")
+
+# key of the postgres advisory lock that serializes claim()
+CLAIM_LOCK = 52150
+
+
+def build_mail(subject: str, message: str, recipient_list: List[str], html_message: Optional[str] = None,
+               from_email: Optional[str] = None) -> models.OutgoingMail:
+    """
+    same arguments as django.core.mail.send_mail, the mail is not saved yet
+    """
+    return models.OutgoingMail(subject=subject, message=message, html_message=html_message,
+                               from_email=from_email or settings.DEFAULT_FROM_EMAIL, recipient_list=list(recipient_list))
+
+
+def queue_mails(mails: List[models.OutgoingMail]) -> List[models.OutgoingMail]:
+    """
+    queues mails of build_mail with one insert
+    """
+    if not mails:
+        return []
+    mails = models.OutgoingMail.objects.bulk_create(mails)
+    transaction.on_commit(schedule_delivery)
+    return mails
+
+
+def queue_mail(subject: str, message: str, recipient_list: List[str], html_message: Optional[str] = None,
+               from_email: Optional[str] = None) -> models.OutgoingMail:
+    """
+    same arguments as django.core.mail.send_mail
+    """
+    return queue_mails([build_mail(subject, message, recipient_list, html_message, from_email)])[0]
+
+
+def schedule_delivery():
+    from base import tasks
+    try:
+        tasks.send_queued_mails.delay()
+    except Exception:
+        # the periodic run of send_queued_mails picks the mail up as well
+        logger.exception("could not schedule the delivery of queued mails")
+
+
+def to_message(mail: models.OutgoingMail, connection) -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(subject=mail.subject, body=mail.message, from_email=mail.from_email,
+                                     to=mail.recipient_list, connection=connection)
+    if mail.html_message:
+        message.attach_alternative(mail.html_message, 'text/html')
+    return message
+
+
+def retry_later(mail: models.OutgoingMail, error: Exception, now):
+    mail.attempts += 1
+    mail.last_error = repr(error)
+    mail.send_after = now + timedelta(seconds=settings.MAIL_RETRY_BACKOFF * 2 ** (mail.attempts - 1))
+    mail.claimed_until = None
+    if mail.attempts >= settings.MAIL_MAX_ATTEMPTS:
+        mail.failed_at = now
+        logger.error(f"giving up on mail {mail.pk} after {mail.attempts} attempts: {mail.last_error}")
+    else:
+        logger.warning(f"sending mail {mail.pk} failed in attempt {mail.attempts}: {mail.last_error}")
+    mail.save(update_fields=['attempts', 'last_error', 'send_after', 'claimed_until', 'failed_at'])
+
+
+def claim() -> List[models.OutgoingMail]:
+    """
+    leases the due mails for MAIL_CLAIM_TIMEOUT seconds to this run, at most MAIL_BATCH_SIZE and only as many as
+    MAIL_RATE_LIMIT_PER_MINUTE allows. mails sent in the last minute and mails leased by other runs count against the
+    limit. the runs claim one after the other, so parallel runs can not exceed it together
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CLAIM_LOCK])
+        now = timezone.now()
+        used = models.OutgoingMail.objects.filter(
+            Q(sent_at__gte=now - timedelta(minutes=1)) | Q(sent_at__isnull=True, claimed_until__gt=now)).count()
+        batch_size = min(settings.MAIL_BATCH_SIZE, settings.MAIL_RATE_LIMIT_PER_MINUTE - used)
+        if batch_size <= 0:
+            return []
+        mails = list(models.OutgoingMail.objects.filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lte=now), sent_at__isnull=True, failed_at__isnull=True,
+            send_after__lte=now, attempts__lt=settings.MAIL_MAX_ATTEMPTS).order_by('send_after')[:batch_size])
+        models.OutgoingMail.objects.filter(pk__in=[mail.pk for mail in mails]).update(
+            claimed_until=now + timedelta(seconds=settings.MAIL_CLAIM_TIMEOUT))
+    return mails
+
+
+def send_queued() -> int:
+    """
+    sends the mails claim() leased to this run. the smtp connection is only opened after the claim is committed, so
+    no database lock waits for the mail server. returns the number of sent mails
+    """
+    mails = claim()
+    if not mails:
+        return 0
+    now = timezone.now()
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+    except Exception as error:
+        for mail in mails:
+            retry_later(mail, error, now)
+        return 0
+    sent = 0
+    try:
+        for mail in mails:
+            try:
+                mail_connection.send_messages([to_message(mail, mail_connection)])
+            except Exception as error:
+                retry_later(mail, error, now)
+                continue
+            mail.sent_at = timezone.now()
+            mail.claimed_until = None
+            mail.save(update_fields=['sent_at', 'claimed_until'])
+            sent += 1
+    finally:
+        mail_connection.close()
+    return sent
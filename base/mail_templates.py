@@ -0,0 +1,52 @@
+"""
+compiled django templates of the Text models used for mails. parsing a template is done once per process and version
+of the Text, saving or deleting a Text increases its version in the cache, see base.signals
+"""
+from typing import Dict, Tuple
+
+from django.template import Context, Template
+
+from base import cache as cache_versions
+from base import models
+
+_templates: Dict[Tuple[str, bool], Tuple[int, Template]] = {}
+
+
+def version_name(name: str) -> str:
+    return f"text:{name}"
+
+
+def unwrap(content: str) -> str:
+    """
+    the editor of the frontend wraps template tags in paragraphs, which breaks loops over table rows
+    """
+    return content.replace(r"%}}</p>", r"%}}").replace(r"<p>{{%", r"{{%")
+
+
+def get_template(name: str, unwrap_tags: bool = False) -> Template:
+    """
+    the compiled template of the Text with this name. checks the version with one cache request, fetch it once
+    instead of once per rendered mail when rendering many
+    """
+    version = cache_versions.get_version(version_name(name))
+    cached = _templates.get((name, unwrap_tags))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    text = models.Text.objects.filter(name=name).first()
+    if text is None:
+        raise models.Text.DoesNotExist(f"Text matching name={name} does not exist")
+    content = text.content or ""
+    template = Template(unwrap(content) if unwrap_tags else content)
+    _templates[(name, unwrap_tags)] = (version, template)
+    return template
+
+
+def render(name: str, data: dict, unwrap_tags: bool = False) -> str:
+    return get_template(name, unwrap_tags).render(Context(data))
+
+
+def invalidate(*names: str):
+    cache_versions.bump_version(*[version_name(name) for name in names])
+    for name in names:
+        _templates.pop((name, False), None)
+        _templates.pop((name, True), None)
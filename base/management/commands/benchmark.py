@@ -0,0 +1,185 @@
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from typing import Callable, Dict, List
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from knox.models import AuthToken
+
+from base import dynamic_settings
+from base import models
+
+ENDPOINTS = ['available', 'catalog', 'bulk_reservation', 'rentals', 'open_rentals', 'slots', 'download_form']
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    nearest rank percentile
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Command(BaseCommand):
+    help = "sends requests to the hot endpoints of the api through the django test client and prints latency and query " \
+           "counts per endpoint as json. the requests commit like real ones, so the cache and the on commit work are " \
+           "measured. the benchmark user is deleted at the end together with its reservations and queued mails. " \
+           "fill the database with generate_test_data first"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help="measured requests per endpoint")
+        parser.add_argument('--warmup', type=int, default=2, help="requests per endpoint before measuring")
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help=f"comma separated subset of {','.join(ENDPOINTS)}")
+        parser.add_argument('--clear-cache', action='store_true', help="clear the cache before every request to measure cold requests")
+        parser.add_argument('--seed', type=int, default=0, help="seed of the random choice of types, workplaces and reservations")
+        parser.add_argument('--output', help="write the json to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        endpoints = [name for name in options['endpoints'].split(',') if name]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"unknown endpoints {', '.join(sorted(unknown))}")
+        self.random = random.Random(options['seed'])
+        performance_logger = logging.getLogger('performance')
+        level = performance_logger.level
+        # one log line per request would drown the results
+        performance_logger.setLevel(logging.WARNING)
+        self.user = None
+        try:
+            with override_settings(ALLOWED_HOSTS=['*']):
+                self.prepare()
+                results = {}
+                for name in endpoints:
+                    request = getattr(self, f'request_{name}')()
+                    if request is None:
+                        results[name] = {'skipped': True}
+                        continue
+                    results[name] = self.measure(request, options['warmup'], options['iterations'], options['clear_cache'])
+        finally:
+            performance_logger.setLevel(level)
+            self.cleanup()
+        report = json.dumps({
+            'iterations': options['iterations'],
+            'database': {'types': len(self.types), 'objects': models.RentalObject.objects.count(),
+                         'reservations': models.Reservation.objects.count(), 'rentals': models.Rental.objects.count(),
+                         'bookings': models.OnPremiseBooking.objects.count()},
+            'endpoints': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def prepare(self):
+        self.types = list(models.RentalObjectType.objects.filter(visible=True).order_by('pk').values_list('pk', flat=True))
+        if not self.types:
+            raise CommandError("there are no visible types, run generate_test_data first")
+        username = f"benchmark-{get_random_string(8)}"
+        # example.invalid can not receive mails, in case the worker sends the confirmations before the cleanup
+        self.user = User.objects.create(username=username, email=f"{username}@example.invalid", is_staff=True, is_superuser=True)
+        models.Profile.objects.create(user=self.user, prio=models.Priority.objects.get_or_create(prio=99, defaults={'name': "unverified"})[0])
+        _, token = AuthToken.objects.create(self.user)
+        self.client = Client(raise_request_exception=False, HTTP_AUTHORIZATION=f"Token {token}")
+        # the next lending day in a week, reservations for it are possible
+        lenting_day, returning_day = dynamic_settings.get_int('lenting_day'), dynamic_settings.get_int('returning_day')
+        day = timezone.localdate() + timedelta(days=7)
+        self.from_date = day + timedelta(days=(lenting_day - day.isoweekday()) % 7)
+        self.until_date = self.from_date + timedelta(days=(returning_day - self.from_date.isoweekday()) % 7 or 7)
+
+    def cleanup(self):
+        """
+        the reservations and the token go with the user, the signals of the deleted reservations update the
+        availability like a cancellation would
+        """
+        if self.user is None:
+            return
+        with transaction.atomic():
+            models.OutgoingMail.objects.filter(recipient_list__contains=[self.user.email], sent_at__isnull=True).delete()
+            self.user.delete()
+
+    def measure(self, request: Callable, warmup: int, iterations: int, clear_cache: bool) -> dict:
+        durations, queries, statuses = [], [], Counter()
+        for iteration in range(warmup + iterations):
+            if clear_cache:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = request()
+                duration = time.perf_counter() - started
+            if iteration < warmup:
+                continue
+            durations.append(duration * 1000)
+            queries.append(len(captured))
+            statuses[str(response.status_code)] += 1
+        return {
+            'requests': iterations,
+            'status': dict(statuses),
+            'p50_ms': round(percentile(durations, 50), 2),
+            'p95_ms': round(percentile(durations, 95), 2),
+            'max_ms': round(max(durations), 2),
+            'mean_ms': round(sum(durations) / len(durations), 2),
+            'queries_p50': percentile(queries, 50),
+            'queries_p95': percentile(queries, 95),
+            'queries_max': max(queries),
+        }
+
+    def date_range(self) -> Dict[str, str]:
+        return {'from_date': self.from_date.isoformat(), 'until_date': (self.until_date + timedelta(weeks=2)).isoformat()}
+
+    def request_available(self):
+        return lambda: self.client.get(f'/api/rentalobjecttypes/{self.random.choice(self.types)}/available/', self.date_range())
+
+    def request_catalog(self):
+        return lambda: self.client.get('/api/rentalobjecttypes/available/', self.date_range())
+
+    def request_bulk_reservation(self):
+        def request():
+            data = {'data': [{'objecttype': pk, 'reserved_from': self.from_date.isoformat(), 'reserved_until': self.until_date.isoformat(), 'count': 1}
+                             for pk in self.random.sample(self.types, min(len(self.types), 3))]}
+            return self.client.post('/api/reservations/bulk/', data, content_type='application/json')
+        return request
+
+    def request_rentals(self):
+        return lambda: self.client.get('/api/rentals/', {'page_size': 100})
+
+    def request_open_rentals(self):
+        return lambda: self.client.get('/api/rentals/', {'open': 'true'})
+
+    def request_slots(self):
+        workplaces = list(models.OnPremiseWorkplace.objects.values_list('pk', flat=True))
+        if not workplaces:
+            return None
+        return lambda: self.client.get(f'/api/workplace/{self.random.choice(workplaces)}/slots/')
+
+    def request_download_form(self):
+        if not models.Files.objects.filter(name='rental_form').exists():
+            return None
+        operations = list(models.Reservation.objects.filter(rental__isnull=False).order_by('-operation_number')
+                          .values_list('operation_number', flat=True).distinct()[:20])
+        if not operations:
+            return None
+        # what the frontend sends for a handed out operation, built up front so it is not measured
+        payloads = []
+        for operation_number in operations:
+            reservations = models.Reservation.objects.filter(operation_number=operation_number).select_related(
+                'reserver__user', 'objecttype').prefetch_related('rental_set')
+            payloads.append([{
+                'id': reservation.pk, 'operation_number': reservation.operation_number, 'count': reservation.count,
+                'reserved_from': reservation.reserved_from.isoformat(), 'reserved_until': reservation.reserved_until.isoformat(),
+                'reserver': {'user': {'first_name': reservation.reserver.user.first_name, 'last_name': reservation.reserver.user.last_name,
+                                      'email': reservation.reserver.user.email}},
+                'objecttype': {'name': reservation.objecttype.name, 'prefix_identifier': reservation.objecttype.prefix_identifier},
+                'selectedObjects': [rental.rented_object_id for rental in reservation.rental_set.all()]} for reservation in reservations])
+        return lambda: self.client.post('/api/reservations/download_form/', self.random.choice(payloads), content_type='application/json')
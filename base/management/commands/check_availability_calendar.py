@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base import availability
+from base import models
+
+
+class Command(BaseCommand):
+    help = "compares the availability calendar with a full recalculation and lists every differing day"
+
+    def handle(self, *args, **options):
+        from_date, until_date = availability.calendar_range()
+        pks = list(models.RentalObjectType.objects.order_by('pk').values_list('pk', flat=True))
+        stored = {(type_id, day): (rentable, occupied) for type_id, day, rentable, occupied in models.AvailabilityCalendar.objects.filter(
+            day__gte=from_date, day__lte=until_date).values_list('object_type_id', 'day', 'rentable', 'occupied')}
+        differences = 0
+        for row in availability.calendar_rows(pks, from_date, until_date):
+            expected = (row.rentable, row.occupied)
+            actual = stored.pop((row.object_type_id, row.day), None)
+            if actual != expected:
+                differences += 1
+                self.stdout.write(f"type {row.object_type_id} on {row.day}: stored (rentable, occupied) {actual}, expected {expected}")
+        for type_id, day in stored:
+            differences += 1
+            self.stdout.write(f"type {type_id} on {day}: stored a row that should not exist")
+        if differences:
+            raise CommandError(f"{differences} days of the availability calendar differ from the recalculation")
+        self.stdout.write(f"the availability calendar matches the recalculation from {from_date} until {until_date}")
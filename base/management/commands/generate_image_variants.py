@@ -0,0 +1,28 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from base import images
+from base import tasks
+
+
+class Command(BaseCommand):
+    help = "creates the scaled down variants of all images that do not have up to date variants yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="create the variants of all images again, e.g. after IMAGE_VARIANT_SIZES changed")
+        parser.add_argument('--queue', action='store_true',
+                            help="let the celery workers create the variants instead of this process")
+
+    def handle(self, *args, **options):
+        generated = 0
+        for model in images.MODELS:
+            for instance in apps.get_model(model).objects.order_by('pk').only('pk', 'image', 'image_variants'):
+                if not (options['force'] or images.variants_outdated(instance)):
+                    continue
+                if options['queue']:
+                    tasks.generate_image_variants.delay(model, instance.pk)
+                    generated += 1
+                elif images.update_variants(model, instance.pk, force=options['force']):
+                    generated += 1
+        self.stdout.write(f"{'queued' if options['queue'] else 'generated'} the image variants of {generated} rows")
@@ -0,0 +1,185 @@
+import random
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from base import availability
+from base import dynamic_settings
+from base import models
+
+# names of the generated rows, used to find them again for --clear
+CATEGORY_NAME = "Testdaten"
+USERNAME = "testuser"
+WORKPLACE_NAME = "Testarbeitsplatz"
+
+
+class Command(BaseCommand):
+    help = "fills the database with synthetic categories, types, objects, reservations, rentals and workplace bookings " \
+           "to measure the api against realistic amounts of data, see the benchmark command"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help="multiplies all amounts, 1 creates about 60 types with 2000 objects and 500 users")
+        parser.add_argument('--years', type=float, default=2.0,
+                            help="reservations are created for this many years into the past")
+        parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+        parser.add_argument('--clear', action='store_true', help="delete previously generated data first")
+        parser.add_argument('--force', action='store_true', help="run although DEBUG is off")
+        parser.add_argument('--batch-size', type=int, default=2000, help="rows per insert")
+
+    def handle(self, *args, **options):
+        if not (settings.DEBUG or options['force']):
+            raise CommandError("refusing to generate test data with DEBUG off, pass --force if this really is a test database")
+        self.random = random.Random(options['seed'])
+        self.scale = options['scale']
+        self.batch_size = options['batch_size']
+        with transaction.atomic():
+            if options['clear']:
+                self.clear()
+            elif models.Category.objects.filter(name__startswith=CATEGORY_NAME).exists():
+                raise CommandError("generated data exists already, pass --clear to replace it")
+            self.prio = models.Priority.objects.get_or_create(prio=99, defaults={'name': "unverified"})[0]
+            profiles, lender = self.create_users()
+            types = self.create_inventory()
+            reservations, rentals, extensions = self.create_reservations(profiles, lender, types, options['years'])
+            bookings = self.create_bookings([profile.user for profile in profiles])
+        # bulk_create skips the signals that keep the calendar and the cached availability up to date
+        from_date, until_date = availability.calendar_range()
+        pks = [object_type.pk for object_type in types]
+        for index in range(0, len(pks), 50):
+            availability.refresh_calendar(pks[index:index + 50], from_date, until_date)
+        availability.invalidate_cache(pks)
+        self.stdout.write(f"created {len(profiles)} users, {len(types)} types with {sum(len(objects) for objects in types.values())} objects, "
+                          f"{reservations} reservations, {rentals} rentals, {extensions} extensions and {bookings} workplace bookings")
+
+    def scaled(self, amount: int) -> int:
+        return max(1, round(amount * self.scale))
+
+    def clear(self):
+        models.Category.objects.filter(name__startswith=CATEGORY_NAME).delete()
+        models.OnPremiseWorkplace.objects.filter(name__startswith=WORKPLACE_NAME).delete()
+        User.objects.filter(username__startswith=USERNAME).delete()
+
+    def create_users(self):
+        users = [User(username=f"{USERNAME}{index}", email=f"{USERNAME}{index}@example.com", first_name="Test",
+                      last_name=str(index), password="!") for index in range(self.scaled(500))]
+        lender = User(username=f"{USERNAME}-lender", email=f"{USERNAME}-lender@example.com", is_staff=True, password="!")
+        User.objects.bulk_create(users + [lender], batch_size=self.batch_size)
+        profiles = models.Profile.objects.bulk_create(
+            [models.Profile(user=user, prio=self.prio, verified=self.random.random() < 0.7) for user in users],
+            batch_size=self.batch_size)
+        return profiles, lender
+
+    def create_inventory(self) -> dict:
+        """
+        returns the objects of every created type by type
+        """
+        categories = models.Category.objects.bulk_create(
+            [models.Category(name=f"{CATEGORY_NAME} {index}") for index in range(self.scaled(8))])
+        types = models.RentalObjectType.objects.bulk_create([
+            models.RentalObjectType(name=f"Testtyp {index}", category=self.random.choice(categories), visible=self.random.random() < 0.9,
+                                    shortdescription="generated", manufacturer="Test", prefix_identifier=f"TD{index}-")
+            for index in range(self.scaled(60))], batch_size=self.batch_size)
+        objects = models.RentalObject.objects.bulk_create([
+            models.RentalObject(type=object_type, internal_identifier=index, rentable=self.random.random() < 0.97)
+            for object_type in types for index in range(self.random.randint(10, 60))], batch_size=self.batch_size)
+        by_type = {object_type: [] for object_type in types}
+        for rental_object in objects:
+            by_type[rental_object.type].append(rental_object)
+        today = timezone.localdate()
+        models.RentalObjectStatus.objects.bulk_create([
+            models.RentalObjectStatus(rental_object=rental_object, reason="defekt", from_date=today - timedelta(days=self.random.randint(0, 60)),
+                                      until_date=today + timedelta(days=self.random.randint(0, 60)))
+            for rental_object in self.random.sample(objects, len(objects) // 50)], batch_size=self.batch_size)
+        return by_type
+
+    def create_reservations(self, profiles, lender, types: dict, years: float):
+        """
+        every lending day gets a number of operations with reservations of one to three types. objects are only
+        reserved while they are free, so the generated data never overbooks a type. reservations that already started
+        are handed out, returned unless they are still running and some of them extended
+        """
+        lenting_day = dynamic_settings.get_int('lenting_day')
+        returning_day = dynamic_settings.get_int('returning_day')
+        today = timezone.localdate()
+        day = today - timedelta(days=int(365 * years))
+        day += timedelta(days=(lenting_day - day.isoweekday()) % 7)
+        # first day every object is free again
+        free_from = {rental_object: day for objects in types.values() for rental_object in objects if rental_object.rentable}
+        operation_number = (models.Reservation.objects.order_by('-operation_number').values_list('operation_number', flat=True).first() or 0) + 1
+        rental_number = (models.Rental.objects.order_by('-rental_number').values_list('rental_number', flat=True).first() or 0) + 1
+        reservations, assigned = [], []
+        while day <= today + timedelta(weeks=8):
+            for _ in range(self.scaled(25)):
+                profile = self.random.choice(profiles)
+                weeks = self.random.choice([1, 1, 1, 2, 2, 3])
+                until = day + timedelta(days=(returning_day - day.isoweekday()) % 7 or 7) + timedelta(weeks=weeks - 1)
+                extended = until + timedelta(weeks=1) if day <= today and self.random.random() < 0.1 else None
+                canceled = timezone.now() if self.random.random() < 0.05 else None
+                for object_type in self.random.sample(list(types), min(len(types), self.random.choice([1, 1, 2, 3]))):
+                    free = [rental_object for rental_object in types[object_type]
+                            if rental_object in free_from and free_from[rental_object] <= day]
+                    count = min(self.random.randint(1, 3), len(free))
+                    if count == 0:
+                        continue
+                    selected = self.random.sample(free, count) if canceled is None else []
+                    for rental_object in selected:
+                        free_from[rental_object] = (extended or until) + settings.DEFAULT_OFFSET_BETWEEN_RENTALS + timedelta(days=1)
+                    reservations.append(models.Reservation(reserver=profile, reserved_from=day, reserved_until=until, objecttype=object_type,
+                                                           operation_number=operation_number, count=count, canceled=canceled))
+                    assigned.append((selected, rental_number, extended))
+                operation_number += 1
+                rental_number += 1
+            day += timedelta(weeks=1)
+        models.Reservation.objects.bulk_create(reservations, batch_size=self.batch_size)
+
+        rentals, extended_rentals = [], []
+        zone = timezone.get_current_timezone()
+        for reservation, (selected, number, extended) in zip(reservations, assigned):
+            if reservation.reserved_from > today:
+                continue
+            returned_on = extended or reservation.reserved_until
+            for rental_object in selected:
+                rental = models.Rental(rented_object=rental_object, reservation=reservation, rental_number=number, lender=lender,
+                                       handed_out_at=datetime.combine(reservation.reserved_from, time(settings.DEFAULT_LENTING_START_HOUR), zone),
+                                       received_back_at=datetime.combine(returned_on, time(settings.DEFAULT_RETURNING_START_HOUR), zone) if returned_on < today else None)
+                rentals.append(rental)
+                if extended is not None:
+                    extended_rentals.append((rental, reservation.reserved_until, extended))
+        models.Rental.objects.bulk_create(rentals, batch_size=self.batch_size)
+        models.Extension.objects.bulk_create([
+            models.Extension(extended_rental=rental, extended_from=extended_from, extended_until=extended_until, extended_by=lender)
+            for rental, extended_from, extended_until in extended_rentals], batch_size=self.batch_size)
+        return len(reservations), len(rentals), len(extended_rentals)
+
+    def create_bookings(self, users) -> int:
+        """
+        bookings of the workplaces for the last 90 days and the days that can be booked at the moment
+        """
+        workplaces = models.OnPremiseWorkplace.objects.bulk_create(
+            [models.OnPremiseWorkplace(name=f"{WORKPLACE_NAME} {index}") for index in range(self.scaled(6))])
+        zone = timezone.get_current_timezone()
+        today = timezone.localdate()
+        bookings, statuses = [], []
+        for workplace in workplaces:
+            for offset in range(-90, 14):
+                day = today + timedelta(days=offset)
+                if day.isoweekday() > 5:
+                    continue
+                start = datetime.combine(day, time(9), zone)
+                while start.hour < 17:
+                    end = start + timedelta(minutes=90)
+                    if self.random.random() < 0.5:
+                        bookings.append(models.OnPremiseBooking(user=self.random.choice(users), workplace=workplace, slot_start=start, slot_end=end,
+                                                                showed_up=day < today, canceled=timezone.now() if self.random.random() < 0.1 else None))
+                    start = end + timedelta(minutes=15)
+            status_start = datetime.combine(today + timedelta(days=self.random.randint(0, 14)), time(9), zone)
+            statuses.append(models.OnPremiseWorkplaceStatus(workplace=workplace, from_date=status_start,
+                                                            until_date=status_start + timedelta(days=1), reason="Wartung"))
+        models.OnPremiseBooking.objects.bulk_create(bookings, batch_size=self.batch_size)
+        models.OnPremiseWorkplaceStatus.objects.bulk_create(statuses)
+        return len(bookings)
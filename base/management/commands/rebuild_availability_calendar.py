@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from base import availability
+from base import models
+
+
+class Command(BaseCommand):
+    help = "recalculates the whole availability calendar from reservations, rentals and status"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=50,
+                            help="number of types that are calculated at once")
+
+    def handle(self, *args, **options):
+        from_date, until_date = availability.calendar_range()
+        pks = list(models.RentalObjectType.objects.order_by('pk').values_list('pk', flat=True))
+        with transaction.atomic():
+            models.AvailabilityCalendar.objects.all().delete()
+            for index in range(0, len(pks), options['chunk_size']):
+                availability.refresh_calendar(pks[index:index + options['chunk_size']], from_date, until_date)
+        self.stdout.write(f"rebuilt the availability calendar for {len(pks)} types from {from_date} until {until_date}")
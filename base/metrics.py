@@ -0,0 +1,73 @@
+"""
+prometheus metrics of the api and the celery tasks, served at /metrics.
+api requests are observed by api.middleware.PerformanceMiddleware, labeled with the url prefix of the viewset and
+the action, e.g. reservations.bulk_create. celery tasks are observed through the signals of celery below.
+
+gunicorn workers and celery worker processes each have their own metrics. to add them up set the environment
+variable PROMETHEUS_MULTIPROC_DIR to an empty directory shared by all processes before they start (clear it on
+every deploy). gunicorn has to call base.metrics.process_exited(worker.pid) from its child_exit hook, celery
+worker processes are handled here
+"""
+import os
+import time
+from typing import Dict
+
+from celery import signals as celery_signals
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+REQUEST_DURATION = Histogram('api_request_duration_seconds', 'duration of api requests', ['action', 'method'])
+REQUESTS = Counter('api_requests', 'api requests by status class', ['action', 'method', 'status'])
+REQUEST_ERRORS = Counter('api_request_errors', 'api requests that failed with a server error', ['action', 'method'])
+REQUEST_QUERIES = Histogram('api_request_queries', 'database queries per api request', ['action', 'method'],
+                            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')))
+TASK_DURATION = Histogram('celery_task_duration_seconds', 'duration of celery tasks', ['task'],
+                          buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf')))
+TASKS = Counter('celery_tasks', 'finished celery tasks by outcome', ['task', 'outcome'])
+
+
+def multiprocess_mode() -> bool:
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+def observe_request(action: str, method: str, status: int, duration: float, queries: int):
+    REQUEST_DURATION.labels(action, method).observe(duration)
+    REQUESTS.labels(action, method, f"{status // 100}xx").inc()
+    REQUEST_QUERIES.labels(action, method).observe(queries)
+    if status >= 500:
+        REQUEST_ERRORS.labels(action, method).inc()
+
+
+def render() -> bytes:
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def process_exited(pid: int):
+    if multiprocess_mode():
+        multiprocess.mark_process_dead(pid)
+
+
+# start of the running tasks of this process by task id
+_task_starts: Dict[str, float] = {}
+
+
+@celery_signals.task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _task_starts[task_id] = time.perf_counter()
+
+
+@celery_signals.task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_starts.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name).observe(time.perf_counter() - started)
+    TASKS.labels(task.name, (state or 'unknown').lower()).inc()
+
+
+@celery_signals.worker_process_shutdown.connect
+def worker_process_exited(**kwargs):
+    process_exited(os.getpid())
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2023-07-20 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0080_alter_rental_handed_out_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvailabilityCalendar',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('rentable', models.IntegerField()),
+                ('occupied', models.IntegerField()),
+                ('object_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calendar', to='base.rentalobjecttype')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='availabilitycalendar',
+            constraint=models.UniqueConstraint(fields=('object_type', 'day'), name='unique_calendar_day'),
+        ),
+    ]
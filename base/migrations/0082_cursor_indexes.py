@@ -0,0 +1,25 @@
+# Generated by Django 4.2.3 on 2023-07-24 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0081_availabilitycalendar'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['reserved_from', 'id'], name='reservation_cursor'),
+        ),
+        migrations.AddIndex(
+            model_name='rental',
+            index=models.Index(fields=['rental_number', 'id'], name='rental_cursor'),
+        ),
+        migrations.AddIndex(
+            model_name='onpremisebooking',
+            index=models.Index(fields=['slot_start', 'id'], name='onpremisebooking_cursor'),
+        ),
+    ]
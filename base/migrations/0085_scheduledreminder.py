@@ -0,0 +1,64 @@
+# Generated by Django 4.2.3 on 2023-07-28 16:35
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def local_datetime(day, hour=0):
+    return timezone.make_aware(datetime.combine(day, time(hour)))
+
+
+def schedule_open_reminders(apps, schema_editor):
+    """
+    reminders for everything the removed 30 minute scan would still have notified about
+    """
+    Reservation = apps.get_model('base', 'Reservation')
+    Rental = apps.get_model('base', 'Rental')
+    Extension = apps.get_model('base', 'Extension')
+    Settings = apps.get_model('base', 'Settings')
+    ScheduledReminder = apps.get_model('base', 'ScheduledReminder')
+    today = timezone.localdate()
+    setting = Settings.objects.filter(type='returning_end_hour').first()
+    returning_end_hour = int(setting.value) if setting else settings.DEFAULT_RETURNING_END_HOUR
+
+    reminders = [ScheduledReminder(kind='reservation_start', reservation_id=pk, due_at=local_datetime(reserved_from - timedelta(days=1)))
+                 for pk, reserved_from in Reservation.objects.filter(canceled__isnull=True, notified__isnull=True, reserved_from__gte=today).values_list('pk', 'reserved_from')]
+    latest_extension = Extension.objects.filter(extended_rental=models.OuterRef('pk')).order_by('-extended_until').values('extended_until')[:1]
+    rentals = Rental.objects.filter(handed_out_at__isnull=False, received_back_at__isnull=True).annotate(
+        extended_until_date=Coalesce(models.Subquery(latest_extension), models.F('reservation__reserved_until'))).filter(
+        extended_until_date__gte=today)
+    for pk, extended_until, notified in rentals.values_list('pk', 'extended_until_date', 'notified'):
+        if notified is None and extended_until - timedelta(days=2) >= today:
+            reminders.append(ScheduledReminder(kind='rental_expiration', rental_id=pk, due_at=local_datetime(extended_until - timedelta(days=2))))
+        reminders.append(ScheduledReminder(kind='rental_missing', rental_id=pk, due_at=local_datetime(extended_until, returning_end_hour)))
+    ScheduledReminder.objects.bulk_create(reminders)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0083_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledReminder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('reservation_start', 'tell the lender about a reservation one day in advance'), ('rental_expiration', 'remind the renter to return the objects in two days'), ('rental_missing', 'tell the lender about objects that were not returned on the last day')], max_length=30)),
+                ('due_at', models.DateTimeField()),
+                ('sent_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('rental', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.rental')),
+                ('reservation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.reservation')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['due_at'], name='scheduledreminder_pending')],
+            },
+        ),
+        migrations.RunPython(schedule_open_reminders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.3 on 2023-08-01 09:12
+
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def store_pending_tokens(apps, schema_editor):
+    """
+    the links of accounts that are not validated yet contain the sha256 of date_joined, username and salt
+    """
+    User = apps.get_model('auth', 'User')
+    EmailValidationToken = apps.get_model('base', 'EmailValidationToken')
+    tokens = []
+    for user in User.objects.filter(is_active=False, last_login__isnull=True):
+        token = hashlib.sha256((str(user.date_joined) + user.username + settings.EMAIL_VALIDATION_HASH_SALT).encode("utf-8")).hexdigest()
+        tokens.append(EmailValidationToken(user=user, token_hash=hashlib.sha256(token.encode("utf-8")).hexdigest()))
+    EmailValidationToken.objects.bulk_create(tokens)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('base', '0085_scheduledreminder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailValidationToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_hash', models.CharField(max_length=64, unique=True)),
+                ('creation_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='email_validation_token', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(store_pending_tokens, migrations.RunPython.noop),
+    ]
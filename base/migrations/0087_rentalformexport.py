@@ -0,0 +1,32 @@
+# Generated by Django 4.2.3 on 2023-08-02 10:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('base', '0086_emailvalidationtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RentalFormExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('lending_date', models.DateField(blank=True, default=None, null=True)),
+                ('operation_numbers', models.JSONField(blank=True, default=list)),
+                ('status', models.CharField(choices=[('pending', 'waiting for a worker'), ('running', 'rendering the forms'), ('done', 'zip is ready for download'), ('failed', 'rendering failed')], default='pending', max_length=10)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('rendered', models.PositiveIntegerField(default=0)),
+                ('file', models.FileField(blank=True, default=None, null=True, upload_to='rental_form_exports/')),
+                ('error', models.TextField(blank=True, default='')),
+                ('finished_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
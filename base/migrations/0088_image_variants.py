@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2023-08-03 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0087_rentalformexport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='onpremiseworkplace',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='rentalobjecttype',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
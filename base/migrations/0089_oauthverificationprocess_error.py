@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2023-08-04 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0088_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oauthverificationprocess',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_exhausted_mails(apps, schema_editor):
+    # mails that used up their attempts before failed_at existed
+    OutgoingMail = apps.get_model('base', 'OutgoingMail')
+    OutgoingMail.objects.filter(sent_at__isnull=True, attempts__gte=settings.MAIL_MAX_ATTEMPTS).update(failed_at=F('send_after'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0089_oauthverificationprocess_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.RunPython(mark_exhausted_mails, migrations.RunPython.noop),
+    ]
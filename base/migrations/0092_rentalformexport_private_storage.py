@@ -0,0 +1,17 @@
+import base.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0090_outgoingmail_claim'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rentalformexport',
+            name='file',
+            field=models.FileField(blank=True, default=None, null=True, storage=base.storage.private_storage, upload_to='rental_form_exports/'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0092_rentalformexport_private_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oauthverificationprocess',
+            name='polling_until',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    the user list is paginated by (-date_joined, -id), auth.User belongs to django so the index is created by hand
+    """
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('base', '0093_oauthverificationprocess_polling_until'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX IF NOT EXISTS "user_cursor" ON "auth_user" ("date_joined", "id")',
+            reverse_sql='DROP INDEX IF EXISTS "user_cursor"',
+        ),
+    ]
@@ -1,5 +1,7 @@
+import hashlib
 from typing import Iterable, Optional
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from datetime import datetime
@@ -9,6 +11,8 @@ from datetime import timedelta, date
 from django.forms import model_to_dict
 import logging
 
+from base.storage import private_storage
+
 
 logger = logging.getLogger(name="django")
 
@@ -69,7 +73,22 @@ class Tag(models.Model):
         return self.name
 
 
-class RentalObjectType(models.Model):
+class LoadedValuesModel(models.Model):
+    """
+    remembers the field values the row was loaded with, so signals can tell which fields changed without fetching
+    the stored row again, see base.signals.remember_availability_ranges
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
+class RentalObjectType(LoadedValuesModel):
     """
     Parenttype for objects
     """
@@ -89,6 +108,8 @@ class RentalObjectType(models.Model):
     # hide objects from rentalpage
     visible = models.BooleanField(default=False)
     image = models.ImageField(default='nopicture.png')
+    # scaled down versions of image, see base.images
+    image_variants = models.JSONField(default=dict, blank=True)
     prefix_identifier = models.CharField(max_length=20, default="LZ")
     tags = models.ManyToManyField(Tag, blank=True)
 
@@ -96,55 +117,11 @@ class RentalObjectType(models.Model):
         return self.name
 
     def available(pk: int, from_date: datetime, until_date: datetime):
-        if isinstance(from_date, date):
-            from_date = datetime.combine(
-                from_date, datetime.min.time(), tzinfo=timezone.get_current_timezone())
-        if isinstance(until_date, date):
-            until_date = datetime.combine(
-                until_date, datetime.min.time(), tzinfo=timezone.get_current_timezone())
-        delta = until_date - from_date
-        offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
-        # get all "defect" status for this type
-        object_status = RentalObjectStatus.objects.all().filter(from_date__lte=until_date, until_date__gte=from_date,
-                                                                rentable=False, rental_object__in=RentalObject.objects.filter(type=pk))
-        # remove all objects with an status from objects
-        objects = RentalObject.objects.all().filter(
-            type=pk).exclude(rentable=False).exclude(rentalobjectstatus__in=object_status)
-        # exclude reservations that are already related to an rental also exclude them from counting if they are canceled
-        reservations = Reservation.objects.filter(
-            objecttype_id=pk, reserved_from__lte=until_date.date(), reserved_until__gte=from_date.date()).exclude(rental__in=Rental.objects.filter(rented_object__type=pk)).exclude(canceled__isnull=False)
-        rentals = Rental.objects.filter(
-            rented_object__in=objects, handed_out_at__lte=until_date)
-        rentals = [r for r in rentals if r.extended_until() <= from_date.date()]
-        count = len(objects)
-
-        # give reservations + rentals them common keys for the dates
-        normalized_list = [{**model_to_dict(x), 'from_date': x.handed_out_at.date(
-        ), 'until_date': x.extended_until()} for x in rentals]
-        # normalized_list = [ for x in reservations]
-        for reservation in reservations:
-            for _ in range(reservation.count):
-                normalized_list.append(
-                    {**model_to_dict(reservation), 'from_date': reservation.reserved_from, 'until_date': reservation.reserved_until})
-        ret = {}
-        max_value = 0
-        for day_diff in range(delta.days+1):
-            current_date = (from_date + timedelta(days=day_diff)).date()
-            temp_value = 0
-            for blocked_timerange in normalized_list:
-                # calculate offset
-                until_date_with_offset = (
-                    blocked_timerange['until_date']+offset)
-                if until_date_with_offset.isoweekday() != settings.DEFAULT_LENTING_DAY_OF_WEEK:
-                    # since weekday is not a Lenting day we extend the "occupied/lended" state until the next lenting day
-                    until_date_with_offset += timedelta(days=7-abs(
-                        until_date_with_offset.isoweekday()-settings.DEFAULT_LENTING_DAY_OF_WEEK))
-                if blocked_timerange['from_date'] <= current_date < blocked_timerange['until_date'] + offset:
-                    temp_value += 1
-            max_value = temp_value if temp_value > max_value else max_value
-            ret[str(current_date)] = count-temp_value
-        ret['available'] = count-max_value
-        return ret
+        """
+        returns the free objects of this type for every day between from_date and until_date and the minimum of those as 'available'
+        """
+        from base import availability
+        return availability.available(pk, from_date, until_date)
 
     def max_rent_duration(pk, prio: Priority):
         object_type = RentalObjectType.objects.get(id=pk)
@@ -167,7 +144,18 @@ class RentalObjectType(models.Model):
 
 
 
-class RentalObject(models.Model):
+class RentalObjectQuerySet(models.QuerySet):
+    def with_in_house(self):
+        """
+        annotates in_house, false while the object is handed out and not yet received back
+        """
+        now = timezone.now()
+        handed_out = Rental.objects.filter(rented_object=models.OuterRef('pk'), handed_out_at__lte=now).filter(
+            models.Q(received_back_at__gte=now) | models.Q(received_back_at__isnull=True))
+        return self.annotate(in_house=~models.Exists(handed_out))
+
+
+class RentalObject(LoadedValuesModel):
     class Meta:
         constraints = [
             models.UniqueConstraint(name='unique_identifier', fields=[
@@ -182,11 +170,13 @@ class RentalObject(models.Model):
     # together with prefix_identifier from type class the short internal identifier e.g. LZ1
     internal_identifier = models.IntegerField()
 
+    objects = RentalObjectQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.type.name + " " + str(self.type.prefix_identifier) + str(self.internal_identifier)
 
 
-class RentalObjectStatus(models.Model):
+class RentalObjectStatus(LoadedValuesModel):
     """
     A Status to prevent a Rentalobject to be rent. for example planned maintenance. defaults to now until infinity.
     """
@@ -208,7 +198,16 @@ class RentalObjectStatus(models.Model):
         return str(self.rental_object.__str__()) + " status"
 
 
-class Reservation(models.Model):
+class ReservationQuerySet(models.QuerySet):
+    def with_fullfilled(self):
+        """
+        annotates has_rental and has_handed_out_rental, so serializers do not have to query the rentals of every reservation
+        """
+        rentals = Rental.objects.filter(reservation=models.OuterRef('pk'))
+        return self.annotate(has_rental=models.Exists(rentals), has_handed_out_rental=models.Exists(rentals.filter(handed_out_at__isnull=False)))
+
+
+class Reservation(LoadedValuesModel):
     class Meta:
         constraints = [
             models.CheckConstraint(
@@ -216,6 +215,10 @@ class Reservation(models.Model):
                 name="reservation_reserved_from_date_lte_reserved_until"
             )
         ]
+        # ordering of the cursor pagination
+        indexes = [
+            models.Index(fields=['reserved_from', 'id'], name='reservation_cursor'),
+        ]
     reserver = models.ForeignKey(
         Profile, on_delete=models.CASCADE, related_name='reserver')
     reserved_at = models.DateTimeField(auto_now_add=True)
@@ -227,11 +230,32 @@ class Reservation(models.Model):
     canceled = models.DateTimeField(null=True, blank=True, default=None)
     notified = models.DateTimeField(null=True, blank=True, default=None)
 
+    objects = ReservationQuerySet.as_manager()
+
     def __str__(self) -> str:
         return 'reservation: ' + str(self.operation_number)
 
 
-class Rental(models.Model):
+class RentalQuerySet(models.QuerySet):
+    def with_extended_until(self):
+        """
+        annotates extended_until_date, the end of the latest extension or the end of the reservation if the rental never got extended.
+        can be filtered on like a normal field
+        """
+        latest_extension = Extension.objects.filter(
+            extended_rental=models.OuterRef('pk')).order_by('-extended_until').values('extended_until')[:1]
+        return self.annotate(extended_until_date=Coalesce(models.Subquery(latest_extension), models.F('reservation__reserved_until')))
+
+    def with_extension_count(self):
+        """
+        annotates extension_count, the number of extensions of the rental
+        """
+        extensions = Extension.objects.filter(extended_rental=models.OuterRef('pk')).order_by().values('extended_rental').annotate(
+            count=models.Count('id')).values('count')
+        return self.annotate(extension_count=Coalesce(models.Subquery(extensions), 0))
+
+
+class Rental(LoadedValuesModel):
     class Meta:
         constraints = [
             models.CheckConstraint(
@@ -240,6 +264,9 @@ class Rental(models.Model):
                 name="rental_handed_out_lte_received_date"
             ),
         ]
+        indexes = [
+            models.Index(fields=['rental_number', 'id'], name='rental_cursor'),
+        ]
     rented_object = models.ForeignKey(RentalObject, on_delete=models.CASCADE)
     lender = models.ForeignKey(User, blank=True, null=True,
                                default=None, on_delete=models.CASCADE, related_name='lender')
@@ -252,6 +279,8 @@ class Rental(models.Model):
     reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE)
     notified = models.DateTimeField(null=True, blank=True, default=None)
 
+    objects = RentalQuerySet.as_manager()
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None) -> None:
         # check if the inserted rented object is the same type as the type required from the reservation
         if self.reservation.objecttype.pk != self.rented_object.type.pk:
@@ -259,15 +288,18 @@ class Rental(models.Model):
         return super().save(force_insert, force_update, using, update_fields)
 
     def extended_until(self) -> date:
-        currentend = self.reservation.reserved_until
-        if self.extension_set.count()>0:
-            currentend = self.extension_set.order_by('-extended_until').first().extended_until
-        return currentend     
+        """
+        uses the annotation of Rental.objects.with_extended_until() if the rental got fetched with it
+        """
+        if 'extended_until_date' in self.__dict__:
+            return self.extended_until_date
+        currentend = self.extension_set.aggregate(models.Max('extended_until'))['extended_until__max']
+        return currentend if currentend is not None else self.reservation.reserved_until
 
     def __str__(self) -> str:
         return 'Rental: ' + str(self.rental_number)
     
-class Extension(models.Model):
+class Extension(LoadedValuesModel):
     """
     model to save extensions more verbose
     """
@@ -277,6 +309,55 @@ class Extension(models.Model):
     extended_by = models.ForeignKey(User, on_delete=models.CASCADE)
     extended_rental = models.ForeignKey(Rental, on_delete=models.CASCADE)
 
+
+class ScheduledReminder(models.Model):
+    """
+    a notification mail that is due at a fixed time. created and moved by base.signals whenever its reservation or rental
+    changes and sent by base.tasks.send_due_reminders
+    """
+    RESERVATION_START = 'reservation_start'
+    RENTAL_EXPIRATION = 'rental_expiration'
+    RENTAL_MISSING = 'rental_missing'
+    KIND_CHOICES = [
+        (RESERVATION_START, 'tell the lender about a reservation one day in advance'),
+        (RENTAL_EXPIRATION, 'remind the renter to return the objects in two days'),
+        (RENTAL_MISSING, 'tell the lender about objects that were not returned on the last day'),
+    ]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['due_at'], name='scheduledreminder_pending', condition=models.Q(sent_at__isnull=True))
+        ]
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    reservation = models.ForeignKey(Reservation, null=True, blank=True, on_delete=models.CASCADE)
+    rental = models.ForeignKey(Rental, null=True, blank=True, on_delete=models.CASCADE)
+    due_at = models.DateTimeField()
+    sent_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self) -> str:
+        return f"{self.kind} at {self.due_at}"
+
+
+class AvailabilityCalendar(models.Model):
+    """
+    precalculated availability of a type per day, used if AVAILABILITY_BACKEND is 'calendar'.
+    kept up to date by base.signals, can be rebuilt with manage.py rebuild_availability_calendar
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name='unique_calendar_day',
+                fields=['object_type', 'day']
+            )
+        ]
+    object_type = models.ForeignKey(
+        RentalObjectType, on_delete=models.CASCADE, related_name='calendar')
+    day = models.DateField()
+    # rentable objects without a "defect" status on this day
+    rentable = models.IntegerField()
+    # objects blocked by reservations and rentals on this day
+    occupied = models.IntegerField()
+
 class OnPremiseBlockedTimes(models.Model):
     """
     To block specific days e.g. someone is ill
@@ -294,11 +375,15 @@ class OnPremiseWorkplace(models.Model):
     shortdescription = models.TextField(default='')
     displayed = models.BooleanField(default=True)
     image = models.ImageField(default='nopicture.png')
+    # scaled down versions of image, see base.images
+    image_variants = models.JSONField(default=dict, blank=True)
     exclusions = models.ManyToManyField('OnPremiseWorkplace', blank=True)
     #suggested_types = models.ManyToManyField(RentalObjectType)
 
 
 class OnPremiseBooking(models.Model):
+    class Meta:
+        indexes = [models.Index(fields=['slot_start', 'id'], name='onpremisebooking_cursor')]
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     showed_up = models.BooleanField(blank=True, default=False)
     workplace = models.ForeignKey(OnPremiseWorkplace, on_delete=models.CASCADE)
@@ -375,6 +460,20 @@ class PasswordReset(models.Model):
     hash = models.CharField(max_length=1024)
     creation_date = models.DateTimeField(default=timezone.now)
 
+class EmailValidationToken(models.Model):
+    """
+    token of the validation link sent at signup. only the sha256 of the token is stored, so the link can be checked
+    with one indexed lookup without keeping usable tokens in the database
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='email_validation_token')
+    token_hash = models.CharField(max_length=64, unique=True)
+    creation_date = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def hash_token(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
 class MaxRentDuration(models.Model):
     class Meta:
         constraints = [
@@ -397,6 +496,37 @@ class Files(models.Model):
         return self.name
 
 
+class RentalFormExport(models.Model):
+    """
+    zip with the rental forms of several operations, rendered by the celery task base.tasks.export_rental_forms.
+    covers all reservations starting on lending_date or the given operation_numbers
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'waiting for a worker'),
+        (RUNNING, 'rendering the forms'),
+        (DONE, 'zip is ready for download'),
+        (FAILED, 'rendering failed'),
+    ]
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    lending_date = models.DateField(null=True, blank=True, default=None)
+    operation_numbers = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # number of forms in the export and how many of them are rendered already
+    total = models.PositiveIntegerField(default=0)
+    rendered = models.PositiveIntegerField(default=0)
+    file = models.FileField(upload_to='rental_form_exports/', storage=private_storage, null=True, blank=True, default=None)
+    error = models.TextField(blank=True, default="")
+    finished_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self) -> str:
+        return f"rental forms {self.lending_date or self.operation_numbers} ({self.status})"
+
+
 class OauthVerificationProcess(models.Model):
     # since we do not need the Process if a user gets deleted 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -410,6 +540,39 @@ class OauthVerificationProcess(models.Model):
     access_token_exipiry = models.DateTimeField(null=True, blank=True, default=None)
     refresh_token = models.CharField(max_length=130, null=True, blank=True)
     faculty = models.CharField(max_length=100)
+    # set by base.oauth if the provider could not tell whether the user is verifiable
+    error = models.TextField(blank=True, default="")
+    # lease of the scheduled poll of base.oauth, a new one is only scheduled after it expired
+    polling_until = models.DateTimeField(null=True, blank=True, default=None)
+
+
+class OutgoingMail(models.Model):
+    """
+    outbox for mails. created in the same transaction as the change the mail is about and sent by the celery task
+    base.tasks.send_queued_mails, so requests never wait for the mail server
+    """
+    class Meta:
+        indexes = [
+            models.Index(fields=['send_after'], name='outgoingmail_pending', condition=models.Q(sent_at__isnull=True))
+        ]
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(null=True, blank=True, default=None)
+    from_email = models.CharField(max_length=255)
+    recipient_list = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # postponed after failed attempts
+    send_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True, default=None)
+    last_error = models.TextField(blank=True, default="")
+    # leased to a run of base.mail.send_queued until then
+    claimed_until = models.DateTimeField(null=True, blank=True, default=None)
+    # given up after MAIL_MAX_ATTEMPTS
+    failed_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self) -> str:
+        return self.subject + ' to ' + ', '.join(self.recipient_list)
 
 
 # class Notification(models.Model):
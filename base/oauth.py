@@ -0,0 +1,175 @@
+"""
+device flow verification against the oauth provider of OAUTH_CLIENTS['oauth']. the provider is only called from here,
+with one pooled session per process and timeouts, so a slow provider can not block a worker for long.
+after the device code is requested base.tasks.poll_oauth_verification asks the provider for the access token every
+ping_interval until the user finished the process or it expired, the api only reads OauthVerificationProcess.
+polling_until is the lease of the scheduled poll, there is only one chain of polls per process
+"""
+import logging
+from datetime import timedelta
+from typing import Optional
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from base import models
+
+logger = logging.getLogger("django")
+
+# added to the countdown of a scheduled poll for its lease, covers the queue and the calls to the provider
+POLL_LEASE_MARGIN = timedelta(minutes=1)
+
+_session: Optional[requests.Session] = None
+
+
+def session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # only failed connections are retried, a post that reached the provider is not sent twice
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.OAUTH_POOL_SIZE,
+                              max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5))
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def client_settings() -> dict:
+    return settings.OAUTH_CLIENTS['oauth']
+
+
+def start(user: User) -> models.OauthVerificationProcess:
+    """
+    requests a device code and schedules the polling for the access token
+    """
+    response = session().post(client_settings()['OAUTH_AUTHORIZATION_CODE_URL'], timeout=settings.OAUTH_TIMEOUT,
+                              data={"client_id": client_settings()['client_id'], 'scope': client_settings()['scope']})
+    response.raise_for_status()
+    data = response.json()
+    ping_interval = timedelta(seconds=data['interval'])
+    # no transaction is open while waiting for the provider
+    with transaction.atomic():
+        process = models.OauthVerificationProcess.objects.create(
+            device_code=data['device_code'],
+            user_code=data['user_code'],
+            ping_interval=ping_interval,
+            verification_process_expires=timezone.now() + timedelta(seconds=data['expires_in']),
+            last_ping=timezone.now(),
+            polling_until=timezone.now() + ping_interval + POLL_LEASE_MARGIN,
+            user=user)
+        transaction.on_commit(lambda: schedule_poll(process.pk, ping_interval))
+    return process
+
+
+def schedule_poll(pk: int, countdown: timedelta):
+    """
+    schedules the next poll of the chain, the caller holds the lease
+    """
+    from base import tasks
+    models.OauthVerificationProcess.objects.filter(pk=pk).update(polling_until=timezone.now() + countdown + POLL_LEASE_MARGIN)
+    try:
+        tasks.poll_oauth_verification.apply_async((pk,), countdown=countdown.total_seconds())
+    except Exception:
+        # the status endpoint schedules it again once the lease expired
+        logger.exception(f"could not schedule polling of oauth verification {pk}")
+
+
+def polling_stalled(process: models.OauthVerificationProcess) -> bool:
+    """
+    the process is not finished but its lease expired, e.g. because the worker was restarted while the task waited
+    """
+    now = timezone.now()
+    return (process.access_token is None or bool(process.error)) and process.verification_process_expires > now \
+        and (process.polling_until is None or process.polling_until < now)
+
+
+def resume_polling(process: models.OauthVerificationProcess):
+    """
+    starts a new chain of polls for a stalled process. only the caller that takes over the expired lease schedules it,
+    concurrent calls of the status endpoint do not start a chain each
+    """
+    now = timezone.now()
+    taken = models.OauthVerificationProcess.objects.filter(pk=process.pk).filter(
+        Q(polling_until__isnull=True) | Q(polling_until__lt=now)).update(polling_until=now + POLL_LEASE_MARGIN)
+    if taken:
+        transaction.on_commit(lambda: schedule_poll(process.pk, timedelta()))
+
+
+def fetch_access_token(process: models.OauthVerificationProcess) -> bool:
+    """
+    asks the provider whether the user finished the process, returns whether the access token was received
+    """
+    response = session().post(client_settings()['OAUTH_ACCESS_TOKEN_URL'], timeout=settings.OAUTH_TIMEOUT, data={
+        "client_id": client_settings()['client_id'], "code": process.device_code, "grant_type": "device"})
+    data = response.json()
+    process.last_ping = timezone.now()
+    if data.get('error') == 'slow_down':
+        # the provider wants to be asked less often
+        process.ping_interval += timedelta(seconds=5)
+    if data.get('access_token') is None:
+        process.save(update_fields=['last_ping', 'ping_interval'])
+        return False
+    process.access_token = data['access_token']
+    process.refresh_token = data['refresh_token']
+    process.access_token_exipiry = timezone.now() + timedelta(seconds=data['expires_in'])
+    process.save(update_fields=['last_ping', 'ping_interval', 'access_token', 'refresh_token', 'access_token_exipiry'])
+    return True
+
+
+def verify_profile(process: models.OauthVerificationProcess) -> bool:
+    """
+    gets the data of the user from the provider and verifies the profile if it matches OAUTH_DATA_KEY and OAUTH_DATA_VALUE.
+    returns False if the provider answered with an error, the data is asked for again with the next poll
+    """
+    response = session().get(client_settings()['OAUTH_VERIFICATIONDATA_ENDPOINT'] + process.access_token, timeout=settings.OAUTH_TIMEOUT)
+    userdata = response.json()
+    if userdata["IsError"]:
+        process.error = "there was an error while calling the api. please write an message to us"
+        process.save(update_fields=['error'])
+        logger.warning(f"verification data of user {process.user_id} could not be fetched: {userdata}")
+        return False
+    if process.error:
+        process.error = ""
+        process.save(update_fields=['error'])
+    profile = models.Profile.objects.get(user_id=process.user_id)
+    data_field = client_settings()['OAUTH_DATA_KEY']
+    if "Data" in userdata and data_field in userdata["Data"] and userdata["Data"][data_field] == client_settings()['OAUTH_DATA_VALUE']:
+        logger.debug("user: " + str(process.user_id) + " has been automatically verified")
+        profile.verified = True
+        profile.prio = models.Priority.objects.get(prio=50, name__contains="automatically")
+    else:
+        profile.automatically_verifiable = False
+        logger.debug("user: " + str(process.user_id) + " couldn't be automatically verified. \n" + str(userdata))
+    profile.save()
+    return True
+
+
+def poll(pk: int) -> Optional[timedelta]:
+    """
+    one poll of the process, returns the time until the next one or None if the process is finished
+    """
+    process = models.OauthVerificationProcess.objects.filter(pk=pk).first()
+    if process is None or process.verification_process_expires < timezone.now():
+        return None
+    if process.access_token is None:
+        try:
+            received = fetch_access_token(process)
+        except (requests.RequestException, ValueError):
+            logger.exception(f"polling oauth verification {pk} failed")
+            return process.ping_interval
+        if not received:
+            return process.ping_interval
+    if not models.Profile.objects.filter(user_id=process.user_id, verified=True).exists():
+        try:
+            if not verify_profile(process):
+                return process.ping_interval
+        except (requests.RequestException, ValueError):
+            logger.exception(f"fetching the verification data of oauth verification {pk} failed")
+            return process.ping_interval
+    return None
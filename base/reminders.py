@@ -0,0 +1,150 @@
+"""
+notification mails at fixed due times. instead of scanning all reservations and rentals periodically, a
+ScheduledReminder is stored when a reservation is created or a rental is handed out and moved when they change,
+see base.signals. base.tasks.send_due_reminders sends the due ones every minute
+"""
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.forms import model_to_dict
+from django.template import Context
+from django.utils import timezone
+
+from base import dynamic_settings
+from base import mail
+from base import mail_templates
+from base import models
+
+
+def local_datetime(day: date, hour: int = 0) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time(hour)))
+
+
+def reschedule_reservation(pk: int):
+    """
+    replaces the pending reminder of the reservation, the lender is told about it one day before it starts
+    """
+    reservation = models.Reservation.objects.filter(pk=pk).first()
+    with transaction.atomic():
+        models.ScheduledReminder.objects.filter(reservation_id=pk, sent_at__isnull=True).delete()
+        if reservation is None or reservation.canceled is not None or reservation.notified is not None or reservation.reserved_from < timezone.localdate():
+            return
+        models.ScheduledReminder.objects.create(kind=models.ScheduledReminder.RESERVATION_START, reservation=reservation,
+                                                due_at=local_datetime(reservation.reserved_from - timedelta(days=1)))
+
+
+def reschedule_rental(pk: int):
+    """
+    replaces the pending reminders of a handed out rental: the renter is reminded two days before the end and the lender
+    is told if the objects are still missing after the returning hours of the last day
+    """
+    rental = models.Rental.objects.with_extended_until().filter(pk=pk).first()
+    with transaction.atomic():
+        models.ScheduledReminder.objects.filter(rental_id=pk, sent_at__isnull=True).delete()
+        if rental is None or rental.handed_out_at is None or rental.received_back_at is not None:
+            return
+        today = timezone.localdate()
+        extended_until = rental.extended_until()
+        reminders = []
+        if rental.notified is None and extended_until - timedelta(days=2) >= today:
+            reminders.append(models.ScheduledReminder(kind=models.ScheduledReminder.RENTAL_EXPIRATION, rental=rental,
+                                                      due_at=local_datetime(extended_until - timedelta(days=2))))
+        if extended_until >= today:
+            reminders.append(models.ScheduledReminder(kind=models.ScheduledReminder.RENTAL_MISSING, rental=rental,
+                                                      due_at=local_datetime(extended_until, dynamic_settings.get_int('returning_end_hour'))))
+        models.ScheduledReminder.objects.bulk_create(reminders)
+
+
+def reservation_mail(reservations: List[models.Reservation]) -> models.OutgoingMail:
+    """
+    one mail to the lender listing the reservations
+    """
+    template_data = {"reservations": []}
+    for reservation in reservations:
+        reservation_dict = model_to_dict(reservation)
+        reservation_dict['reserver_profile'] = model_to_dict(reservation.reserver)
+        reservation_dict['reserver_user'] = model_to_dict(reservation.reserver.user)
+        reservation_dict['objecttype'] = model_to_dict(reservation.objecttype)
+        template_data['reservations'].append(reservation_dict)
+    message = mail_templates.render('reservation_lender_notification', template_data)
+    return mail.build_mail(subject="Neue Reservierungen am " + str(template_data["reservations"][0]['reserved_from']),
+                           message=message, html_message=message, recipient_list=[settings.DEFAULT_NOTIFICATION_EMAIL])
+
+
+def expiration_mails(rentals: List[models.Rental]) -> List[models.OutgoingMail]:
+    """
+    one mail per renter, the rentals have to be ordered by user
+    """
+    mails = []
+    template = mail_templates.get_template('rental_expiration_notification')
+    for _, user_rentals in groupby(rentals, key=lambda rental: rental.reservation.reserver.user_id):
+        user_rentals = list(user_rentals)
+        user = user_rentals[0].reservation.reserver.user
+        template_data = {'user': model_to_dict(user), 'rentals': [], 'return_date_info': {
+            'date': user_rentals[0].extended_until(), 'start': dynamic_settings.get('returning_start_hour'), 'end': dynamic_settings.get('returning_end_hour')}}
+        for rental in user_rentals:
+            rental_dict = model_to_dict(rental)
+            rental_dict['rented_object'] = model_to_dict(rental.rented_object)
+            rental_dict['rented_object']['type'] = model_to_dict(rental.rented_object.type)
+            rental_dict['rented_object']['merged_identifier'] = rental.rented_object.type.prefix_identifier + \
+                str(rental.rented_object.internal_identifier)
+            template_data['rentals'].append(rental_dict)
+        message = template.render(Context(template_data))
+        mails.append(mail.build_mail(subject=f"Deine ausgeliehenen Gegenstände müssen am {template_data['return_date_info']['date']} zurück",
+                                     message=message, html_message=message, recipient_list=[user.email]))
+    return mails
+
+
+def missing_mail() -> models.OutgoingMail:
+    message = "Wir haben ein paar Gegenstände nicht zurückerhalten, bitte einmal überprüfen."
+    return mail.build_mail(subject=f"Fehlende Gegenstände für heutige Rückgabe", message=message, html_message=message,
+                           recipient_list=[settings.DEFAULT_NOTIFICATION_EMAIL])
+
+
+def send_due() -> Dict[str, int]:
+    """
+    queues the mails of all due reminders and returns how many of each kind were queued. reminders whose reservation got
+    canceled or whose rental got returned in the meantime are marked as sent without a mail
+    """
+    now = timezone.now()
+    counts = {kind: 0 for kind, _ in models.ScheduledReminder.KIND_CHOICES}
+    with transaction.atomic():
+        # skip_locked lets a second worker continue with the reminders that are not being sent already
+        due = list(models.ScheduledReminder.objects.select_for_update(skip_locked=True).filter(
+            sent_at__isnull=True, due_at__lte=now).values_list('pk', 'kind', 'reservation_id', 'rental_id'))
+        if not due:
+            return counts
+        ids = {kind: [reservation_id or rental_id for _, reminder_kind, reservation_id, rental_id in due if reminder_kind == kind] for kind in counts}
+        mails = []
+
+        reservations = list(models.Reservation.objects.filter(
+            pk__in=ids[models.ScheduledReminder.RESERVATION_START], canceled__isnull=True, notified__isnull=True).select_related(
+            'reserver__user', 'objecttype').prefetch_related('reserver__user__groups', 'reserver__user__user_permissions', 'objecttype__tags').order_by('reserved_from', 'pk'))
+        if reservations:
+            mails.append(reservation_mail(reservations))
+            counts[models.ScheduledReminder.RESERVATION_START] = 1
+
+        rentals = list(models.Rental.objects.with_extended_until().filter(
+            pk__in=ids[models.ScheduledReminder.RENTAL_EXPIRATION], received_back_at__isnull=True, notified__isnull=True).select_related(
+            'reservation__reserver__user', 'rented_object__type').prefetch_related(
+            'reservation__reserver__user__groups', 'reservation__reserver__user__user_permissions', 'rented_object__type__tags').order_by(
+            'reservation__reserver__user', 'pk'))
+        rental_mails = expiration_mails(rentals)
+        mails += rental_mails
+        counts[models.ScheduledReminder.RENTAL_EXPIRATION] = len(rental_mails)
+
+        missing = list(models.Rental.objects.filter(
+            pk__in=ids[models.ScheduledReminder.RENTAL_MISSING], received_back_at__isnull=True).values_list('pk', flat=True))
+        if missing:
+            mails.append(missing_mail())
+            counts[models.ScheduledReminder.RENTAL_MISSING] = 1
+
+        mail.queue_mails(mails)
+        # update() does not send signals, so the reminders are not scheduled again
+        models.Reservation.objects.filter(pk__in=[reservation.pk for reservation in reservations]).update(notified=now)
+        models.Rental.objects.filter(pk__in=[rental.pk for rental in rentals] + missing).update(notified=now)
+        models.ScheduledReminder.objects.filter(pk__in=[pk for pk, _, _, _ in due]).update(sent_at=now)
+    return counts
@@ -0,0 +1,119 @@
+"""
+the rental form lenders print at the handout, rendered from the docx uploaded as Files(name='rental_form').
+the parsed docx is kept per worker until the file changes, every render works on a copy of it
+"""
+import copy
+import io
+import logging
+import os
+import zipfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.core.files.base import ContentFile
+from django.db.models import Prefetch
+from django.utils import timezone
+from docx import Document
+from docxtpl import DocxTemplate
+
+from base import models
+
+logger = logging.getLogger("django")
+
+_documents: Dict[Tuple[str, float], object] = {}
+
+
+def get_document(path: str):
+    """
+    a fresh copy of the parsed docx at path, parsed again only if the modification time changed
+    """
+    key = (path, os.stat(path).st_mtime)
+    document = _documents.get(key)
+    if document is None:
+        document = Document(path)
+        # only the current version of the form is needed
+        _documents.clear()
+        _documents[key] = document
+    return copy.deepcopy(document)
+
+
+def template_path() -> str:
+    return models.Files.objects.get(name='rental_form').file.path
+
+
+def render(context: dict, path: Optional[str] = None) -> bytes:
+    """
+    path of the form, looked up if not given
+    """
+    path = path or template_path()
+    doc = DocxTemplate(path)
+    # rendering changes the document, so it gets a copy instead of the cached one
+    doc.docx = get_document(path)
+    doc.render(context=context)
+    file = io.BytesIO()
+    doc.save(file)
+    return file.getvalue()
+
+
+def reservation_context(reservations: List[models.Reservation]) -> dict:
+    """
+    the context download_form gets from the frontend, built from the reservations of one operation instead.
+    the identifiers are the ones of the rentals if the objects were handed out already, otherwise they are left empty
+    for the lender to fill in
+    """
+    user = reservations[0].reserver.user
+    context = {'rented_items': [], 'reserver': {'last_name': user.last_name, 'first_name': user.first_name, 'email': user.email}}
+    for reservation in reservations:
+        context['rented_items'].append({'operation_number': reservation.operation_number, 'reserved_from': reservation.reserved_from.isoformat(),
+                                        'reserved_until': reservation.reserved_until.isoformat(), 'count': reservation.count,
+                                        'name': reservation.objecttype.name, 'identifier': ",".join(
+                                            [reservation.objecttype.prefix_identifier + str(rental.rented_object.internal_identifier) for rental in reservation.rental_set.all()])})
+    return context
+
+
+def export_reservations(export: models.RentalFormExport):
+    """
+    reservations covered by the export, ordered by their operation
+    """
+    reservations = models.Reservation.objects.filter(canceled__isnull=True)
+    if export.lending_date is not None:
+        reservations = reservations.filter(reserved_from=export.lending_date)
+    else:
+        reservations = reservations.filter(operation_number__in=export.operation_numbers)
+    return reservations.select_related('reserver__user', 'objecttype').prefetch_related(
+        Prefetch('rental_set', queryset=models.Rental.objects.select_related('rented_object').order_by('rented_object__internal_identifier'))
+    ).order_by('operation_number', 'objecttype__name', 'pk')
+
+
+def group_by_operation(reservations: Iterable[models.Reservation]) -> Dict[int, List[models.Reservation]]:
+    operations: Dict[int, List[models.Reservation]] = {}
+    for reservation in reservations:
+        operations.setdefault(reservation.operation_number, []).append(reservation)
+    return operations
+
+
+def export(pk: int) -> models.RentalFormExport:
+    """
+    renders one form per operation into the zip of the export. the progress is saved after every form,
+    so the frontend can show it while polling the export
+    """
+    export = models.RentalFormExport.objects.get(pk=pk)
+    operations = group_by_operation(export_reservations(export))
+    export.status, export.total, export.rendered = models.RentalFormExport.RUNNING, len(operations), 0
+    export.save(update_fields=['status', 'total', 'rendered'])
+    try:
+        path = template_path()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for operation_number, reservations in operations.items():
+                user = reservations[0].reserver.user
+                zip_file.writestr(f"{operation_number}_{user.last_name}_{user.first_name}.docx", render(reservation_context(reservations), path))
+                export.rendered += 1
+                export.save(update_fields=['rendered'])
+        export.file.save(f"rental_forms_{export.pk}.zip", ContentFile(archive.getvalue()), save=False)
+        export.status = models.RentalFormExport.DONE
+    except Exception as e:
+        logger.exception(f"exporting the rental forms of {export} failed")
+        export.status, export.error = models.RentalFormExport.FAILED, repr(e)
+    export.finished_at = timezone.now()
+    export.save(update_fields=['file', 'status', 'error', 'finished_at'])
+    return export
@@ -1,5 +1,15 @@
+from django.conf import settings
 from django.contrib.auth.models import User, Group, Permission
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from base.models import Priority
+from base import availability
+from base import dynamic_settings
+from base import images
+from base import mail_templates
+from base import models
+from base import reminders
 import logging
 
 logger = logging.getLogger("django")
@@ -35,4 +45,210 @@ def populate_models(sender, **kwargs):
     # try:
     #     Priority.objects.get(prio=99)
     # except:
-    #     Priority.objects.create(name='Default', prio=99, description='default class')
\ No newline at end of file
+    #     Priority.objects.create(name='Default', prio=99, description='default class')
+
+
+def availability_ranges(instance) -> list:
+    """
+    the days whose availability depends on this instance as (type id, from_date, until_date)
+    """
+    offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+    try:
+        if isinstance(instance, models.Reservation):
+            return [(instance.objecttype_id, instance.reserved_from, instance.reserved_until + offset)]
+        if isinstance(instance, models.Extension):
+            instance = instance.extended_rental
+        if isinstance(instance, models.Rental):
+            from_date = instance.reservation.reserved_from
+            if instance.handed_out_at is not None:
+                from_date = min(from_date, instance.handed_out_at.date())
+            until_date = max(instance.reservation.reserved_until, instance.extended_until())
+            return [(instance.rented_object.type_id, from_date, until_date + offset)]
+        if isinstance(instance, models.RentalObjectStatus):
+            return [(instance.rental_object.type_id, availability.to_date(instance.from_date), availability.to_date(instance.until_date))]
+        if isinstance(instance, models.RentalObject):
+            return [(instance.type_id, *availability.calendar_range())]
+        if isinstance(instance, models.RentalObjectType):
+            return [(instance.pk, *availability.calendar_range())]
+    except ObjectDoesNotExist:
+        # related objects that are deleted in the same cascade do not block anything anymore
+        pass
+    return []
+
+
+def availability_types(instance) -> set:
+    """
+    the types whose availability depends on this instance, read from the instance and its already loaded relations
+    wherever possible. without the calendar only their cached availability has to be invalidated, the days do not matter
+    """
+    try:
+        if isinstance(instance, models.Reservation):
+            return {instance.objecttype_id}
+        if isinstance(instance, models.Extension):
+            if not models.Extension.extended_rental.is_cached(instance):
+                return set(models.RentalObject.objects.filter(rental=instance.extended_rental_id).values_list('type_id', flat=True))
+            instance = instance.extended_rental
+        if isinstance(instance, models.Rental):
+            return {instance.rented_object.type_id}
+        if isinstance(instance, models.RentalObjectStatus):
+            return {instance.rental_object.type_id}
+        if isinstance(instance, models.RentalObject):
+            return {instance.type_id}
+        if isinstance(instance, models.RentalObjectType):
+            return {instance.pk}
+    except ObjectDoesNotExist:
+        pass
+    return set()
+
+
+def affected_ranges(instance) -> list:
+    if settings.AVAILABILITY_BACKEND == 'calendar':
+        return availability_ranges(instance)
+    return [(type_id, None, None) for type_id in availability_types(instance)]
+
+
+# fields that move an instance to other types and fields that move its days. if none of them changed since the row
+# was loaded, the stored version affects the same types and days as the saved one and does not have to be fetched
+AVAILABILITY_FIELDS = {
+    models.Reservation: (['objecttype_id'], ['reserved_from', 'reserved_until']),
+    models.Rental: (['rented_object_id'], ['reservation_id', 'handed_out_at']),
+    models.Extension: (['extended_rental_id'], ['extended_until']),
+    models.RentalObjectStatus: (['rental_object_id'], ['from_date', 'until_date']),
+    models.RentalObject: (['type_id'], []),
+    models.RentalObjectType: ([], []),
+}
+
+
+def fields_changed(instance, fields: list) -> bool:
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is None:
+        # not loaded from the database, e.g. saved with an explicit pk
+        return True
+    return any(field not in loaded or instance.__dict__.get(field, loaded[field]) != loaded[field] for field in fields)
+
+
+def availability_changed(ranges: list):
+    """
+    recalculates the affected days of the availability calendar and invalidates the cached availability of the types.
+    waits for the commit, otherwise other requests could cache uncommitted data and cascading deletes would
+    recreate calendar rows of types that are deleted afterwards
+    """
+    def refresh():
+        if settings.AVAILABILITY_BACKEND == 'calendar':
+            for type_id, from_date, until_date in ranges:
+                availability.refresh_calendar([type_id], from_date, until_date)
+        availability.invalidate_cache({type_id for type_id, _, _ in ranges})
+    if ranges:
+        transaction.on_commit(refresh)
+
+
+def remember_availability_ranges(sender, instance, raw=False, **kwargs):
+    """
+    saves the ranges of the stored version of the instance, since those days change as well. the stored row is only
+    fetched if the instance was moved to other types or, for the calendar, other days
+    """
+    instance._old_availability_ranges = []
+    if raw or not instance.pk:
+        return
+    type_fields, date_fields = AVAILABILITY_FIELDS[sender]
+    if not fields_changed(instance, type_fields + date_fields if settings.AVAILABILITY_BACKEND == 'calendar' else type_fields):
+        return
+    old_instance = sender.objects.filter(pk=instance.pk).first()
+    instance._old_availability_ranges = affected_ranges(old_instance) if old_instance else []
+
+
+def update_availability_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # instances saved with update() and passed here by hand, e.g. in bulkhandout, skipped remember_availability_ranges
+    availability_changed(getattr(instance, '_old_availability_ranges', []) + affected_ranges(instance))
+    # the next save compares against this version
+    instance._loaded_values = {field.attname: instance.__dict__[field.attname] for field in sender._meta.concrete_fields
+                               if field.attname in instance.__dict__}
+
+
+def update_availability_on_delete(sender, instance, **kwargs):
+    availability_changed(affected_ranges(instance))
+
+
+for availability_model in AVAILABILITY_FIELDS:
+    pre_save.connect(remember_availability_ranges, sender=availability_model)
+    post_save.connect(update_availability_on_save, sender=availability_model)
+    post_delete.connect(update_availability_on_delete, sender=availability_model)
+
+
+def settings_changed(sender, **kwargs):
+    """
+    reload the Settings table in every process once the change is committed
+    """
+    transaction.on_commit(dynamic_settings.invalidate)
+
+
+post_save.connect(settings_changed, sender=models.Settings)
+post_delete.connect(settings_changed, sender=models.Settings)
+
+
+def remember_text_name(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._old_name = sender.objects.filter(pk=instance.pk).values_list('name', flat=True).first() if instance.pk else None
+
+
+def text_changed(sender, instance, **kwargs):
+    """
+    recompile the mail template in every process once the change is committed, also under the old name if it was renamed
+    """
+    names = {instance.name, getattr(instance, '_old_name', None) or instance.name}
+    transaction.on_commit(lambda: mail_templates.invalidate(*names))
+
+
+pre_save.connect(remember_text_name, sender=models.Text)
+post_save.connect(text_changed, sender=models.Text)
+post_delete.connect(text_changed, sender=models.Text)
+
+
+def update_reminders_on_save(sender, instance, raw=False, **kwargs):
+    """
+    moves the reminders of the reservation or rental once the change is committed. done afterwards since the rental
+    might get deleted in the same transaction, e.g. when its extensions are deleted with it
+    """
+    if raw:
+        return
+    if isinstance(instance, models.Reservation):
+        transaction.on_commit(lambda: reminders.reschedule_reservation(instance.pk))
+    elif isinstance(instance, models.Rental):
+        transaction.on_commit(lambda: reminders.reschedule_rental(instance.pk))
+    elif isinstance(instance, models.Extension):
+        transaction.on_commit(lambda: reminders.reschedule_rental(instance.extended_rental_id))
+
+
+def update_reminders_on_delete(sender, instance, **kwargs):
+    if isinstance(instance, models.Extension):
+        update_reminders_on_save(sender, instance)
+
+
+for reminder_model in [models.Reservation, models.Rental, models.Extension]:
+    post_save.connect(update_reminders_on_save, sender=reminder_model)
+post_delete.connect(update_reminders_on_delete, sender=models.Extension)
+
+
+def schedule_image_variants(sender, instance, raw=False, **kwargs):
+    """
+    creates the variants in a worker once a new image is committed, the request does not wait for pillow
+    """
+    if raw or not images.variants_outdated(instance):
+        return
+    model, pk = sender._meta.label, instance.pk
+
+    def schedule():
+        from base import tasks
+        try:
+            tasks.generate_image_variants.delay(model, pk)
+        except Exception:
+            # manage.py generate_image_variants creates the missing variants
+            logger.exception(f"could not schedule the image variants of {model} {pk}")
+    transaction.on_commit(schedule)
+
+
+for image_model in [models.RentalObjectType, models.OnPremiseWorkplace]:
+    post_save.connect(schedule_image_variants, sender=image_model)
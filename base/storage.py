@@ -0,0 +1,34 @@
+"""
+storage for files that must not be reachable under MEDIA_URL, e.g. the zips of base.RentalFormExport with the names and
+emails of the reservers. they are kept in PRIVATE_MEDIA_ROOT and only sent by views that check the permissions
+"""
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+
+class PrivateStorage(FileSystemStorage):
+    # read on every access instead of once, so PRIVATE_MEDIA_ROOT can be overridden like MEDIA_ROOT
+    @property
+    def base_location(self):
+        return settings.PRIVATE_MEDIA_ROOT
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+    @property
+    def base_url(self):
+        # url() raises, there is no public url
+        return None
+
+
+_private_storage = PrivateStorage()
+
+
+def private_storage() -> PrivateStorage:
+    """
+    callable for the storage argument of file fields, keeps the location out of the migrations
+    """
+    return _private_storage
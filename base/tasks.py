@@ -2,17 +2,25 @@ from celery import shared_task
 from django.forms import model_to_dict
 from django.utils import timezone
 from django.conf import settings
-from django.core.mail import send_mail
 from django.contrib.auth.models import User
 from django.db import transaction
-from django.template import Context, Template
+from django.db.models import Max
 
 from django_celery_beat.models import PeriodicTask
 
 from datetime import timedelta, datetime
 
 from base import models
+from base import availability
+from base import images
+from base import mail
+# observes the tasks of the worker
+from base import metrics
+from base import oauth
+from base import reminders
+from base import rental_form
 import logging
+import time
 
 logger = logging.getLogger("django")
 
@@ -40,69 +48,79 @@ def cleanup_accounts():
 
 
 @shared_task()
-def notify_about_rentals_and_reservations():
-    """
-    fetch all reservations for the next day 
-    """
-    reservations = models.Reservation.objects.filter(reserved_from__lte=(timezone.now(
-    ) + timedelta(days=1)).date(), reserved_from__gte=timezone.now().date(), canceled__isnull=True, notified__isnull=True)
-    count_mails = 0
-    if len(reservations) > 0:
-        with transaction.atomic():
-            template_data = {"reservations": []}
-            for reservation in reservations:
-                reservation_dict = model_to_dict(reservation)
-                reservation_dict['reserver_profile'] = model_to_dict(
-                    reservation.reserver)
-                reservation_dict['reserver_user'] = model_to_dict(
-                    reservation.reserver.user)
-                reservation_dict['objecttype'] = model_to_dict(
-                    reservation.objecttype)
-                template_data['reservations'].append(reservation_dict)
-            logger.info(template_data)
-            # notify lender about reservations one day in advance
-            template = Template(models.Text.objects.filter(
-                name='reservation_lender_notification').first().content)
-            message = template.render(Context(template_data))
-            count_mails = send_mail(subject="Neue Reservierungen am " + str(template_data["reservations"][0]['reserved_from']),
-                                    from_email=settings.DEFAULT_FROM_EMAIL, message=message, html_message=message, recipient_list=[settings.DEFAULT_NOTIFICATION_EMAIL])
-            reservations.update(notified=timezone.now())
-
-    rentals = [ r for r in models.Rental.objects.filter( received_back_at__isnull=True, notified__isnull=True) if r.extended_until==(
-        timezone.now() + timedelta(days=2)).date()]
-    count_rental_mails = 0
-    if len(rentals) > 0:
-        with transaction.atomic():
-            template_data = {}
-            for rental in rentals:
-                rental_dict = model_to_dict(rental)
-                if rental.reservation.reserver.user.pk not in template_data:
-                    user = rental.reservation.reserver.user
-                    template_data[user.pk] = {'user': model_to_dict(user), 'rentals': [], 'return_date_info': {'date': rental.extended_until(), 'start': models.Settings.objects.get(
-                        type='returning_start_hour').value, 'end': models.Settings.objects.get(type='returning_end_hour').value}}
-                rental_dict['rented_object'] = model_to_dict(
-                    rental.rented_object)
-                rental_dict['rented_object']['type'] = model_to_dict(
-                    rental.rented_object.type)
-                rental_dict['rented_object']['merged_identifier'] = rental.rented_object.type.prefix_identifier + \
-                    str(rental.rented_object.internal_identifier)
-                template_data[user.pk]['rentals'].append(rental_dict)
-            for key in template_data.keys():
-                template = Template(models.Text.objects.filter(
-                    name='rental_expiration_notification').first().content)
-                message = template.render(Context(template_data[key]))
-                count_rental_mails += send_mail(subject=f"Deine ausgeliehenen Gegenstände müssen am {template_data[key]['return_date_info']['date']} zurück",
-                                                from_email=settings.DEFAULT_FROM_EMAIL, message=message, html_message=message, recipient_list=[template_data[key]['user']['email']])
-                logger.info(message)
-            rentals.update(notified=timezone.now())
-    # only execute if returning hours are over
-    if timezone.now() > timezone.now().replace(hour=int(models.Settings.objects.get(type='returning_end_hour').value), minute=0, second=0):
-        # reuse notified state for this fetch all rentals that were supposed to come back today and which have been notified about reserved until before the rental hour startet
-        rentals_not_received_back = [ r for r in models.Rental.objects.filter(received_back_at__isnull=True, notified__lte=timezone.now(
-            ).replace(hour=int(models.Settings.objects.get(type='returning_start_hour').value))) if r.extended_until==timezone.now().date()]
-        if len(rentals_not_received_back) > 0:
-            message="Wir haben ein paar Gegenstände nicht zurückerhalten, bitte einmal überprüfen."
-            send_mail(subject=f"Fehlende Gegenstände für heutige Rückgabe",
-                from_email=settings.DEFAULT_FROM_EMAIL, message=message, html_message=message, recipient_list=[settings.DEFAULT_NOTIFICATION_EMAIL])
-            rentals.update(notified=timezone.now())
-    return f"send {count_mails} mails about reservations"
+def send_queued_mails():
+    """
+    deliver the mails queued in base.OutgoingMail, see base.mail
+    """
+    sent = mail.send_queued()
+    return f"sent {sent} mails"
+
+
+@shared_task()
+def generate_image_variants(model: str, pk: int):
+    """
+    creates the scaled down variants of the image of the row, see base.images
+    """
+    if images.update_variants(model, pk):
+        return f"generated the image variants of {model} {pk}"
+    return f"image variants of {model} {pk} are up to date"
+
+
+@shared_task()
+def export_rental_forms(pk: int):
+    """
+    renders the forms of a base.RentalFormExport into its zip, see base.rental_form.export
+    """
+    export = rental_form.export(pk)
+    return f"rendered {export.rendered} of {export.total} rental forms, {export.status}"
+
+
+@shared_task()
+def cleanup_rental_form_exports():
+    """
+    delete exports and their zips after RENTAL_FORM_EXPORT_MAX_AGE
+    """
+    exports = models.RentalFormExport.objects.filter(created_at__lte=timezone.now() - settings.RENTAL_FORM_EXPORT_MAX_AGE)
+    # django_cleanup removes the zips, post_delete is sent for every deleted row
+    deleted, _ = exports.delete()
+    return f"deleted {deleted} rental form exports"
+
+
+@shared_task()
+def poll_oauth_verification(pk: int):
+    """
+    asks the oauth provider whether the user finished the verification and schedules itself again
+    after ping_interval until then, see base.oauth
+    """
+    countdown = oauth.poll(pk)
+    if countdown is None:
+        return f"oauth verification {pk} is finished"
+    oauth.schedule_poll(pk, countdown)
+    return f"oauth verification {pk} is pending, polling again in {countdown}"
+
+
+@shared_task()
+def roll_availability_calendar():
+    """
+    remove past days from the availability calendar and add the days that moved into its range
+    """
+    if settings.AVAILABILITY_BACKEND != 'calendar':
+        return "availability calendar is not used"
+    from_date, until_date = availability.calendar_range()
+    deleted, _ = models.AvailabilityCalendar.objects.filter(day__lt=from_date).delete()
+    pks = list(models.RentalObjectType.objects.values_list('pk', flat=True))
+    last_day = models.AvailabilityCalendar.objects.aggregate(Max('day'))['day__max']
+    if last_day is not None and last_day >= from_date:
+        from_date = last_day + timedelta(days=1)
+    availability.refresh_calendar(pks, from_date, until_date)
+    return f"deleted {deleted} past days, calculated days from {from_date} until {until_date}"
+
+
+@shared_task()
+def send_due_reminders():
+    """
+    queues the mails of all due base.ScheduledReminder, see base.reminders
+    """
+    started = time.monotonic()
+    counts = reminders.send_due()
+    return f"queued {counts[models.ScheduledReminder.RESERVATION_START]} mails about reservations, {counts[models.ScheduledReminder.RENTAL_EXPIRATION]} about rentals and {counts[models.ScheduledReminder.RENTAL_MISSING]} about missing objects in {time.monotonic() - started:.3f}s"
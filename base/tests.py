@@ -1,3 +1,659 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
 
 # Create your tests here.
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail as django_mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.forms import model_to_dict
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from base import availability
+from base import cache as cache_versions
+from base import dynamic_settings
+from base import images
+from base import mail
+from base import mail_templates
+from base import reminders
+from base import rental_form
+from base import models
+from base import tasks
+
+
+def legacy_available(pk, from_date, until_date):
+    """
+    the day by interval implementation RentalObjectType.available used before the sweep line engine. kept to prove that both calculate the same
+    """
+    if isinstance(from_date, date):
+        from_date = datetime.combine(
+            from_date, datetime.min.time(), tzinfo=timezone.get_current_timezone())
+    if isinstance(until_date, date):
+        until_date = datetime.combine(
+            until_date, datetime.min.time(), tzinfo=timezone.get_current_timezone())
+    delta = until_date - from_date
+    offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+    object_status = models.RentalObjectStatus.objects.all().filter(from_date__lte=until_date, until_date__gte=from_date,
+                                                                   rentable=False, rental_object__in=models.RentalObject.objects.filter(type=pk))
+    objects = models.RentalObject.objects.all().filter(
+        type=pk).exclude(rentable=False).exclude(rentalobjectstatus__in=object_status)
+    reservations = models.Reservation.objects.filter(
+        objecttype_id=pk, reserved_from__lte=until_date.date(), reserved_until__gte=from_date.date()).exclude(rental__in=models.Rental.objects.filter(rented_object__type=pk)).exclude(canceled__isnull=False)
+    rentals = models.Rental.objects.filter(
+        rented_object__in=objects, handed_out_at__lte=until_date)
+    rentals = [r for r in rentals if r.extended_until() <= from_date.date()]
+    count = len(objects)
+    normalized_list = [{**model_to_dict(x), 'from_date': x.handed_out_at.date(
+    ), 'until_date': x.extended_until()} for x in rentals]
+    for reservation in reservations:
+        for _ in range(reservation.count):
+            normalized_list.append(
+                {**model_to_dict(reservation), 'from_date': reservation.reserved_from, 'until_date': reservation.reserved_until})
+    return legacy_free_per_day(count, normalized_list, from_date.date(), delta.days)
+
+
+def legacy_free_per_day(count, normalized_list, from_date, days):
+    offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+    ret = {}
+    max_value = 0
+    for day_diff in range(days+1):
+        current_date = from_date + timedelta(days=day_diff)
+        temp_value = 0
+        for blocked_timerange in normalized_list:
+            if blocked_timerange['from_date'] <= current_date < blocked_timerange['until_date'] + offset:
+                temp_value += 1
+        max_value = temp_value if temp_value > max_value else max_value
+        ret[str(current_date)] = count-temp_value
+    ret['available'] = count-max_value
+    return ret
+
+
+class OccupancyTestCase(SimpleTestCase):
+    def test_free_per_day_equals_day_by_interval_loop(self):
+        rng = random.Random(42)
+        offset = settings.DEFAULT_OFFSET_BETWEEN_RENTALS
+        start = date(2023, 1, 5)
+        for _ in range(200):
+            normalized_list = []
+            intervals = []
+            for _ in range(rng.randint(0, 20)):
+                from_date = start + timedelta(days=rng.randint(-30, 60))
+                until_date = from_date + timedelta(days=rng.randint(0, 30))
+                weight = rng.randint(1, 4)
+                normalized_list += [{'from_date': from_date, 'until_date': until_date}] * weight
+                intervals.append(availability.BlockedInterval(from_date, until_date + offset, weight))
+            range_start = start + timedelta(days=rng.randint(-10, 40))
+            days = rng.randint(-2, 40)
+            count = rng.randint(0, 30)
+            self.assertEqual(
+                availability.free_per_day(count, intervals, range_start, range_start + timedelta(days=days)),
+                legacy_free_per_day(count, normalized_list, range_start, days))
+
+
+class AvailabilityFixture:
+    def setUp(self):
+        prio = models.Priority.objects.create(prio=99, name="unverified")
+        user = User.objects.create_user(username="renter", email="renter@rwth-aachen.de")
+        self.profile = models.Profile.objects.create(user=user, prio=prio)
+        category = models.Category.objects.create(name="Kameras")
+        self.object_type = models.RentalObjectType.objects.create(name="Kamera", category=category, prefix_identifier="K")
+        self.objects = [models.RentalObject.objects.create(type=self.object_type, internal_identifier=i) for i in range(6)]
+        models.RentalObject.objects.create(type=self.object_type, internal_identifier=6, rentable=False)
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[5], from_date=date(2023, 1, 12), until_date=date(2023, 1, 14))
+
+    def reserve(self, from_date, until_date, count, canceled=None):
+        return models.Reservation.objects.create(reserver=self.profile, reserved_from=from_date, reserved_until=until_date,
+                                                 objecttype=self.object_type, operation_number=1, count=count, canceled=canceled)
+
+
+class AvailableTestCase(AvailabilityFixture, TestCase):
+    def test_available_equals_legacy_implementation(self):
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        self.reserve(date(2023, 1, 12), date(2023, 1, 19), 3)
+        self.reserve(date(2023, 1, 5), date(2023, 1, 26), 1)
+        self.reserve(date(2023, 1, 5), date(2023, 1, 26), 4, canceled=timezone.now())
+        rented = self.reserve(date(2022, 12, 22), date(2023, 1, 5), 1)
+        rental = models.Rental.objects.create(rented_object=self.objects[0], rental_number=1, reservation=rented,
+                                              handed_out_at=datetime(2022, 12, 22, 12, tzinfo=timezone.get_current_timezone()))
+        models.Extension.objects.create(extended_from=date(2023, 1, 5), extended_until=date(2023, 1, 12),
+                                        extended_by=self.profile.user, extended_rental=rental)
+        for from_date, until_date in [(date(2023, 1, 1), date(2023, 1, 31)), (date(2023, 1, 12), date(2023, 1, 12)),
+                                      (date(2023, 1, 13), date(2023, 1, 19)), (date(2023, 1, 19), date(2023, 1, 5))]:
+            self.assertEqual(models.RentalObjectType.available(self.object_type.pk, from_date, until_date),
+                             legacy_available(self.object_type.pk, from_date, until_date))
+            self.assertEqual(availability.available_sql([self.object_type.pk], availability.normalize_date(from_date), availability.normalize_date(until_date)),
+                             {self.object_type.pk: legacy_available(self.object_type.pk, from_date, until_date)})
+
+    def test_available_many_equals_available(self):
+        other_type = models.RentalObjectType.objects.create(name="Stativ", category=self.object_type.category, prefix_identifier="S")
+        models.RentalObject.objects.create(type=other_type, internal_identifier=1)
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        pks = [self.object_type.pk, other_type.pk]
+        with self.assertNumQueries(4):
+            result = availability.available_many(pks, date(2023, 1, 1), date(2023, 1, 31))
+        self.assertEqual(result, {pk: legacy_available(pk, date(2023, 1, 1), date(2023, 1, 31)) for pk in pks})
+        self.assertEqual(availability.available_sql(pks, availability.normalize_date(date(2023, 1, 1)), availability.normalize_date(date(2023, 1, 31))), result)
+
+    def test_extended_until_is_annotated(self):
+        rented = self.reserve(date(2022, 12, 22), date(2023, 1, 5), 1)
+        rental = models.Rental.objects.create(rented_object=self.objects[0], rental_number=1, reservation=rented)
+        self.assertEqual(rental.extended_until(), date(2023, 1, 5))
+        for extended_until in [date(2023, 1, 19), date(2023, 1, 12)]:
+            models.Extension.objects.create(extended_from=date(2023, 1, 5), extended_until=extended_until,
+                                            extended_by=self.profile.user, extended_rental=rental)
+        self.assertEqual(rental.extended_until(), date(2023, 1, 19))
+        with self.assertNumQueries(1):
+            self.assertEqual([r.extended_until() for r in models.Rental.objects.with_extended_until()], [date(2023, 1, 19)])
+        self.assertEqual(models.Rental.objects.with_extended_until().filter(
+            extended_until_date=date(2023, 1, 19)).update(notified=timezone.now()), 1)
+
+    def test_calendar_days_equal_available_of_single_days(self):
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        self.reserve(date(2023, 1, 12), date(2023, 1, 19), 3)
+        rented = self.reserve(date(2022, 12, 22), date(2023, 1, 5), 1)
+        models.Rental.objects.create(rented_object=self.objects[1], rental_number=1, reservation=rented,
+                                     handed_out_at=datetime(2022, 12, 22, 12, tzinfo=timezone.get_current_timezone()))
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[5], from_date=date(2023, 1, 13), until_date=date(2023, 1, 20))
+        for offset in [timedelta(days=0), timedelta(days=2)]:
+            with override_settings(DEFAULT_OFFSET_BETWEEN_RENTALS=offset):
+                from_date, until_date = date(2023, 1, 1), date(2023, 1, 31)
+                snapshot = availability.AvailabilitySnapshot([self.object_type.pk], availability.normalize_date(from_date), availability.normalize_date(until_date))
+                for day, rentable, occupied in availability.calendar_days(snapshot, self.object_type.pk, from_date, until_date):
+                    self.assertEqual(rentable - occupied, legacy_available(self.object_type.pk, day, day)['available'])
+
+    @override_settings(AVAILABILITY_BACKEND='calendar')
+    def test_calendar_is_kept_up_to_date(self):
+        today = timezone.localdate()
+        call_command('rebuild_availability_calendar', stdout=io.StringIO())
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = self.reserve(today + timedelta(days=7), today + timedelta(days=14), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.RentalObjectStatus.objects.create(rental_object=self.objects[2], from_date=today + timedelta(days=10), until_date=today + timedelta(days=11))
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.reserved_until = today + timedelta(days=21)
+            reservation.save()
+        call_command('check_availability_calendar', stdout=io.StringIO())
+        self.assertEqual(models.RentalObjectType.available(self.object_type.pk, today + timedelta(days=7), today + timedelta(days=21))['available'], 3)
+
+    def save_and_commit(self, instance, queries=None):
+        """
+        returns the types whose cached availability got invalidated, queries is the number of queries of the save itself
+        """
+        with mock.patch('base.availability.invalidate_cache') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                if queries is None:
+                    instance.save()
+                else:
+                    with self.assertNumQueries(queries):
+                        instance.save()
+        return set().union(*[call.args[0] for call in invalidate.call_args_list])
+
+    def test_saves_without_reading_the_stored_row(self):
+        reservation = models.Reservation.objects.get(pk=self.reserve(date(2023, 1, 12), date(2023, 1, 19), 2).pk)
+        reservation.count = 1
+        self.assertEqual(self.save_and_commit(reservation, queries=1), {self.object_type.pk})
+        rental = models.Rental.objects.create(rented_object=self.objects[0], rental_number=1, reservation=reservation)
+        rental = models.Rental.objects.select_related('rented_object__type', 'reservation__objecttype').get(pk=rental.pk)
+        rental.handed_out_at = timezone.now()
+        self.assertEqual(self.save_and_commit(rental, queries=1), {self.object_type.pk})
+        # moved to another type, both are invalidated
+        other_type = models.RentalObjectType.objects.create(name="Stativ", category=self.object_type.category, prefix_identifier="S")
+        reservation.objecttype = other_type
+        self.assertEqual(self.save_and_commit(reservation), {self.object_type.pk, other_type.pk})
+
+    @override_settings(AVAILABILITY_BACKEND='calendar')
+    def test_status_with_default_dates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            # from_date and until_date stay datetimes on the instance
+            models.RentalObjectStatus.objects.create(rental_object=self.objects[1])
+        today = timezone.localdate()
+        self.assertEqual(models.AvailabilityCalendar.objects.get(object_type=self.object_type, day=today).rentable, 5)
+
+    def test_backends_agree_for_partly_defect_objects(self):
+        start = timezone.localdate() + timedelta(days=7)
+        self.reserve(start, start + timedelta(days=1), 1)
+        # no object is free on both of the last days, although only one is defect on each of them
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[3], from_date=start + timedelta(days=1), until_date=start + timedelta(days=1))
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[4], from_date=start + timedelta(days=2), until_date=start + timedelta(days=2))
+        availability.refresh_calendar([self.object_type.pk], start, start + timedelta(days=2))
+        days = [str(start + timedelta(days=diff)) for diff in range(3)]
+        for offset in [timedelta(days=0), timedelta(days=2)]:
+            with override_settings(DEFAULT_OFFSET_BETWEEN_RENTALS=offset):
+                for from_date, until_date in [(start, start + timedelta(days=2)), (start + timedelta(days=1), start + timedelta(days=2)), (start, start)]:
+                    results = {}
+                    for backend in ['python', 'postgres', 'calendar']:
+                        with override_settings(AVAILABILITY_BACKEND=backend):
+                            results[backend] = availability.calculate_available([self.object_type.pk], availability.normalize_date(from_date),
+                                                                                availability.normalize_date(until_date))[self.object_type.pk]
+                    self.assertEqual(results['postgres'], results['python'])
+                    self.assertEqual(results['calendar'], results['python'])
+                    self.assertEqual(results['python'], legacy_available(self.object_type.pk, from_date, until_date))
+        with override_settings(AVAILABILITY_BACKEND='calendar'):
+            self.assertEqual(availability.calculate_available([self.object_type.pk], availability.normalize_date(start), availability.normalize_date(start + timedelta(days=2))),
+                             {self.object_type.pk: {days[0]: 3, days[1]: 4, days[2]: 4, 'available': 3}})
+            # without a defect the rows answer the range
+            with self.assertNumQueries(2):
+                availability.calculate_available([self.object_type.pk], availability.normalize_date(start), availability.normalize_date(start))
+
+
+class AvailabilityEngineTestCase(AvailabilityFixture, TestCase):
+    """
+    the python and the postgres engine on the same data, both have to answer like the legacy implementation
+    """
+
+    def assertEnginesAgree(self, pks, ranges):
+        for offset in [timedelta(days=0), timedelta(days=2)]:
+            with override_settings(DEFAULT_OFFSET_BETWEEN_RENTALS=offset):
+                for from_date, until_date in ranges:
+                    from_datetime, until_datetime = availability.normalize_date(from_date), availability.normalize_date(until_date)
+                    expected = {pk: legacy_available(pk, from_date, until_date) for pk in pks}
+                    with override_settings(AVAILABILITY_BACKEND='python'):
+                        self.assertEqual(availability.calculate_available(pks, from_datetime, until_datetime), expected, (offset, from_date, until_date))
+                    self.assertEqual(availability.available_sql(pks, from_datetime, until_datetime), expected, (offset, from_date, until_date))
+
+    def test_boundary_days(self):
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        self.reserve(date(2023, 1, 12), date(2023, 1, 19), 3)
+        self.reserve(date(2023, 1, 19), date(2023, 1, 19), 1)
+        self.reserve(date(2023, 1, 12), date(2023, 1, 19), 4, canceled=timezone.now())
+        self.assertEnginesAgree([self.object_type.pk], [
+            (date(2023, 1, 12), date(2023, 1, 12)), (date(2023, 1, 11), date(2023, 1, 12)), (date(2023, 1, 19), date(2023, 1, 19)),
+            (date(2023, 1, 20), date(2023, 1, 21)), (date(2023, 1, 4), date(2023, 1, 5)), (date(2023, 1, 13), date(2023, 1, 12))])
+
+    def test_rentals_around_midnight(self):
+        zone = timezone.get_current_timezone()
+        reservation = self.reserve(date(2023, 1, 5), date(2023, 1, 12), 3)
+        # handed out late, the utc day of 00:30 in Berlin is the day before
+        models.Rental.objects.create(rented_object=self.objects[0], rental_number=1, reservation=reservation,
+                                     handed_out_at=datetime(2023, 1, 13, 0, 30, tzinfo=zone))
+        models.Rental.objects.create(rented_object=self.objects[1], rental_number=1, reservation=reservation,
+                                     handed_out_at=datetime(2023, 1, 14, 0, 0, tzinfo=zone))
+        extended = models.Rental.objects.create(rented_object=self.objects[2], rental_number=1, reservation=reservation,
+                                                handed_out_at=datetime(2023, 1, 4, 23, 30, tzinfo=zone))
+        models.Extension.objects.create(extended_from=date(2023, 1, 12), extended_until=date(2023, 1, 19),
+                                        extended_by=self.profile.user, extended_rental=extended)
+        self.assertEnginesAgree([self.object_type.pk], [
+            (date(2023, 1, 12), date(2023, 1, 12)), (date(2023, 1, 12), date(2023, 1, 13)), (date(2023, 1, 12), date(2023, 1, 14)),
+            (date(2023, 1, 13), date(2023, 1, 15)), (date(2023, 1, 19), date(2023, 1, 21)), (date(2023, 1, 4), date(2023, 1, 5))])
+
+    def test_defect_objects(self):
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1)
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[1], from_date=date(2023, 1, 6), until_date=date(2023, 1, 7))
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[2], from_date=date(2023, 1, 1), until_date=date(2023, 1, 31))
+        # a status that keeps the object rentable and one of an object that is not rentable anyway
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[3], from_date=date(2023, 1, 6), until_date=date(2023, 1, 7), rentable=True)
+        models.RentalObjectStatus.objects.create(rental_object=models.RentalObject.objects.get(rentable=False), from_date=date(2023, 1, 6), until_date=date(2023, 1, 7))
+        self.assertEnginesAgree([self.object_type.pk], [
+            (date(2023, 1, 5), date(2023, 1, 5)), (date(2023, 1, 5), date(2023, 1, 6)), (date(2023, 1, 7), date(2023, 1, 8)),
+            (date(2023, 1, 8), date(2023, 1, 11)), (date(2023, 1, 1), date(2023, 1, 31))])
+
+    def test_empty_types(self):
+        category = self.object_type.category
+        without_objects = models.RentalObjectType.objects.create(name="Stativ", category=category, prefix_identifier="S")
+        not_rentable = models.RentalObjectType.objects.create(name="Blitz", category=category, prefix_identifier="B")
+        models.RentalObject.objects.create(type=not_rentable, internal_identifier=1, rentable=False)
+        all_defect = models.RentalObjectType.objects.create(name="Mikrofon", category=category, prefix_identifier="M")
+        models.RentalObjectStatus.objects.create(rental_object=models.RentalObject.objects.create(type=all_defect, internal_identifier=1),
+                                                 from_date=date(2023, 1, 5), until_date=date(2023, 1, 5))
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 1)
+        pks = [self.object_type.pk, without_objects.pk, not_rentable.pk, all_defect.pk]
+        self.assertEnginesAgree(pks, [(date(2023, 1, 5), date(2023, 1, 6)), (date(2023, 1, 6), date(2023, 1, 6)), (date(2023, 1, 6), date(2023, 1, 5))])
+        self.assertEqual(availability.available_sql([], availability.normalize_date(date(2023, 1, 5)), availability.normalize_date(date(2023, 1, 6))), {})
+
+    def test_several_ranges_at_once(self):
+        other_type = models.RentalObjectType.objects.create(name="Stativ", category=self.object_type.category, prefix_identifier="S")
+        models.RentalObject.objects.create(type=other_type, internal_identifier=1)
+        self.reserve(date(2023, 1, 5), date(2023, 1, 12), 2)
+        models.RentalObjectStatus.objects.create(rental_object=self.objects[1], from_date=date(2023, 1, 13), until_date=date(2023, 1, 13))
+        ranges = [(pk, availability.normalize_date(from_date), availability.normalize_date(until_date)) for pk in [self.object_type.pk, other_type.pk]
+                  for from_date, until_date in [(date(2023, 1, 5), date(2023, 1, 12)), (date(2023, 1, 12), date(2023, 1, 19)), (date(2023, 1, 14), date(2023, 1, 14))]]
+        expected = {key: legacy_available(*key) for key in ranges}
+        with self.assertNumQueries(1):
+            self.assertEqual(availability.available_sql_ranges(ranges), expected)
+        with self.assertNumQueries(4):
+            self.assertEqual(availability.available_snapshot(ranges), expected)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AvailabilityCacheTestCase(AvailabilityFixture, TransactionTestCase):
+    def test_cached_until_the_type_changes(self):
+        from_date, until_date = date(2023, 1, 5), date(2023, 1, 19)
+        self.assertEqual(models.RentalObjectType.available(self.object_type.pk, from_date, until_date)['available'], 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(models.RentalObjectType.available(self.object_type.pk, from_date, until_date)['available'], 5)
+        reservation = self.reserve(date(2023, 1, 12), date(2023, 1, 19), 2)
+        self.assertEqual(models.RentalObjectType.available(self.object_type.pk, from_date, until_date)['available'], 3)
+        reservation.canceled = timezone.now()
+        reservation.save()
+        self.assertEqual(models.RentalObjectType.available(self.object_type.pk, from_date, until_date)['available'], 5)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, SETTINGS_CACHE_CHECK_INTERVAL=60)
+class DynamicSettingsTestCase(TestCase):
+    def setUp(self):
+        dynamic_settings.invalidate()
+
+    def tearDown(self):
+        dynamic_settings.invalidate()
+
+    def test_read_from_process_cache_until_saved(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            setting = models.Settings.objects.create(type='onpremise_starttime', value='10:30', public=True)
+            models.Settings.objects.create(type='onpremise_weekdays', value='1, 2,3', public=True)
+        self.assertEqual(dynamic_settings.get_time('onpremise_starttime'), (10, 30))
+        with self.assertNumQueries(0):
+            self.assertEqual(dynamic_settings.get_list('onpremise_weekdays'), ['1', '2', '3'])
+            self.assertEqual(dynamic_settings.get('onpremise_starttime'), '10:30')
+        with self.captureOnCommitCallbacks(execute=True):
+            setting.value = '18'
+            setting.save()
+        self.assertEqual(dynamic_settings.get_time('onpremise_starttime'), (18, 0))
+        with self.assertRaises(models.Settings.DoesNotExist):
+            dynamic_settings.get('unknown')
+
+    def test_other_process_reloads_after_version_bump(self):
+        models.Settings.objects.create(type='lenting_day', value='4', public=True)
+        self.assertEqual(dynamic_settings.get_int('lenting_day'), 4)
+        # simulates a save in another process, this one only sees the bumped version after the check interval
+        models.Settings.objects.filter(type='lenting_day').update(value='3')
+        cache_versions.bump_version(dynamic_settings.VERSION_NAME)
+        self.assertEqual(dynamic_settings.get_int('lenting_day'), 4)
+        with override_settings(SETTINGS_CACHE_CHECK_INTERVAL=0):
+            self.assertEqual(dynamic_settings.get_int('lenting_day'), 3)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MailTemplatesTestCase(TestCase):
+    def test_compiled_once_per_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            text = models.Text.objects.create(name='signup_mail', content='{{ x }} %}}</p>')
+        self.assertEqual(mail_templates.render('signup_mail', {'x': 1}), '1 %}}</p>')
+        self.assertEqual(mail_templates.render('signup_mail', {'x': 1}, unwrap_tags=True), '1 %}}')
+        with self.assertNumQueries(0):
+            template = mail_templates.get_template('signup_mail')
+        with self.captureOnCommitCallbacks(execute=True):
+            text.content = 'Hallo {{ name }}'
+            text.save()
+        self.assertIsNot(mail_templates.get_template('signup_mail'), template)
+        self.assertEqual(mail_templates.render('signup_mail', {'name': 'Kim'}), 'Hallo Kim')
+        with self.captureOnCommitCallbacks(execute=True):
+            text.name = 'renamed'
+            text.save()
+        with self.assertRaises(models.Text.DoesNotExist):
+            mail_templates.get_template('signup_mail')
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', MAIL_BATCH_SIZE=2, MAIL_RATE_LIMIT_PER_MINUTE=3,
+                   MAIL_RETRY_BACKOFF=60, MAIL_MAX_ATTEMPTS=2)
+class OutboxTestCase(TestCase):
+    def test_sent_in_batches_within_rate_limit(self):
+        for i in range(4):
+            mail.queue_mail(subject=f"Mail {i}", message="text", html_message="<p>text</p>", recipient_list=["renter@rwth-aachen.de"])
+        self.assertEqual(len(django_mail.outbox), 0)
+        self.assertEqual(mail.send_queued(), 2)
+        self.assertEqual(mail.send_queued(), 1)
+        self.assertEqual(mail.send_queued(), 0)
+        self.assertEqual([message.subject for message in django_mail.outbox], ["Mail 0", "Mail 1", "Mail 2"])
+        self.assertEqual(django_mail.outbox[0].alternatives, [("<p>text</p>", "text/html")])
+
+    def test_failed_mails_are_retried_with_backoff(self):
+        queued = mail.queue_mail(subject="Mail", message="text", recipient_list=["renter@rwth-aachen.de"])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=ConnectionError("down")):
+            self.assertEqual(mail.send_queued(), 0)
+        queued.refresh_from_db()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn("down", queued.last_error)
+        self.assertEqual(mail.send_queued(), 0)
+        models.OutgoingMail.objects.update(send_after=timezone.now())
+        self.assertEqual(mail.send_queued(), 1)
+        self.assertEqual(len(django_mail.outbox), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        queued = mail.queue_mail(subject="Mail", message="text", recipient_list=["renter@rwth-aachen.de"])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=ConnectionError("down")):
+            for _ in range(2):
+                models.OutgoingMail.objects.update(send_after=timezone.now())
+                with self.assertLogs('django', 'WARNING') as logs:
+                    self.assertEqual(mail.send_queued(), 0)
+        self.assertIn("giving up on mail", logs.output[-1])
+        queued.refresh_from_db()
+        self.assertIsNotNone(queued.failed_at)
+        self.assertIsNone(queued.claimed_until)
+
+    def test_claims_count_against_the_rate_limit(self):
+        for i in range(4):
+            mail.queue_mail(subject=f"Mail {i}", message="text", recipient_list=["renter@rwth-aachen.de"])
+        # two runs at the same time, the mails of the first are still being sent
+        self.assertEqual(len(mail.claim()), 2)
+        self.assertEqual(len(mail.claim()), 1)
+        self.assertEqual(mail.claim(), [])
+        # the lease of a crashed run expires
+        models.OutgoingMail.objects.update(claimed_until=timezone.now())
+        self.assertEqual(mail.send_queued(), 2)
+
+    def test_queued_in_the_transaction_of_the_request(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            mail.queue_mail(subject="Mail", message="text", recipient_list=["renter@rwth-aachen.de"])
+        self.assertEqual([callback.__name__ for callback in callbacks], ['schedule_delivery'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReminderTestCase(AvailabilityFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        dynamic_settings.invalidate()
+        models.Settings.objects.create(type='returning_start_hour', value='8', public=True)
+        models.Settings.objects.create(type='returning_end_hour', value='12', public=True)
+        models.Text.objects.create(name='reservation_lender_notification', content='{{ reservations|length }}')
+        models.Text.objects.create(name='rental_expiration_notification', content='{% for rental in rentals %}{{ rental.rented_object.merged_identifier }} {% endfor %}')
+        self.today = timezone.localdate()
+        self.users = [self.profile] + [models.Profile.objects.create(user=User.objects.create_user(username=f"renter{i}", email=f"renter{i}@rwth-aachen.de"),
+                                                                     prio=self.profile.prio) for i in range(2)]
+
+    def tearDown(self):
+        dynamic_settings.invalidate()
+
+    def rent(self, profile, rented_object, until_date):
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = models.Reservation.objects.create(reserver=profile, reserved_from=self.today - timedelta(days=7), reserved_until=until_date,
+                                                            objecttype=self.object_type, operation_number=1, count=1)
+            return models.Rental.objects.create(rented_object=rented_object, rental_number=1, reservation=reservation,
+                                                handed_out_at=timezone.now() - timedelta(days=7))
+
+    def pending(self):
+        return sorted((reminder.kind, reminder.due_at) for reminder in models.ScheduledReminder.objects.filter(sent_at__isnull=True))
+
+    def send_due(self):
+        with CaptureQueriesContext(connection) as queries:
+            counts = reminders.send_due()
+        return counts, len(queries)
+
+    def test_scheduled_and_moved_with_the_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = self.reserve(self.today + timedelta(days=3), self.today + timedelta(days=10), 1)
+        rental = self.rent(self.users[1], self.objects[0], self.today + timedelta(days=4))
+        self.assertEqual(self.pending(), [
+            ('rental_expiration', reminders.local_datetime(self.today + timedelta(days=2))),
+            ('rental_missing', reminders.local_datetime(self.today + timedelta(days=4), 12)),
+            ('reservation_start', reminders.local_datetime(self.today + timedelta(days=2))),
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Extension.objects.create(extended_from=self.today + timedelta(days=4), extended_until=self.today + timedelta(days=11),
+                                            extended_by=self.users[1].user, extended_rental=rental)
+            reservation.canceled = timezone.now()
+            reservation.save()
+        self.assertEqual(self.pending(), [
+            ('rental_expiration', reminders.local_datetime(self.today + timedelta(days=9))),
+            ('rental_missing', reminders.local_datetime(self.today + timedelta(days=11), 12)),
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            rental.delete()
+        self.assertEqual(self.pending(), [])
+
+    def test_due_reminders_are_sent_with_a_fixed_number_of_queries(self):
+        # settings and templates are only read once per process
+        dynamic_settings.values()
+        mail_templates.get_template('reservation_lender_notification')
+        mail_templates.get_template('rental_expiration_notification')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reserve(self.today + timedelta(days=1), self.today + timedelta(days=8), 1)
+        self.rent(self.users[0], self.objects[0], self.today + timedelta(days=2))
+        models.ScheduledReminder.objects.filter(rental=self.rent(self.users[0], self.objects[4], self.today), kind='rental_missing').update(due_at=timezone.now())
+        counts, few_rows = self.send_due()
+        self.assertEqual(counts, {'reservation_start': 1, 'rental_expiration': 1, 'rental_missing': 1})
+        self.assertEqual(self.send_due()[0], {'reservation_start': 0, 'rental_expiration': 0, 'rental_missing': 0})
+
+        models.OutgoingMail.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reserve(self.today, self.today + timedelta(days=7), 2)
+            self.reserve(self.today + timedelta(days=1), self.today + timedelta(days=8), 1)
+        for i in range(1, 4):
+            self.rent(self.users[i % 3], self.objects[i], self.today + timedelta(days=2))
+        extended = self.rent(self.users[1], self.objects[4], self.today)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Extension.objects.create(extended_from=self.today, extended_until=self.today + timedelta(days=2),
+                                            extended_by=self.users[1].user, extended_rental=extended)
+        missing = self.rent(self.users[2], self.objects[5], self.today)
+        models.ScheduledReminder.objects.filter(rental=missing, kind='rental_missing').update(due_at=timezone.now())
+        counts, many_rows = self.send_due()
+        self.assertEqual(counts, {'reservation_start': 1, 'rental_expiration': 3, 'rental_missing': 1})
+        self.assertEqual(many_rows, few_rows)
+        self.assertEqual(models.OutgoingMail.objects.get(recipient_list=["renter0@rwth-aachen.de"]).message, "K1 K4 ")
+        self.assertEqual(self.send_due()[0], {'reservation_start': 0, 'rental_expiration': 0, 'rental_missing': 0})
+        self.assertTrue(tasks.send_due_reminders().startswith("queued 0 mails about reservations"))
+
+
+class RentalFormTestCase(TestCase):
+    def test_parsed_once_until_the_file_changes(self):
+        rental_form._documents.clear()
+        path = models.Files.objects.create(name='rental_form').file.path
+        context = {'rented_items': [], 'reserver': {'first_name': 'Kim', 'last_name': 'Meyer', 'email': 'kim@rwth-aachen.de'}}
+        with mock.patch('base.rental_form.Document', wraps=rental_form.Document) as document:
+            forms = [rental_form.render(context) for _ in range(2)]
+            self.assertEqual(document.call_count, 1)
+            with tempfile.TemporaryDirectory() as directory:
+                copied = shutil.copy(path, directory)
+                rental_form.get_document(copied)
+                os.utime(copied, (os.stat(copied).st_atime, os.stat(copied).st_mtime + 1))
+                rental_form.get_document(copied)
+            self.assertEqual(document.call_count, 3)
+        for form in forms:
+            self.assertTrue(form.startswith(b'PK'))
+
+
+class ImageVariantsTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.category = models.Category.objects.create(name="Kameras")
+
+    def upload(self, size, mode='RGBA'):
+        image = io.BytesIO()
+        Image.new(mode, size, (200, 10, 10, 128) if mode == 'RGBA' else (200, 10, 10)).save(image, 'PNG')
+        return default_storage.save('camera.png', ContentFile(image.getvalue()))
+
+    def test_variants_after_upload(self):
+        with mock.patch('base.tasks.generate_image_variants.delay', side_effect=images.update_variants) as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                object_type = models.RentalObjectType.objects.create(name="Kamera", category=self.category, prefix_identifier="K", image=self.upload((2000, 1000)))
+            self.assertEqual(delay.call_count, 1)
+            object_type.refresh_from_db()
+            with self.captureOnCommitCallbacks(execute=True):
+                # unchanged image
+                object_type.save()
+            self.assertEqual(delay.call_count, 1)
+        variants = object_type.image_variants
+        self.assertEqual(variants['source'], object_type.image.name)
+        for variant, size in [('thumbnail', (320, 160)), ('medium', (960, 480))]:
+            for extension, file_format in [('webp', 'WEBP'), ('jpeg', 'JPEG')]:
+                with Image.open(default_storage.path(variants[variant][extension])) as image:
+                    self.assertEqual((image.size, image.format), (size, file_format))
+        from api import serializers
+        self.assertEqual(serializers.RentalObjectTypeSerializer(object_type).data['image_variants']['thumbnail']['webp'],
+                         settings.MEDIA_URL + variants['thumbnail']['webp'])
+
+    def test_backfill_and_replace(self):
+        small = self.upload((100, 50), mode='RGB')
+        first = models.RentalObjectType.objects.create(name="Kamera", category=self.category, prefix_identifier="K", image=small)
+        second = models.OnPremiseWorkplace.objects.create(name="Platz", image=small)
+        call_command('generate_image_variants', stdout=io.StringIO())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        # same image, same files. small images are not scaled up
+        self.assertEqual(first.image_variants, second.image_variants)
+        with Image.open(default_storage.path(first.image_variants['medium']['jpeg'])) as image:
+            self.assertEqual(image.size, (100, 50))
+        old_files = images.variant_names(first.image_variants)
+        for instance in [first, second]:
+            instance.image = self.upload((400, 400))
+            instance.save()
+        self.assertTrue(images.update_variants('base.RentalObjectType', first.pk))
+        self.assertTrue(all(default_storage.exists(name) for name in old_files))
+        self.assertTrue(images.update_variants('base.OnPremiseWorkplace', second.pk))
+        self.assertFalse(any(default_storage.exists(name) for name in old_files))
+
+    def test_force_after_changed_sizes(self):
+        object_type = models.RentalObjectType.objects.create(name="Kamera", category=self.category, prefix_identifier="K", image=self.upload((2000, 1000)))
+        call_command('generate_image_variants', stdout=io.StringIO())
+        object_type.refresh_from_db()
+        old_files = images.variant_names(object_type.image_variants)
+        with override_settings(IMAGE_VARIANT_SIZES={'thumbnail': 200, 'medium': 600}):
+            call_command('generate_image_variants', force=True, stdout=io.StringIO())
+        object_type.refresh_from_db()
+        for variant, size in [('thumbnail', (200, 100)), ('medium', (600, 300))]:
+            for extension in ['webp', 'jpeg']:
+                with Image.open(default_storage.path(object_type.image_variants[variant][extension])) as image:
+                    self.assertEqual(image.size, size)
+        self.assertFalse(any(default_storage.exists(name) for name in old_files))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        for type, value in [('lenting_day', '4'), ('returning_day', '4'), ('onpremise_weekdays', '1,2,3,4,5'), ('onpremise_starttime', '10:00'),
+                            ('onpremise_endtime', '18:00'), ('onpremise_breakinbetween_in_min', '15'), ('onpremise_date_range_in_days', '7'),
+                            ('onepremise_slotduration', '90'), ('lenting_start_hour', '12'), ('lenting_end_hour', '16'),
+                            ('returning_start_hour', '8'), ('returning_end_hour', '12')]:
+            models.Settings.objects.create(type=type, value=value, public=True)
+        models.Text.objects.create(name='reservation_confirmation_mail', content="{% for reservation in reservations %}{{ reservation.objecttype }}{% endfor %}")
+
+    def test_generate_and_benchmark(self):
+        call_command('generate_test_data', scale=0.1, years=0.5, force=True, stdout=io.StringIO())
+        pks = list(models.RentalObjectType.objects.values_list('pk', flat=True))
+        self.assertEqual(len(pks), 6)
+        self.assertTrue(models.Rental.objects.filter(received_back_at__isnull=True).exists())
+        self.assertTrue(models.Extension.objects.exists())
+        # objects are only reserved while they are free
+        today = timezone.localdate()
+        for day in range(-180, 60, 7):
+            for data in availability.available_many(pks, today + timedelta(days=day), today + timedelta(days=day)).values():
+                self.assertGreaterEqual(data['available'], 0)
+        reservations = models.Reservation.objects.count()
+        output = io.StringIO()
+        call_command('benchmark', iterations=3, warmup=0, stdout=output)
+        report = json.loads(output.getvalue())
+        self.assertEqual(set(report['endpoints']), {'available', 'catalog', 'bulk_reservation', 'rentals', 'open_rentals', 'slots', 'download_form'})
+        for name in ['available', 'catalog', 'bulk_reservation', 'rentals', 'open_rentals', 'slots']:
+            self.assertEqual(report['endpoints'][name]['status'], {'200': 3}, name)
+        self.assertTrue(report['endpoints']['download_form']['skipped'])
+        # the benchmark user is deleted with its reservations and their queued mails
+        self.assertEqual(models.Reservation.objects.count(), reservations)
+        self.assertFalse(User.objects.filter(username__startswith="benchmark-").exists())
+        self.assertFalse(models.OutgoingMail.objects.filter(recipient_list__0__endswith="@example.invalid").exists())